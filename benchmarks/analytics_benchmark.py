@@ -0,0 +1,139 @@
+"""
+Compares the vectorized analytics module against the straightforward per-object loops over List[Match] / List[Stat] that it replaces.
+Both produce the same figures (checked on every run). Loading the arrays is timed separately, since it's paid once per history.
+
+    venv/bin/python benchmarks/analytics_benchmark.py [--matches 2000] [--stats 100] [--players 30] [--repeat 5]
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import analytics
+from analytics import History, Record, ShotRecord
+from domain.match import Match, GameScore, Stat
+from domain.player import Player
+
+SHOT_TYPES = ["DROP", "DINK", "DRIVE", "LOB", "SERVE", "RETURN", "VOLLEY", "OVERHEAD"]
+SHOT_SIDES = ["FOREHAND", "BACKHAND", None]
+SHOT_RESULTS = ["WINNER", "ERROR", "NEUTRAL"]
+
+
+def build_matches(match_count: int, stats_per_match: int, player_count: int):
+    rng = random.Random(42)
+    players = [Player(f"player{i}", "user", i == 0, None, f"First{i}", f"Last{i}") for i in range(player_count)]
+    matches = []
+    for i in range(match_count):
+        doubles = rng.random() < 0.7
+        team_players = rng.sample(players, 4 if doubles else 2)
+        scores = [GameScore(11, rng.randint(0, 9)) if rng.random() < 0.5 else GameScore(rng.randint(0, 9), 11) for _ in range(rng.choice([1, 3]))]
+        stats = [Stat(f"match{i}", rng.choice(team_players).player_id, rng.randrange(len(scores)), rng.choice(SHOT_RESULTS), rng.choice(SHOT_TYPES), rng.choice(SHOT_SIDES)) for _ in range(stats_per_match)]
+        matches.append(Match(
+            f"match{i}", "user", datetime.datetime(2021, 1, 1) + datetime.timedelta(hours=i),
+            team_players[0], team_players[2] if doubles else None, team_players[1], team_players[3] if doubles else None,
+            scores, stats
+        ))
+    return matches
+
+
+# The per-object implementations
+
+def winning_team(match: Match) -> int:
+    team1_games = sum(1 for score in match.scores if score.team1_score > score.team2_score)
+    team2_games = sum(1 for score in match.scores if score.team2_score > score.team1_score)
+    return 1 if team1_games > team2_games else 2 if team2_games > team1_games else 0
+
+
+def teams(match: Match):
+    return [player.player_id for player in [match.team1_player1, match.team1_player2] if player is not None], [player.player_id for player in [match.team2_player1, match.team2_player2] if player is not None]
+
+
+def naive_win_rates(matches):
+    records = {}
+    for match in matches:
+        winner = winning_team(match)
+        team1, team2 = teams(match)
+        for team, players in [(1, team1), (2, team2)]:
+            for player_id in players:
+                record = records.setdefault(player_id, Record(0, 0))
+                record.played += 1
+                record.won += winner == team
+    return records
+
+
+def naive_shot_records(matches, key):
+    records = {}
+    for match in matches:
+        for stat in match.stats:
+            if stat.shot_result in ("WINNER", "ERROR"):
+                record = records.setdefault(stat.player_id, {}).setdefault(key(stat), ShotRecord(0, 0))
+                if stat.shot_result == "WINNER":
+                    record.winners += 1
+                else:
+                    record.errors += 1
+    return records
+
+
+def naive_pair_records(matches, partners: bool):
+    records = defaultdict(dict)
+    for match in matches:
+        winner = winning_team(match)
+        team1, team2 = teams(match)
+        for team, players, others in [(1, team1, team2), (2, team2, team1)]:
+            for player_id in players:
+                for other_id in (players if partners else others):
+                    if other_id != player_id:
+                        record = records[player_id].setdefault(other_id, Record(0, 0))
+                        record.played += 1
+                        record.won += winner == team
+    return dict(records)
+
+
+def best_of(repeat: int, fun):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fun()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--matches", type=int, default=2000)
+    parser.add_argument("--stats", type=int, default=100)
+    parser.add_argument("--players", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    matches = build_matches(args.matches, args.stats, args.players)
+    load_time, history = best_of(args.repeat, lambda: History.from_matches(matches))
+    print(f"{args.matches} matches, {args.matches * args.stats} stats, {args.players} players (best of {args.repeat})")
+    print(f"  {'History.from_matches (once per history)':<40} {load_time * 1000:8.1f} ms")
+
+    figures = [
+        ("win rates", lambda: naive_win_rates(matches), lambda: analytics.win_rates(history)),
+        ("shot efficiency", lambda: naive_shot_records(matches, lambda stat: stat.shot_type), lambda: analytics.shot_efficiency(history)),
+        ("game splits", lambda: naive_shot_records(matches, lambda stat: stat.game_index), lambda: analytics.game_splits(history)),
+        ("partner records", lambda: naive_pair_records(matches, partners=True), lambda: analytics.partner_records(history)),
+        ("opponent records", lambda: naive_pair_records(matches, partners=False), lambda: analytics.opponent_records(history)),
+    ]
+    naive_total, vectorized_total = 0, 0
+    for name, naive, vectorized in figures:
+        naive_time, naive_result = best_of(args.repeat, naive)
+        vectorized_time, vectorized_result = best_of(args.repeat, vectorized)
+        assert naive_result == vectorized_result, f"{name} differ"
+        naive_total += naive_time
+        vectorized_total += vectorized_time
+        print(f"  {name:<20} loops {naive_time * 1000:8.1f} ms   numpy {vectorized_time * 1000:8.2f} ms  ({naive_time / vectorized_time:.0f}x)")
+    print(f"  {'all five':<20} loops {naive_total * 1000:8.1f} ms   numpy {vectorized_total * 1000:8.2f} ms  ({naive_total / vectorized_total:.0f}x, "
+          f"{naive_total / (vectorized_total + load_time):.1f}x including the load)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Measures what a Lambda cold start pays for: how long each module takes to import and how long each initialization step takes.
+Every run happens in a fresh interpreter so nothing is already cached in sys.modules.
+
+    venv/bin/python benchmarks/cold_start_benchmark.py [--runs 5] [--top 15]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+# Run inside the child interpreter. Each step is timed on its own, in the order a first request would hit it
+CHILD_SCRIPT = """
+import json, os, sys, time
+steps = []
+
+def step(name, fun):
+    start = time.perf_counter()
+    fun()
+    steps.append((name, (time.perf_counter() - start) * 1000))
+
+step("import handler", lambda: __import__("handler"))
+import handler
+step("Handler.get_instance()", handler.Handler.get_instance)
+step("first request (no db, no token)", lambda: handler.handle({"resource": "/players", "httpMethod": "GET", "headers": {}}, None))
+step("import pymysql (first db query)", lambda: __import__("pymysql"))
+step("import firebase_admin.auth (first token)", lambda: __import__("firebase_admin.auth"))
+step("firebase_admin.initialize_app()", lambda: __import__("firebase_admin").initialize_app())
+print(json.dumps(steps))
+"""
+
+
+def run_child(extra_args=()):
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    return subprocess.run([sys.executable, *extra_args, "-c", CHILD_SCRIPT], env=env, capture_output=True, text=True, check=True)
+
+
+def import_times(stderr: str):
+    # -X importtime lines look like "import time: <self us> | <cumulative us> | <module>", with the module indented by nesting depth
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        times[name] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    step_samples = {}
+    module_samples = {}
+    for _ in range(args.runs):
+        result = run_child(["-X", "importtime"])
+        for name, millis in json.loads(result.stdout.strip().splitlines()[-1]):
+            step_samples.setdefault(name, []).append(millis)
+        for name, (_, cumulative_us) in import_times(result.stderr).items():
+            module_samples.setdefault(name, []).append(cumulative_us / 1000)
+
+    print(f"Init steps (median of {args.runs} cold interpreters, -X importtime adds some overhead)")
+    for name, samples in step_samples.items():
+        print(f"  {name:<45} {statistics.median(samples):8.1f} ms")
+    print(f"  {'total':<45} {sum(statistics.median(samples) for samples in step_samples.values()):8.1f} ms")
+
+    print(f"\nSlowest imports (cumulative, top {args.top})")
+    medians = sorted(((statistics.median(samples), name) for name, samples in module_samples.items()), reverse=True)
+    for millis, name in medians[:args.top]:
+        print(f"  {name:<45} {millis:8.1f} ms")
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    print(f"\nFinished in {time.perf_counter() - start:.1f}s")
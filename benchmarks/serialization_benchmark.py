@@ -0,0 +1,92 @@
+"""
+Compares the old json.dumps(default=default_serialize) path against the precompiled serializers on a large /matches payload.
+
+    venv/bin/python benchmarks/serialization_benchmark.py [--matches 2000] [--stats 40] [--repeat 5]
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import serialization
+from domain.base import DomainBase
+from domain.match import Match, GameScore, Stat, NormalizedMatches
+from domain.player import Player
+
+
+def default_serialize(x):
+    if isinstance(x, datetime.datetime):
+        return x.strftime("%Y-%m-%dT%H:%M:%SZ")
+    elif isinstance(x, DomainBase):
+        return x.to_dict()
+    else:
+        return x.__dict__
+
+
+def legacy_dumps(body):
+    return json.dumps(body, default=default_serialize)
+
+
+def build_matches(match_count: int, stats_per_match: int):
+    players = [Player(f"player{i}", "user", i == 0, f"https://example.com/{i}.jpg", f"First{i}", f"Last{i}", "RIGHT", "notes", "555-5555", f"p{i}@example.com", 4.5) for i in range(10)]
+    return [
+        Match(
+            match_id=f"match{i}",
+            user_id="user",
+            date=datetime.datetime(2021, 1, 1) + datetime.timedelta(hours=i),
+            team1_player1=players[0],
+            team1_player2=players[(i + 1) % 10] if i % 3 else None,
+            team2_player1=players[(i + 2) % 10],
+            team2_player2=players[(i + 3) % 10] if i % 3 else None,
+            scores=[GameScore(11, i % 11), GameScore(i % 11, 11), GameScore(11, 9)],
+            stats=[Stat(f"match{i}", players[j % 4].player_id, j % 3, "WINNER" if j % 2 else "ERROR", "DINK", "FOREHAND" if j % 5 else None) for j in range(stats_per_match)],
+        )
+        for i in range(match_count)
+    ]
+
+
+def best_of(repeat: int, fun):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fun()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--matches", type=int, default=2000)
+    parser.add_argument("--stats", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    matches = build_matches(args.matches, args.stats)
+    legacy_time, legacy_body = best_of(args.repeat, lambda: legacy_dumps(matches))
+    print(f"{args.matches} matches, {args.stats} stats each, {len(legacy_body) / 1e6:.1f} MB of json (best of {args.repeat})")
+    print(f"  {'json.dumps(default=default_serialize)':<40} {legacy_time * 1000:8.1f} ms")
+
+    orjson = serialization.orjson
+    serialization.orjson = None
+    json_time, json_body = best_of(args.repeat, lambda: serialization.dumps(matches))
+    serialization.orjson = orjson
+    assert json.loads(json_body) == json.loads(legacy_body)
+    print(f"  {'precompiled encoders + json':<40} {json_time * 1000:8.1f} ms  ({legacy_time / json_time:.1f}x)")
+
+    if orjson is not None:
+        orjson_time, orjson_body = best_of(args.repeat, lambda: serialization.dumps(matches))
+        assert json.loads(orjson_body) == json.loads(legacy_body)
+        print(f"  {'precompiled encoders + orjson':<40} {orjson_time * 1000:8.1f} ms  ({legacy_time / orjson_time:.1f}x)")
+    else:
+        print("  orjson isn't installed, so the fast backend was skipped")
+
+    normalized_time, normalized_body = best_of(args.repeat, lambda: serialization.dumps(NormalizedMatches(matches)))
+    print(f"  {'?shape=normalized':<40} {normalized_time * 1000:8.1f} ms  ({legacy_time / normalized_time:.1f}x, {len(normalized_body) / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
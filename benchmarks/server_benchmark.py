@@ -0,0 +1,165 @@
+"""
+Load tests the self-hosted server (src/server.py) at several worker counts, to show how throughput scales with the worker pool.
+Requests go through the real Handler, ManagerImpl and DaoImpl over HTTP, but the database is simulated: every query just sleeps for --latency ms (as a
+round trip to MySQL would, without holding the GIL) and returns canned rows. The connection pool has one connection per worker, as the server's does.
+
+With --asyncio, the event loop server (server.py --asyncio) is run too, with the same number of DB connections (and so DB threads) as each worker count.
+
+    venv/bin/python benchmarks/server_benchmark.py [--workers 1,2,4,8,16] [--requests 400] [--clients 32] [--latency 5] [--players 20] [--asyncio]
+"""
+import argparse
+import asyncio
+import http.client
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from async_bl import AsyncManagerImpl
+from async_da import AsyncDaoImpl
+from async_handler import AsyncHandler
+from bl import ManagerImpl
+from connection_pool import ConnectionPool
+from da import DaoImpl
+from firebase_client import FirebaseClient
+from handler import Handler
+from server import PooledHTTPServer, AsyncHTTPServer
+
+
+class SignedInFirebaseClient(FirebaseClient):
+    def get_firebase_user(self, token: str):
+        return {"user_id": "fb_load", "name": "Load Test"}
+
+
+class SimulatedCursor:
+    def __init__(self, latency: float, player_count: int):
+        self.latency = latency
+        self.player_count = player_count
+        self.rows = []
+
+    def execute(self, sql, args=None):
+        time.sleep(self.latency)
+        if "from users where firebase_id" in sql:
+            self.rows = [("load_user", "fb_load", "Load", "Test", None)]
+        elif "select data_version" in sql:
+            self.rows = [(1,)]
+        elif "from players where owner_user_id" in sql:
+            self.rows = [(f"player{i}", "load_user", i == 0, None, "First", f"Last{i}", "RIGHT", None, None, None, 3.5) for i in range(self.player_count)]
+        else:
+            self.rows = []
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if len(self.rows) > 0 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+class SimulatedConnection:
+    open = True
+
+    def __init__(self, latency: float, player_count: int):
+        self.latency = latency
+        self.player_count = player_count
+
+    def cursor(self):
+        return SimulatedCursor(self.latency, self.player_count)
+
+    def ping(self, reconnect=False):
+        time.sleep(self.latency)
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def running_server(workers: int, latency: float, player_count: int):
+    dao = DaoImpl(ConnectionPool(lambda: SimulatedConnection(latency, player_count), max_size=workers))
+    server = PooledHTTPServer(("127.0.0.1", 0), Handler(ManagerImpl(SignedInFirebaseClient(), dao)), workers)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@contextmanager
+def running_async_server(db_pool_size: int, latency: float, player_count: int):
+    dao = AsyncDaoImpl(DaoImpl(ConnectionPool(lambda: SimulatedConnection(latency, player_count), max_size=db_pool_size)))
+    server = AsyncHTTPServer(AsyncHandler(AsyncManagerImpl(SignedInFirebaseClient(), dao)))
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        asyncio.run_coroutine_threadsafe(server.start("127.0.0.1", 0), loop).result()
+        yield server
+    finally:
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        dao.executor.shutdown()
+
+
+def get_players(port: int) -> float:
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("GET", "/players", headers={"X-Firebase-Token": "token"})
+        response = conn.getresponse()
+        response.read()
+        assert response.status == 200, response.status
+    finally:
+        conn.close()
+    return time.perf_counter() - start
+
+
+def load(port: int, request_count: int, client_count: int):
+    """Requests per second, and each request's latency"""
+    with ThreadPoolExecutor(max_workers=client_count) as clients:
+        start = time.perf_counter()
+        latencies = list(clients.map(lambda _: get_players(port), range(request_count)))
+        elapsed = time.perf_counter() - start
+    return request_count / elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4,8,16", help="Comma separated worker counts to try")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--clients", type=int, default=32, help="Concurrent clients")
+    parser.add_argument("--latency", type=float, default=5, help="Simulated ms per database round trip")
+    parser.add_argument("--players", type=int, default=20, help="Players in each response")
+    parser.add_argument("--asyncio", action="store_true", help="Also run the event loop server")
+    args = parser.parse_args()
+
+    print(f"GET /players, {args.requests} requests from {args.clients} concurrent clients, {args.latency:g} ms per simulated db round trip")
+    servers = [("worker(s)", running_server)] + ([("db thread(s), asyncio", running_async_server)] if args.asyncio else [])
+    baseline = None
+    for label, running in servers:
+        for workers in [int(workers) for workers in args.workers.split(",")]:
+            # The handler logs every request, which would drown out the results
+            with running(workers, args.latency / 1000, args.players) as server, redirect_stdout(open(os.devnull, "w")):
+                load(server.server_port, min(args.requests, args.clients), args.clients)  # Warm up, so the user cache is populated
+                throughput, latencies = load(server.server_port, args.requests, args.clients)
+            baseline = baseline or throughput
+            latencies.sort()
+            print(f"  {workers:>3} {label:<22} {throughput:8.1f} req/s  ({throughput / baseline:4.1f}x)   p50 {statistics.median(latencies) * 1000:7.1f} ms   p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
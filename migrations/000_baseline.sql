@@ -0,0 +1,54 @@
+-- The tables as they were before migrations were tracked, so that a fresh database can be built from migrations/ alone (see src/migrate.py).
+-- Databases that already have them skip this, since every table is created only if it doesn't exist
+create table if not exists users (
+    id varchar(64) not null primary key,
+    firebase_id varchar(128) not null,
+    first_name varchar(255) null,
+    last_name varchar(255) null,
+    image_url varchar(1024) null
+);
+
+create table if not exists players (
+    id varchar(64) not null primary key,
+    owner_user_id varchar(64) not null,
+    is_owner boolean not null default false,
+    image_url varchar(1024) null,
+    first_name varchar(255) null,
+    last_name varchar(255) null,
+    dominant_hand varchar(16) null,
+    notes text null,
+    phone_number varchar(32) null,
+    email_address varchar(255) null,
+    level decimal(2, 1) null,
+    constraint players_owner_user_id_fk foreign key (owner_user_id) references users (id) on delete cascade
+);
+
+create table if not exists matches (
+    id varchar(64) not null primary key,
+    user_id varchar(64) not null,
+    date datetime not null,
+    team1_player1_id varchar(64) not null,
+    team1_player2_id varchar(64) null,
+    team2_player1_id varchar(64) not null,
+    team2_player2_id varchar(64) null,
+    scores varchar(255) not null,
+    constraint matches_user_id_fk foreign key (user_id) references users (id) on delete cascade,
+    constraint matches_team1_player1_id_fk foreign key (team1_player1_id) references players (id) on delete cascade,
+    constraint matches_team1_player2_id_fk foreign key (team1_player2_id) references players (id) on delete cascade,
+    constraint matches_team2_player1_id_fk foreign key (team2_player1_id) references players (id) on delete cascade,
+    constraint matches_team2_player2_id_fk foreign key (team2_player2_id) references players (id) on delete cascade
+);
+
+create table if not exists stats (
+    id varchar(64) not null default (uuid()) primary key,
+    user_id varchar(64) not null,
+    match_id varchar(64) not null,
+    player_id varchar(64) not null,
+    game_index int not null,
+    shot_result varchar(32) not null,
+    shot_type varchar(32) not null,
+    shot_side varchar(32) null,
+    constraint stats_user_id_fk foreign key (user_id) references users (id) on delete cascade,
+    constraint stats_match_id_fk foreign key (match_id) references matches (id) on delete cascade,
+    constraint stats_player_id_fk foreign key (player_id) references players (id) on delete cascade
+);
@@ -0,0 +1,2 @@
+-- Bumped by every write to a user's players or matches, so GET /players and GET /matches can answer If-None-Match without running their queries
+alter table users add column data_version bigint not null default 0;
@@ -0,0 +1,10 @@
+-- updated_at drives GET /players?since= and GET /matches?since=. Deletes now set deleted_at instead of removing the row, so a sync can report them
+alter table players
+    add column updated_at datetime(6) not null default current_timestamp(6) on update current_timestamp(6),
+    add column deleted_at datetime(6) null,
+    add index players_owner_user_id_updated_at (owner_user_id, updated_at);
+
+alter table matches
+    add column updated_at datetime(6) not null default current_timestamp(6) on update current_timestamp(6),
+    add column deleted_at datetime(6) null,
+    add index matches_user_id_updated_at (user_id, updated_at);
@@ -0,0 +1,2 @@
+-- Lets GET /players/{id}/stats find a player's shots without reading the rest of the user's
+create index stats_player_id_match_id on stats (player_id, match_id);
@@ -0,0 +1,18 @@
+-- Shot counts per player and calendar month, kept up to date by create_match/delete_match/delete_player. All-time totals are the sum over months.
+-- shot_side is part of the key, so no side is stored as '' rather than null
+create table stat_rollups (
+    user_id varchar(64) not null,
+    player_id varchar(64) not null,
+    month date not null,
+    shot_type varchar(32) not null,
+    shot_side varchar(32) not null default '',
+    shot_result varchar(32) not null,
+    count int not null,
+    primary key (user_id, player_id, month, shot_type, shot_side, shot_result)
+);
+
+insert into stat_rollups (user_id, player_id, month, shot_type, shot_side, shot_result, count)
+select s.user_id, s.player_id, date_format(m.date, '%Y-%m-01'), s.shot_type, coalesce(s.shot_side, ''), s.shot_result, count(*)
+from stats s join matches m on m.id = s.match_id
+where m.deleted_at is null
+group by 1, 2, 3, 4, 5, 6;
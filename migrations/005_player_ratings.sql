@@ -0,0 +1,10 @@
+-- Elo-style ratings (see src/ratings.py). Only players who have played a match have a row.
+-- Ratings can only be worked out by replaying each user's matches in order, which SQL can't do, so after applying this run
+-- `venv/bin/python src/player_ratings.py` to fill it in for the existing matches. Until then, new matches would rate veterans as if it were their first
+create table player_ratings (
+    player_id varchar(64) not null primary key,
+    user_id varchar(64) not null,
+    rating double not null,
+    matches_played int not null,
+    index player_ratings_user_id_rating (user_id, rating)
+);
@@ -0,0 +1,14 @@
+-- Each player's record against (OPPONENT) and alongside (PARTNER) every other player, kept up to date by create_match/delete_match/delete_player.
+-- Rows aren't removed when the count drops to zero. It's filled in for the existing matches by 010, once 007 and 008 have added what it's counted from
+create table pair_records (
+    user_id varchar(64) not null,
+    player_id varchar(64) not null,
+    other_player_id varchar(64) not null,
+    relation enum('OPPONENT', 'PARTNER') not null,
+    matches int not null,
+    wins int not null,
+    losses int not null,
+    point_differential int not null,
+    primary key (player_id, relation, other_player_id),
+    index pair_records_user_id (user_id)
+);
@@ -0,0 +1,39 @@
+-- Who won each match, derived from its scores when it's written (see create_match), so that wins and losses can be counted, filtered and indexed in SQL.
+-- winning_team is 1 or 2, or null for a tie (as many games won as lost)
+alter table matches
+    add column team1_games int null,
+    add column team2_games int null,
+    add column team1_points int null,
+    add column team2_points int null,
+    add column winning_team tinyint null,
+    add index matches_user_id_winning_team (user_id, winning_team);
+
+-- Backfill by splitting each scores string ('11-5,9-11,...') into its games. Setting updated_at to itself keeps the backfill from showing up in syncs
+update matches m join (
+    select id,
+           sum(team1_score > team2_score) as team1_games,
+           sum(team2_score > team1_score) as team2_games,
+           sum(team1_score) as team1_points,
+           sum(team2_score) as team2_points
+    from (
+        with recursive games (id, game, rest) as (
+            select id, substring_index(scores, ',', 1), if(locate(',', scores) > 0, substring(scores, locate(',', scores) + 1), null) from matches
+            union all
+            select id, substring_index(rest, ',', 1), if(locate(',', rest) > 0, substring(rest, locate(',', rest) + 1), null) from games where rest is not null
+        )
+        select id, cast(substring_index(game, '-', 1) as signed) as team1_score, cast(substring_index(game, '-', -1) as signed) as team2_score from games
+    ) scores
+    group by id
+) outcomes on outcomes.id = m.id
+set m.team1_games = outcomes.team1_games,
+    m.team2_games = outcomes.team2_games,
+    m.team1_points = outcomes.team1_points,
+    m.team2_points = outcomes.team2_points,
+    m.winning_team = case when outcomes.team1_games > outcomes.team2_games then 1 when outcomes.team2_games > outcomes.team1_games then 2 end,
+    m.updated_at = m.updated_at;
+
+alter table matches
+    modify column team1_games int not null,
+    modify column team2_games int not null,
+    modify column team1_points int not null,
+    modify column team2_points int not null;
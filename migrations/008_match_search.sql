@@ -0,0 +1,26 @@
+-- Access paths for GET /matches filters (see DaoImpl.match_search_sql). Both are ordered like the listing (date desc, id desc), so a page is one index range.
+
+-- Without a player filter: the user's live matches by date
+create index matches_user_id_deleted_at_date on matches (user_id, deleted_at, date, id);
+
+-- With one: a row per player per match, so "matches player X played in" is a range of the key rather than a check of all four player columns of every
+-- match. The second index finds a match's partner/opponent. Rows stay when their match is tombstoned, since searches join matches for deleted_at anyway
+create table match_players (
+    player_id varchar(64) not null,
+    date datetime not null,
+    match_id varchar(64) not null,
+    user_id varchar(64) not null,
+    team tinyint not null,
+    primary key (player_id, date, match_id),
+    index match_players_match_id_player_id (match_id, player_id, team)
+);
+
+-- Matches used to be able to list the same player twice. Those get a single row (for either of the teams they were on)
+insert ignore into match_players (player_id, date, match_id, user_id, team)
+select team1_player1_id, date, id, user_id, 1 from matches
+union all
+select team1_player2_id, date, id, user_id, 1 from matches where team1_player2_id is not null
+union all
+select team2_player1_id, date, id, user_id, 2 from matches
+union all
+select team2_player2_id, date, id, user_id, 2 from matches where team2_player2_id is not null;
@@ -0,0 +1,14 @@
+-- The indexes DaoImpl's queries rely on, which were never written down. Some may already exist on older databases (src/migrate.py skips those, whatever they were named).
+-- matches (user_id, date) is covered by matches_user_id_deleted_at_date from 008, since every listing also filters on deleted_at is null
+
+-- get_user_by_firebase_id
+create unique index users_firebase_id on users (firebase_id);
+
+-- get_players, get_player_changes
+create index players_owner_user_id on players (owner_user_id);
+
+-- get_stats, which reads a user's stats in (match_id, id) order. InnoDB appends the primary key to every secondary index
+create index stats_user_id_match_id on stats (user_id, match_id);
+
+-- get_stats_by_match_ids
+create index stats_match_id on stats (match_id);
@@ -0,0 +1,19 @@
+-- Fills in pair_records (from 006) for every live match, from the outcome columns of 007 and the match_players rows of 008, the same way
+-- DaoImpl.update_pair_records counts them. Anything create_match recorded in the meantime is replaced, so this can't double count.
+-- `venv/bin/python src/pair_records.py` rebuilds the same thing, should the records ever drift
+delete from pair_records;
+
+insert into pair_records (user_id, player_id, other_player_id, relation, matches, wins, losses, point_differential)
+select m.user_id,
+       mine.player_id,
+       other.player_id,
+       if(other.team = mine.team, 'PARTNER', 'OPPONENT') as relation,
+       count(*),
+       sum(m.winning_team <=> mine.team),
+       sum(m.winning_team is not null and m.winning_team != mine.team),
+       sum(if(mine.team = 1, m.team1_points - m.team2_points, m.team2_points - m.team1_points))
+from matches m
+join match_players mine on mine.match_id = m.id
+join match_players other on other.match_id = m.id and other.player_id != mine.player_id
+where m.deleted_at is null
+group by m.user_id, mine.player_id, other.player_id, relation;
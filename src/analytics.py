@@ -0,0 +1,195 @@
+"""
+Figures computed over a user's whole match history.
+
+The history is loaded once into NumPy column arrays, with one entry per match, per game and per stat. Player ids and the shot enums are
+dictionary-encoded as small ints. Every figure is then a few vectorized passes (mostly np.bincount over combined codes) instead of a Python loop
+over Match and Stat objects. Python only touches the non-empty cells of the result.
+"""
+from dataclasses import dataclass
+from typing import List, Dict, Optional, Hashable
+
+import numpy as np
+
+from da import Dao
+from domain.match import Match
+from request_context import RequestContext
+
+WINNER, ERROR = "WINNER", "ERROR"
+
+# Slots of History.match_players
+TEAM1_PLAYER1, TEAM1_PLAYER2, TEAM2_PLAYER1, TEAM2_PLAYER2 = range(4)
+# The other slot on the same team as each slot, and the two slots on the other team
+PARTNER_SLOTS = [TEAM1_PLAYER2, TEAM1_PLAYER1, TEAM2_PLAYER2, TEAM2_PLAYER1]
+OPPONENT_SLOTS = [[TEAM2_PLAYER1, TEAM2_PLAYER2], [TEAM2_PLAYER1, TEAM2_PLAYER2], [TEAM1_PLAYER1, TEAM1_PLAYER2], [TEAM1_PLAYER1, TEAM1_PLAYER2]]
+NOBODY = -1
+
+
+@dataclass
+class Record:
+    """Matches won out of matches played. A tied match (as many games won as lost) is played but not won"""
+    won: int
+    played: int
+
+    @property
+    def rate(self) -> float:
+        return self.won / self.played
+
+
+@dataclass
+class ShotRecord:
+    winners: int
+    errors: int
+
+    @property
+    def efficiency(self) -> Optional[float]:
+        """Share of the decided shots that were winners"""
+        return self.winners / (self.winners + self.errors) if self.winners + self.errors > 0 else None
+
+
+class Encoding:
+    """Dictionary encoding of a column of values as the ints 0..n-1, in order of first appearance"""
+
+    def __init__(self):
+        self.codes: Dict[Hashable, int] = {}
+        self.decoded: List[Hashable] = []
+
+    def encode(self, value: Hashable) -> int:
+        return self.codes.setdefault(value, len(self.codes))
+
+    def encode_all(self, values: List[Hashable], dtype) -> np.ndarray:
+        # This runs once per stat, so the per-value work is kept to a dict lookup done in C
+        for value in dict.fromkeys(values):
+            self.encode(value)
+        return np.fromiter(map(self.codes.__getitem__, values), dtype=dtype, count=len(values))
+
+    def code(self, value: Hashable) -> int:
+        """The value's code, or -1 (which matches nothing) if it never appeared"""
+        return self.codes.get(value, -1)
+
+    @property
+    def values(self) -> List[Hashable]:
+        """Code -> value"""
+        if len(self.decoded) != len(self.codes):
+            self.decoded = list(self.codes)
+        return self.decoded
+
+    def __len__(self):
+        return len(self.codes)
+
+
+@dataclass(eq=False)
+class History:
+    players: Encoding
+    shot_types: Encoding
+    shot_sides: Encoding
+    shot_results: Encoding
+    # One row per match: the player codes in each slot (NOBODY for an empty slot in singles), and the winning team (1 or 2, 0 for a tie)
+    match_players: np.ndarray
+    match_winners: np.ndarray
+    # One entry per stat
+    stat_players: np.ndarray
+    stat_game_indexes: np.ndarray
+    stat_types: np.ndarray
+    stat_sides: np.ndarray
+    stat_results: np.ndarray
+
+    @classmethod
+    def load(cls, dao: Dao, context: RequestContext, user_id: str):
+        return cls.from_matches(dao.get_matches(context, user_id))
+
+    @classmethod
+    def from_matches(cls, matches: List[Match]):
+        """The only pass over the objects. Everything after this works on the arrays"""
+        players, shot_types, shot_sides, shot_results = Encoding(), Encoding(), Encoding(), Encoding()
+
+        match_players = np.array([
+            [players.encode(player.player_id) if player is not None else NOBODY for player in [match.team1_player1, match.team1_player2, match.team2_player1, match.team2_player2]]
+            for match in matches
+        ], dtype=np.int32).reshape(len(matches), 4)
+
+        game_matches = np.array([i for i, match in enumerate(matches) for _ in match.scores], dtype=np.int32)
+        team1_scores = np.array([score.team1_score for match in matches for score in match.scores], dtype=np.int32)
+        team2_scores = np.array([score.team2_score for match in matches for score in match.scores], dtype=np.int32)
+        team1_games = np.bincount(game_matches, weights=team1_scores > team2_scores, minlength=len(matches))
+        team2_games = np.bincount(game_matches, weights=team2_scores > team1_scores, minlength=len(matches))
+        match_winners = np.where(team1_games > team2_games, 1, np.where(team2_games > team1_games, 2, 0)).astype(np.int8)
+
+        stats = [stat for match in matches for stat in match.stats]
+        return History(
+            players, shot_types, shot_sides, shot_results, match_players, match_winners,
+            stat_players=players.encode_all([stat.player_id for stat in stats], np.int32),
+            stat_game_indexes=np.array([stat.game_index for stat in stats], dtype=np.int16),
+            stat_types=shot_types.encode_all([stat.shot_type for stat in stats], np.int8),
+            stat_sides=shot_sides.encode_all([stat.shot_side for stat in stats], np.int8),
+            stat_results=shot_results.encode_all([stat.shot_result for stat in stats], np.int8),
+        )
+
+    def slot_won(self) -> np.ndarray:
+        """(matches, 4) whether the player in each slot won the match"""
+        team1_won, team2_won = self.match_winners == 1, self.match_winners == 2
+        return np.stack([team1_won, team1_won, team2_won, team2_won], axis=1)
+
+
+def win_rates(history: History) -> Dict[str, Record]:
+    present = history.match_players != NOBODY
+    player_codes = history.match_players[present]
+    played = np.bincount(player_codes, minlength=len(history.players))
+    won = np.bincount(player_codes, weights=history.slot_won()[present], minlength=len(history.players))
+    return {history.players.values[p]: Record(int(won[p]), int(played[p])) for p in np.flatnonzero(played)}
+
+
+def shot_efficiency(history: History) -> Dict[str, Dict[str, ShotRecord]]:
+    """Winners and errors per player and shot_type"""
+    return shot_records(history, history.stat_types, history.shot_types.values)
+
+
+def game_splits(history: History) -> Dict[str, Dict[int, ShotRecord]]:
+    """Winners and errors per player and game_index"""
+    game_count = int(history.stat_game_indexes.max()) + 1 if len(history.stat_game_indexes) > 0 else 0
+    return shot_records(history, history.stat_game_indexes, list(range(game_count)))
+
+
+def partner_records(history: History) -> Dict[str, Dict[str, Record]]:
+    """Each player's record with each of their doubles partners"""
+    return pair_records(history, np.arange(4), np.array(PARTNER_SLOTS))
+
+
+def opponent_records(history: History) -> Dict[str, Dict[str, Record]]:
+    """Each player's record against each player on the other team"""
+    slots = np.repeat(np.arange(4), 2)
+    return pair_records(history, slots, np.array(OPPONENT_SLOTS).ravel())
+
+
+def shot_records(history: History, column: np.ndarray, labels: List) -> Dict[str, Dict[object, ShotRecord]]:
+    winners = count_grid(history.stat_players, column, history.stat_results == history.shot_results.code(WINNER), len(history.players), len(labels))
+    errors = count_grid(history.stat_players, column, history.stat_results == history.shot_results.code(ERROR), len(history.players), len(labels))
+
+    records: Dict[str, Dict[object, ShotRecord]] = {}
+    for p, i in zip(*np.nonzero(winners + errors)):
+        records.setdefault(history.players.values[p], {})[labels[i]] = ShotRecord(int(winners[p, i]), int(errors[p, i]))
+    return records
+
+
+def pair_records(history: History, slots: np.ndarray, other_slots: np.ndarray) -> Dict[str, Dict[str, Record]]:
+    """Records of the player in each of slots with the player in the matching entry of other_slots, across every match"""
+    players, others = history.match_players[:, slots], history.match_players[:, other_slots]
+    won = history.slot_won()[:, slots]
+    present = (players != NOBODY) & (others != NOBODY)
+
+    played = count_grid(players[present], others[present], None, len(history.players), len(history.players))
+    wins = count_grid(players[present], others[present], None, len(history.players), len(history.players), weights=won[present])
+
+    records: Dict[str, Dict[str, Record]] = {}
+    for p, q in zip(*np.nonzero(played)):
+        records.setdefault(history.players.values[p], {})[history.players.values[q]] = Record(int(wins[p, q]), int(played[p, q]))
+    return records
+
+
+def count_grid(rows: np.ndarray, columns: np.ndarray, mask: Optional[np.ndarray], row_count: int, column_count: int, weights: Optional[np.ndarray] = None) -> np.ndarray:
+    """(row_count, column_count) counts of each (row, column) pair, limited to the entries where mask is set"""
+    if mask is not None:
+        rows, columns = rows[mask], columns[mask]
+        weights = weights[mask] if weights is not None else None
+    # Combining the two codes into one lets a single bincount do a 2d group by
+    cells = rows.astype(np.int64) * column_count + columns
+    return np.bincount(cells, weights=weights, minlength=row_count * column_count).reshape(row_count, column_count).astype(np.int64)
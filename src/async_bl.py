@@ -0,0 +1,198 @@
+import asyncio
+from typing import List, Optional, Dict
+
+import ratings
+from async_da import AsyncDao
+from bl import RATINGS_QUERY, require_auth, new_user, check_player_exists, check_player_access, check_player_deletable, check_page_limit, check_batch_size, batch_results, \
+    check_match_deletable, is_backdated
+from domain.match import Match, MatchCursor, MatchPage, MatchQuery, MatchFilter, BatchResult
+from domain.pair import PairRecord, OPPONENT, PARTNER
+from domain.player import Player
+from domain.rating import PlayerRating
+from domain.stats import StatsQuery, PlayerStats
+from domain.sync import Watermark, PlayerChanges, MatchChanges
+from firebase_client import FirebaseClient
+from request_context import RequestContext
+
+
+class AsyncManager:
+    firebase_client = None
+    dao = None
+
+    async def validate_token(self, context: RequestContext, token: str) -> None: pass
+
+    async def get_data_version(self, context: RequestContext) -> int: pass
+
+    async def get_players(self, context: RequestContext) -> List[Player]: pass
+
+    async def get_player_changes(self, context: RequestContext, since: str) -> PlayerChanges: pass
+
+    async def create_player(self, context: RequestContext, player: Player) -> Player: pass
+
+    async def update_player(self, context: RequestContext, player_id: str, player: Player) -> Player: pass
+
+    async def delete_player(self, context: RequestContext, player_id: str) -> Dict: pass
+
+    async def get_player_stats(self, context: RequestContext, player_id: str, query: StatsQuery = StatsQuery()) -> PlayerStats: pass
+
+    async def get_head_to_head(self, context: RequestContext, player_id: str) -> List[PairRecord]: pass
+
+    async def get_partners(self, context: RequestContext, player_id: str) -> List[PairRecord]: pass
+
+    async def get_matches(self, context: RequestContext, query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> List[Match]: pass
+
+    async def get_match_page(self, context: RequestContext, limit: int, cursor: Optional[str], query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> MatchPage: pass
+
+    async def get_match_changes(self, context: RequestContext, since: str, query: MatchQuery = MatchQuery()) -> MatchChanges: pass
+
+    async def create_match(self, context: RequestContext, match: Match) -> Match: pass
+
+    async def create_matches(self, context: RequestContext, matches: List[Match]) -> List[BatchResult]: pass
+
+    async def delete_match(self, context: RequestContext, match_id: str) -> Dict: pass
+
+    async def get_ratings(self, context: RequestContext) -> List[PlayerRating]: pass
+
+
+class AsyncManagerImpl(AsyncManager):
+    """ManagerImpl over an AsyncDao. The rules themselves are bl's, shared with ManagerImpl, so only the dao calls differ"""
+
+    def __init__(self, firebase_client: FirebaseClient, dao: AsyncDao):
+        self.firebase_client = firebase_client
+        self.dao = dao
+
+    async def validate_token(self, context: RequestContext, token: Optional[str]):
+        if token is None:
+            return
+
+        try:
+            # Verifying a token is usually a cache hit, but can be a fetch of Google's public keys, so it's kept off the event loop
+            firebase_user = await asyncio.get_running_loop().run_in_executor(None, self.firebase_client.get_firebase_user, token)
+            context.user = await self.dao.get_user_by_firebase_id(context, firebase_user["user_id"])
+            if context.user is None:
+                context.user, player = new_user(firebase_user)
+                # Not gathered: the player's owner_user_id is a foreign key to the user, which has to be committed first
+                await self.dao.create_user(context, context.user)
+                await self.dao.create_player(context, player)
+        except (KeyError, ValueError) as e:
+            print(e)
+            context.user = None
+
+    async def get_data_version(self, context: RequestContext) -> int:
+        require_auth(context)
+
+        return await self.dao.get_data_version(context, context.user.user_id)
+
+    async def get_players(self, context: RequestContext):
+        require_auth(context)
+
+        return await self.dao.get_players(context, context.user.user_id)
+
+    async def get_player_changes(self, context: RequestContext, since: str) -> PlayerChanges:
+        require_auth(context)
+
+        return await self.dao.get_player_changes(context, context.user.user_id, Watermark.decode(since).timestamp)
+
+    async def create_player(self, context: RequestContext, player: Player) -> Player:
+        require_auth(context)
+
+        return await self.dao.create_player(context, player)
+
+    async def update_player(self, context: RequestContext, player_id: str, player: Player) -> Player:
+        require_auth(context)
+
+        check_player_exists(await self.dao.get_player(context, player_id))
+
+        return await self.dao.update_player(context, player_id, player)
+
+    async def delete_player(self, context: RequestContext, player_id: str) -> Dict:
+        require_auth(context)
+
+        check_player_deletable(context, await self.dao.get_player(context, player_id))
+
+        await self.dao.delete_player(context, player_id)
+        # Their matches went with them
+        await self.recompute_ratings(context)
+        return {}
+
+    async def get_player_stats(self, context: RequestContext, player_id: str, query: StatsQuery = StatsQuery()) -> PlayerStats:
+        require_auth(context)
+
+        check_player_access(context, await self.dao.get_player(context, player_id), "view stats for")
+
+        return await self.dao.get_player_stats(context, context.user.user_id, player_id, query)
+
+    async def get_head_to_head(self, context: RequestContext, player_id: str) -> List[PairRecord]:
+        return await self.get_pair_records(context, player_id, OPPONENT)
+
+    async def get_partners(self, context: RequestContext, player_id: str) -> List[PairRecord]:
+        return await self.get_pair_records(context, player_id, PARTNER)
+
+    async def get_matches(self, context: RequestContext, query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> List[Match]:
+        require_auth(context)
+
+        return await self.dao.get_matches(context, context.user.user_id, query, match_filter)
+
+    async def get_match_page(self, context: RequestContext, limit: int, cursor: Optional[str], query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> MatchPage:
+        require_auth(context)
+
+        check_page_limit(limit)
+
+        return await self.dao.get_match_page(context, context.user.user_id, limit, MatchCursor.decode(cursor) if cursor is not None else None, query, match_filter)
+
+    async def get_match_changes(self, context: RequestContext, since: str, query: MatchQuery = MatchQuery()) -> MatchChanges:
+        require_auth(context)
+
+        return await self.dao.get_match_changes(context, context.user.user_id, Watermark.decode(since).timestamp, query)
+
+    async def create_match(self, context: RequestContext, match: Match) -> Match:
+        require_auth(context)
+
+        created_match = await self.dao.create_match(context, match)
+        await self.update_ratings(context, created_match)
+        return created_match
+
+    async def create_matches(self, context: RequestContext, matches: List[Match]) -> List[BatchResult]:
+        require_auth(context)
+
+        check_batch_size(matches)
+
+        existing_ids = set(await self.dao.get_existing_match_ids(context, [match.match_id for match in matches]))
+        new_matches = [match for match in matches if match.match_id not in existing_ids]
+        if len(new_matches) > 0:
+            await self.dao.create_matches(context, new_matches)
+            await self.recompute_ratings(context)
+        return batch_results(matches, existing_ids)
+
+    async def delete_match(self, context: RequestContext, match_id: str) -> Dict:
+        require_auth(context)
+
+        check_match_deletable(context, await self.dao.get_match(context, match_id))
+
+        await self.dao.delete_match(context, match_id)
+        await self.recompute_ratings(context)
+        return {}
+
+    async def get_ratings(self, context: RequestContext) -> List[PlayerRating]:
+        require_auth(context)
+
+        return await self.dao.get_ratings(context, context.user.user_id)
+
+    async def get_pair_records(self, context: RequestContext, player_id: str, relation: str) -> List[PairRecord]:
+        require_auth(context)
+
+        check_player_access(context, await self.dao.get_player(context, player_id), "view records for")
+
+        return await self.dao.get_pair_records(context, player_id, relation)
+
+    async def update_ratings(self, context: RequestContext, match: Match):
+        latest = await self.dao.get_latest_match(context, context.user.user_id, excluding_match_id=match.match_id)
+        if is_backdated(match, latest):
+            await self.recompute_ratings(context)
+            return
+
+        await self.dao.apply_match_to_ratings(context, context.user.user_id, match)
+
+    async def recompute_ratings(self, context: RequestContext):
+        matches = await self.dao.get_matches(context, context.user.user_id, RATINGS_QUERY)
+        await self.dao.save_ratings(context, context.user.user_id, ratings.replay(matches), replace_all=True)
@@ -0,0 +1,209 @@
+"""
+Awaitable versions of the Dao's queries, for serving many requests from one event loop.
+
+pymysql only blocks, so every query still runs on a thread, but on a pool with one thread per database connection rather than one per request. A request
+waiting on the database holds no thread of its own, and the queries a request needs that don't depend on each other (a page's players and its stats, say)
+run at the same time on different connections.
+"""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Optional, Any
+
+from da import DaoImpl
+from domain.match import Match, MatchCursor, MatchPage, MatchQuery, MatchFilter
+from domain.pair import PairRecord
+from domain.player import Player
+from domain.rating import PlayerRating
+from domain.stats import StatsQuery, PlayerStats
+from domain.sync import PlayerChanges, MatchChanges
+from domain.user import User
+from request_context import RequestContext
+
+
+class AsyncDao:
+    async def get_user_by_firebase_id(self, context: RequestContext, firebase_id: str) -> Optional[User]: pass
+
+    async def create_user(self, context: RequestContext, user: User): pass
+
+    async def get_data_version(self, context: RequestContext, user_id: str) -> int: pass
+
+    async def get_players(self, context: RequestContext, owner_user_id: str) -> List[Player]: pass
+
+    async def get_player_changes(self, context: RequestContext, owner_user_id: str, since: Optional[datetime]) -> PlayerChanges: pass
+
+    async def get_player(self, context: RequestContext, player_id: str) -> Optional[Player]: pass
+
+    async def create_player(self, context: RequestContext, player: Player) -> Player: pass
+
+    async def update_player(self, context: RequestContext, player_id: str, player: Player) -> Player: pass
+
+    async def delete_player(self, context: RequestContext, player_id: str): pass
+
+    async def get_player_stats(self, context: RequestContext, user_id: str, player_id: str, query: StatsQuery = StatsQuery()) -> PlayerStats: pass
+
+    async def get_matches(self, context: RequestContext, user_id: str, query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> List[Match]: pass
+
+    async def get_match_page(self, context: RequestContext, user_id: str, limit: int, cursor: Optional[MatchCursor], query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> MatchPage: pass
+
+    async def get_match_changes(self, context: RequestContext, user_id: str, since: Optional[datetime], query: MatchQuery = MatchQuery()) -> MatchChanges: pass
+
+    async def get_match(self, context: RequestContext, match_id: str) -> Optional[Match]: pass
+
+    async def create_match(self, context: RequestContext, match: Match) -> Match: pass
+
+    async def create_matches(self, context: RequestContext, matches: List[Match]) -> List[Match]: pass
+
+    async def get_existing_match_ids(self, context: RequestContext, match_ids: List[str]) -> List[str]: pass
+
+    async def delete_match(self, context: RequestContext, match_id: str): pass
+
+    async def get_latest_match(self, context: RequestContext, user_id: str, excluding_match_id: Optional[str] = None) -> Optional[MatchCursor]: pass
+
+    async def get_ratings(self, context: RequestContext, user_id: str, player_ids: Optional[List[str]] = None) -> List[PlayerRating]: pass
+
+    async def save_ratings(self, context: RequestContext, user_id: str, ratings: List[PlayerRating], replace_all: bool = False): pass
+
+    async def apply_match_to_ratings(self, context: RequestContext, user_id: str, match: Match) -> List[PlayerRating]: pass
+
+    async def get_pair_records(self, context: RequestContext, player_id: str, relation: str) -> List[PairRecord]: pass
+
+
+class AsyncDaoImpl(AsyncDao):
+    """
+    Runs DaoImpl's queries on its own thread pool. Calls that are a single query (or a transaction, which has to stay on one thread) are handed over
+    whole. The reads made of several independent queries are split up here so those queries can overlap.
+    """
+
+    def __init__(self, dao: Optional[DaoImpl] = None, executor: Optional[Executor] = None):
+        self.dao = dao if dao is not None else DaoImpl()
+        # Any more threads than connections would only queue up inside the connection pool
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=self.dao.pool.max_size, thread_name_prefix="db")
+
+    async def get_user_by_firebase_id(self, context: RequestContext, firebase_id: str) -> Optional[User]:
+        return await self.run(self.dao.get_user_by_firebase_id, context, firebase_id)
+
+    async def create_user(self, context: RequestContext, user: User):
+        return await self.run(self.dao.create_user, context, user)
+
+    async def get_data_version(self, context: RequestContext, user_id: str) -> int:
+        return await self.run(self.dao.get_data_version, context, user_id)
+
+    async def get_players(self, context: RequestContext, owner_user_id: str) -> List[Player]:
+        return await self.run(self.dao.get_players, context, owner_user_id)
+
+    async def get_player_changes(self, context: RequestContext, owner_user_id: str, since: Optional[datetime]) -> PlayerChanges:
+        # The watermark has to be taken before anything is read
+        watermark = await self.run(self.dao.next_watermark)
+        if since is None:
+            return PlayerChanges(await self.get_players(context, owner_user_id), [], watermark)
+
+        players, deleted_ids = await asyncio.gather(self.run(self.dao.get_changed_players, owner_user_id, since), self.run(self.dao.get_deleted_player_ids, owner_user_id, since))
+        return PlayerChanges(players, deleted_ids, watermark)
+
+    async def get_player(self, context: RequestContext, player_id: str) -> Optional[Player]:
+        return await self.run(self.dao.get_player, context, player_id)
+
+    async def create_player(self, context: RequestContext, player: Player) -> Player:
+        return await self.run(self.dao.create_player, context, player)
+
+    async def update_player(self, context: RequestContext, player_id: str, player: Player) -> Player:
+        return await self.run(self.dao.update_player, context, player_id, player)
+
+    async def delete_player(self, context: RequestContext, player_id: str):
+        return await self.run(self.dao.delete_player, context, player_id)
+
+    async def get_player_stats(self, context: RequestContext, user_id: str, player_id: str, query: StatsQuery = StatsQuery()) -> PlayerStats:
+        return await self.run(self.dao.get_player_stats, context, user_id, player_id, query)
+
+    async def get_matches(self, context: RequestContext, user_id: str, query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> List[Match]:
+        if not (query.includes("stats") and match_filter.is_empty()):
+            match_dtos = await self.run(self.dao.get_match_dtos, query, *self.dao.match_search_sql(user_id, match_filter))
+            players, stats = await self.get_players_and_stats(context, match_dtos, query)
+            return self.dao.to_matches(context, match_dtos, players, stats)
+
+        # Unfiltered, the stats are the whole history's, so they don't have to wait for the matches. The players are the ones the matches reference
+        # (deleted ones included), so they do
+        match_dtos, stats = await asyncio.gather(
+            self.run(self.dao.get_match_dtos, query, *self.dao.match_search_sql(user_id, match_filter)),
+            self.run(self.dao.get_stats, user_id)
+        )
+        players = await self.run(self.dao.get_players_by_ids, context, list({player_id for dto in match_dtos for player_id in dto.player_ids()}))
+        return self.dao.to_matches(context, match_dtos, players, stats)
+
+    async def get_match_page(self, context: RequestContext, user_id: str, limit: int, cursor: Optional[MatchCursor], query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> MatchPage:
+        match_dtos = await self.run(self.dao.get_match_dtos, query, *self.dao.match_search_sql(user_id, match_filter, cursor, limit + 1))
+        next_cursor = None
+        if len(match_dtos) > limit:
+            match_dtos = match_dtos[:limit]
+            next_cursor = MatchCursor(match_dtos[-1].date, match_dtos[-1].match_id).encode()
+
+        players, stats = await self.get_players_and_stats(context, match_dtos, query)
+        return MatchPage(self.dao.to_matches(context, match_dtos, players, stats), next_cursor)
+
+    async def get_match_changes(self, context: RequestContext, user_id: str, since: Optional[datetime], query: MatchQuery = MatchQuery()) -> MatchChanges:
+        watermark = await self.run(self.dao.next_watermark)
+        if since is None:
+            return MatchChanges(await self.get_matches(context, user_id, query), [], watermark)
+
+        match_dtos, deleted_ids = await asyncio.gather(self.run(self.dao.get_changed_match_dtos, query, user_id, since), self.run(self.dao.get_deleted_match_ids, user_id, since))
+        players, stats = await self.get_players_and_stats(context, match_dtos, query)
+        return MatchChanges(self.dao.to_matches(context, match_dtos, players, stats), deleted_ids, watermark)
+
+    async def get_match(self, context: RequestContext, match_id: str) -> Optional[Match]:
+        match = context.identity_map.get("matches", match_id)
+        if match is not None:
+            return match
+
+        match_dto = await self.run(self.dao.get_match_dto, match_id)
+        if match_dto is None:
+            return None
+        players, stats = await self.get_players_and_stats(context, [match_dto], MatchQuery())
+        return self.dao.to_matches(context, [match_dto], players, stats)[0]
+
+    async def create_match(self, context: RequestContext, match: Match) -> Match:
+        return await self.run(self.dao.create_match, context, match)
+
+    async def create_matches(self, context: RequestContext, matches: List[Match]) -> List[Match]:
+        return await self.run(self.dao.create_matches, context, matches)
+
+    async def get_existing_match_ids(self, context: RequestContext, match_ids: List[str]) -> List[str]:
+        return await self.run(self.dao.get_existing_match_ids, context, match_ids)
+
+    async def delete_match(self, context: RequestContext, match_id: str):
+        return await self.run(self.dao.delete_match, context, match_id)
+
+    async def get_latest_match(self, context: RequestContext, user_id: str, excluding_match_id: Optional[str] = None) -> Optional[MatchCursor]:
+        return await self.run(self.dao.get_latest_match, context, user_id, excluding_match_id)
+
+    async def get_ratings(self, context: RequestContext, user_id: str, player_ids: Optional[List[str]] = None) -> List[PlayerRating]:
+        return await self.run(self.dao.get_ratings, context, user_id, player_ids)
+
+    async def save_ratings(self, context: RequestContext, user_id: str, ratings: List[PlayerRating], replace_all: bool = False):
+        return await self.run(self.dao.save_ratings, context, user_id, ratings, replace_all)
+
+    async def apply_match_to_ratings(self, context: RequestContext, user_id: str, match: Match) -> List[PlayerRating]:
+        return await self.run(self.dao.apply_match_to_ratings, context, user_id, match)
+
+    async def get_pair_records(self, context: RequestContext, player_id: str, relation: str) -> List[PairRecord]:
+        return await self.run(self.dao.get_pair_records, context, player_id, relation)
+
+    # Private functions
+
+    async def get_players_and_stats(self, context: RequestContext, match_dtos: List, query: MatchQuery):
+        """The players referenced by the matches and (if asked for) their stats, read at the same time"""
+        player_ids = list({player_id for dto in match_dtos for player_id in dto.player_ids()})
+        return await asyncio.gather(
+            self.run(self.dao.get_players_by_ids, context, player_ids),
+            self.run(self.dao.get_stats_by_match_ids, [dto.match_id for dto in match_dtos]) if query.includes("stats") else constant(None)
+        )
+
+    async def run(self, fun, *args, **kwargs):
+        # Unlike a task, an executor's thread doesn't inherit the caller's context vars, so the query wouldn't be counted against the request
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(contextvars.copy_context().run, fun, *args, **kwargs))
+
+
+async def constant(value: Any) -> Any:
+    return value
@@ -0,0 +1,40 @@
+import metrics
+from async_bl import AsyncManager
+from domain.exceptions import ServiceException
+from handler import Handler, CACHEABLE_RESOURCES, format_response
+from request_context import RequestContext
+
+
+class AsyncHandler(Handler):
+    """Handler's routes over an AsyncManager, so that one event loop can have many requests in flight. The ROUTES are shared, only the manager calls are awaited"""
+
+    manager: AsyncManager
+
+    async def handle(self, event):
+        context = RequestContext()
+        with metrics.recording(context.metrics):
+            response = await self.dispatch(context, event)
+            context.metrics.finish(response)
+            return response
+
+    async def dispatch(self, context, event):
+        try:
+            resource, method, path_params, query_params, body = self.parse_event(event)
+            context.metrics.route = f"{method} {resource}"
+
+            with context.metrics.span(metrics.AUTH):
+                await self.manager.validate_token(context, self.get_token(event))
+
+            etag = None
+            if method == "GET" and resource in CACHEABLE_RESOURCES:
+                # Read before the data, not alongside it, for the same reason as in Handler.dispatch
+                data_version = await self.manager.get_data_version(context)
+                etag = self.get_etag(context.user.user_id, resource, path_params, query_params, data_version)
+                if etag in self.get_if_none_match(event):
+                    return format_response(status_code=304, headers=self.get_etag_headers(etag))
+
+            call = self.route(context, resource, method, path_params, query_params, body)
+            response_body = call.to_body(await getattr(self.manager, call.method)(context, *call.args) if call.method is not None else None)
+            return format_response(response_body, headers=self.get_etag_headers(etag) if etag is not None else None)
+        except ServiceException as e:
+            return format_response({"error": e.error_message}, e.status_code)
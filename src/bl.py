@@ -1,130 +1,279 @@
 import uuid
 from datetime import datetime
-from typing import List, Optional, Dict
-
-from firebase_admin.auth import ExpiredIdTokenError, InvalidIdTokenError
+from typing import List, Optional, Dict, Set, Tuple
 
+import ratings
 from da import Dao
 from domain.exceptions import ServiceException
-from domain.match import Match, GameScore
+from domain.match import Match, GameScore, MatchCursor, MatchPage, MatchQuery, MatchFilter, BatchResult, CREATED, ALREADY_EXISTS
+from domain.pair import PairRecord, OPPONENT, PARTNER
 from domain.player import Player
+from domain.rating import PlayerRating
+from domain.stats import StatsQuery, PlayerStats
+from domain.sync import Watermark, PlayerChanges, MatchChanges
 from domain.user import User
 from firebase_client import FirebaseClient
+from request_context import RequestContext
+
+
+MAX_PAGE_SIZE = 200
+MAX_BATCH_SIZE = 500
 
 
 class Manager:
     firebase_client = None
-    user = None
     dao = None
 
-    def validate_token(self, token: str) -> None: pass
+    def validate_token(self, context: RequestContext, token: str) -> None: pass
+
+    def get_data_version(self, context: RequestContext) -> int: pass
+
+    def get_players(self, context: RequestContext) -> List[Player]: pass
+
+    def get_player_changes(self, context: RequestContext, since: str) -> PlayerChanges: pass
+
+    def create_player(self, context: RequestContext, player: Player) -> Player: pass
+
+    def update_player(self, context: RequestContext, player_id: str, player: Player) -> Player: pass
 
-    def get_players(self) -> List[Player]: pass
+    def delete_player(self, context: RequestContext, player_id: str) -> Dict: pass
 
-    def create_player(self, player: Player) -> Player: pass
+    def get_player_stats(self, context: RequestContext, player_id: str, query: StatsQuery = StatsQuery()) -> PlayerStats: pass
 
-    def update_player(self, player_id: str, player: Player) -> Player: pass
+    def get_head_to_head(self, context: RequestContext, player_id: str) -> List[PairRecord]: pass
 
-    def delete_player(self, player_id: str) -> Dict: pass
+    def get_partners(self, context: RequestContext, player_id: str) -> List[PairRecord]: pass
 
-    def get_matches(self) -> List[Match]: pass
+    def get_matches(self, context: RequestContext, query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> List[Match]: pass
 
-    def create_match(self, match: Match) -> Match: pass
+    def get_match_page(self, context: RequestContext, limit: int, cursor: Optional[str], query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> MatchPage: pass
 
-    def delete_match(self, match_id: str) -> Dict: pass
+    def get_match_changes(self, context: RequestContext, since: str, query: MatchQuery = MatchQuery()) -> MatchChanges: pass
+
+    def create_match(self, context: RequestContext, match: Match) -> Match: pass
+
+    def create_matches(self, context: RequestContext, matches: List[Match]) -> List[BatchResult]: pass
+
+    def delete_match(self, context: RequestContext, match_id: str) -> Dict: pass
+
+    def get_ratings(self, context: RequestContext) -> List[PlayerRating]: pass
 
 
 class ManagerImpl(Manager):
     def __init__(self, firebase_client: FirebaseClient, dao: Dao):
         self.firebase_client = firebase_client
         self.dao = dao
-        self.user = None
 
-    def validate_token(self, token: Optional[str]):
+    def validate_token(self, context: RequestContext, token: Optional[str]):
         if token is None:
             return
 
         try:
             firebase_user = self.firebase_client.get_firebase_user(token)
-            self.user = self.dao.get_user_by_firebase_id(firebase_user["user_id"])
-            if self.user is None:
-                try:
-                    first_name, last_names = firebase_user["name"].split(" ", 1)
-                except ValueError:
-                    first_name, last_names = "", ""
-
-                self.user = User(user_id=str(uuid.uuid4()), firebase_id=firebase_user["user_id"], first_name=first_name, last_name=last_names, image_url=firebase_user.get("picture"))
-                self.dao.create_user(self.user)
-                self.dao.create_player(
-                    Player(
-                        player_id=str(uuid.uuid4()),
-                        owner_user_id=self.user.user_id,
-                        is_owner=True,
-                        image_url=self.user.image_url,
-                        first_name=self.user.first_name,
-                        last_name=self.user.last_name,
-                        email=firebase_user.get("email")
-                    )
-                )
-        except (KeyError, ValueError, InvalidIdTokenError, ExpiredIdTokenError) as e:
+            context.user = self.dao.get_user_by_firebase_id(context, firebase_user["user_id"])
+            if context.user is None:
+                context.user, player = new_user(firebase_user)
+                self.dao.create_user(context, context.user)
+                self.dao.create_player(context, player)
+        except (KeyError, ValueError) as e:
             print(e)
-            self.user = None
+            context.user = None
+
+    def get_data_version(self, context: RequestContext) -> int:
+        require_auth(context)
+
+        return self.dao.get_data_version(context, context.user.user_id)
+
+    def get_players(self, context: RequestContext):
+        require_auth(context)
+
+        return self.dao.get_players(context, context.user.user_id)
 
-    def get_players(self):
-        self.require_auth()
+    def get_player_changes(self, context: RequestContext, since: str) -> PlayerChanges:
+        require_auth(context)
 
-        return self.dao.get_players(self.user.user_id)
+        return self.dao.get_player_changes(context, context.user.user_id, Watermark.decode(since).timestamp)
 
-    def create_player(self, player: Player) -> Player:
-        self.require_auth()
+    def create_player(self, context: RequestContext, player: Player) -> Player:
+        require_auth(context)
 
-        return self.dao.create_player(player)
+        return self.dao.create_player(context, player)
 
-    def update_player(self, player_id: str, player: Player) -> Player:
-        self.require_auth()
+    def update_player(self, context: RequestContext, player_id: str, player: Player) -> Player:
+        require_auth(context)
 
-        current_player = self.dao.get_player(player_id)
-        if current_player is None:
-            raise ServiceException("Player not found", 404)
+        check_player_exists(self.dao.get_player(context, player_id))
 
-        return self.dao.update_player(player_id, player)
+        return self.dao.update_player(context, player_id, player)
 
-    def delete_player(self, player_id: str) -> Dict:
-        self.require_auth()
+    def delete_player(self, context: RequestContext, player_id: str) -> Dict:
+        require_auth(context)
 
-        player = self.dao.get_player(player_id)
-        if player is None:
-            raise ServiceException("Player not found.", 404)
-        elif player.owner_user_id != self.user.user_id:
-            raise ServiceException("You cannot delete a player you don't own.", 403)
-        elif player.is_owner:
-            raise ServiceException("You cannot delete yourself.", 403)
+        check_player_deletable(context, self.dao.get_player(context, player_id))
 
-        self.dao.delete_player(player_id)
+        self.dao.delete_player(context, player_id)
+        # Their matches went with them
+        self.recompute_ratings(context)
         return {}
 
-    def get_matches(self) -> List[Match]:
-        self.require_auth()
+    def get_player_stats(self, context: RequestContext, player_id: str, query: StatsQuery = StatsQuery()) -> PlayerStats:
+        require_auth(context)
 
-        return self.dao.get_matches(self.user.user_id)
+        check_player_access(context, self.dao.get_player(context, player_id), "view stats for")
 
-    def create_match(self, match: Match) -> Match:
-        self.require_auth()
+        return self.dao.get_player_stats(context, context.user.user_id, player_id, query)
 
-        return self.dao.create_match(match)
+    def get_head_to_head(self, context: RequestContext, player_id: str) -> List[PairRecord]:
+        return self.get_pair_records(context, player_id, OPPONENT)
 
-    def delete_match(self, match_id: str) -> Dict:
-        self.require_auth()
+    def get_partners(self, context: RequestContext, player_id: str) -> List[PairRecord]:
+        return self.get_pair_records(context, player_id, PARTNER)
 
-        match = self.dao.get_match(match_id)
-        if match is None:
-            raise ServiceException("Match not found.", 404)
-        elif match.user_id != self.user.user_id:
-            raise ServiceException("You cannot delete another player's matches.", 403)
+    def get_matches(self, context: RequestContext, query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> List[Match]:
+        require_auth(context)
 
-        self.dao.delete_match(match_id)
+        return self.dao.get_matches(context, context.user.user_id, query, match_filter)
+
+    def get_match_page(self, context: RequestContext, limit: int, cursor: Optional[str], query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> MatchPage:
+        require_auth(context)
+
+        check_page_limit(limit)
+
+        return self.dao.get_match_page(context, context.user.user_id, limit, MatchCursor.decode(cursor) if cursor is not None else None, query, match_filter)
+
+    def get_match_changes(self, context: RequestContext, since: str, query: MatchQuery = MatchQuery()) -> MatchChanges:
+        require_auth(context)
+
+        return self.dao.get_match_changes(context, context.user.user_id, Watermark.decode(since).timestamp, query)
+
+    def create_match(self, context: RequestContext, match: Match) -> Match:
+        require_auth(context)
+
+        created_match = self.dao.create_match(context, match)
+        self.update_ratings(context, created_match)
+        return created_match
+
+    def create_matches(self, context: RequestContext, matches: List[Match]) -> List[BatchResult]:
+        require_auth(context)
+
+        check_batch_size(matches)
+
+        # Uploading the same batch again (after a timeout, say) skips what already made it instead of failing
+        existing_ids = set(self.dao.get_existing_match_ids(context, [match.match_id for match in matches]))
+        new_matches = [match for match in matches if match.match_id not in existing_ids]
+        if len(new_matches) > 0:
+            self.dao.create_matches(context, new_matches)
+            # Imports are usually backdated, so one replay for the whole batch rather than an update (or a replay) per match
+            self.recompute_ratings(context)
+        return batch_results(matches, existing_ids)
+
+    def delete_match(self, context: RequestContext, match_id: str) -> Dict:
+        require_auth(context)
+
+        check_match_deletable(context, self.dao.get_match(context, match_id))
+
+        self.dao.delete_match(context, match_id)
+        self.recompute_ratings(context)
         return {}
 
-    def require_auth(self):
-        if self.user is None:
-            raise ServiceException("Unable to authenticate", 401)
+    def get_ratings(self, context: RequestContext) -> List[PlayerRating]:
+        require_auth(context)
+
+        return self.dao.get_ratings(context, context.user.user_id)
+
+    def get_pair_records(self, context: RequestContext, player_id: str, relation: str) -> List[PairRecord]:
+        require_auth(context)
+
+        check_player_access(context, self.dao.get_player(context, player_id), "view records for")
+
+        return self.dao.get_pair_records(context, player_id, relation)
+
+    def update_ratings(self, context: RequestContext, match: Match):
+        latest = self.dao.get_latest_match(context, context.user.user_id, excluding_match_id=match.match_id)
+        if is_backdated(match, latest):
+            # Every rating from this match on has to be replayed
+            self.recompute_ratings(context)
+            return
+
+        # The usual case: the match is the newest, so only its players move
+        self.dao.apply_match_to_ratings(context, context.user.user_id, match)
+
+    def recompute_ratings(self, context: RequestContext):
+        matches = self.dao.get_matches(context, context.user.user_id, RATINGS_QUERY)
+        self.dao.save_ratings(context, context.user.user_id, ratings.replay(matches), replace_all=True)
+
+
+# The rules, shared by ManagerImpl and AsyncManagerImpl. Anything that decides what a request is allowed to do (or what it writes) belongs down here,
+# so the two managers only differ in how they call their daos
+
+# Ratings only depend on who played and the scores, so stats aren't loaded to replay them
+RATINGS_QUERY = MatchQuery(frozenset(["match_id", "date", "team1", "team2", "scores"]))
+
+
+def require_auth(context: RequestContext):
+    if context.user is None:
+        raise ServiceException("Unable to authenticate", 401)
+
+
+def new_user(firebase_user: Dict) -> Tuple[User, Player]:
+    """A first login's user, and the player that stands for them in their own matches"""
+    try:
+        first_name, last_names = firebase_user["name"].split(" ", 1)
+    except ValueError:
+        first_name, last_names = "", ""
+
+    user = User(user_id=str(uuid.uuid4()), firebase_id=firebase_user["user_id"], first_name=first_name, last_name=last_names, image_url=firebase_user.get("picture"))
+    player = Player(
+        player_id=str(uuid.uuid4()),
+        owner_user_id=user.user_id,
+        is_owner=True,
+        image_url=user.image_url,
+        first_name=user.first_name,
+        last_name=user.last_name,
+        email=firebase_user.get("email")
+    )
+    return user, player
+
+
+def check_player_exists(player: Optional[Player]):
+    if player is None:
+        raise ServiceException("Player not found", 404)
+
+
+def check_player_access(context: RequestContext, player: Optional[Player], action: str):
+    if player is None:
+        raise ServiceException("Player not found.", 404)
+    elif player.owner_user_id != context.user.user_id:
+        raise ServiceException(f"You cannot {action} a player you don't own.", 403)
+
+
+def check_player_deletable(context: RequestContext, player: Optional[Player]):
+    check_player_access(context, player, "delete")
+    if player.is_owner:
+        raise ServiceException("You cannot delete yourself.", 403)
+
+
+def check_page_limit(limit: int):
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ServiceException(f"Limit must be between 1 and {MAX_PAGE_SIZE}", 400)
+
+
+def check_batch_size(matches: List[Match]):
+    if len(matches) > MAX_BATCH_SIZE:
+        raise ServiceException(f"A batch can have at most {MAX_BATCH_SIZE} matches", 400)
+
+
+def batch_results(matches: List[Match], existing_ids: Set[str]) -> List[BatchResult]:
+    return [BatchResult(match.match_id, ALREADY_EXISTS if match.match_id in existing_ids else CREATED) for match in matches]
+
+
+def check_match_deletable(context: RequestContext, match: Optional[Match]):
+    if match is None:
+        raise ServiceException("Match not found.", 404)
+    elif match.user_id != context.user.user_id:
+        raise ServiceException("You cannot delete another player's matches.", 403)
+
+
+def is_backdated(match: Match, latest: Optional[MatchCursor]) -> bool:
+    """Whether the user already has a later match than this one, in which case its players' current ratings aren't the ones it changes"""
+    return latest is not None and (latest.date, latest.match_id) > (match.date, match.match_id)
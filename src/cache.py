@@ -0,0 +1,47 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """A bounded, thread-safe LRU cache where every entry carries its own expiry (in the same units as the clock)"""
+
+    def __init__(self, max_size: int = 1024, clock: Callable[[], float] = time.time):
+        self.max_size = max_size
+        self.clock = clock
+        self.entries: OrderedDict = OrderedDict()  # key -> (value, expires_at), least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if self.clock() >= expires_at:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any, expires_at: float):
+        with self.lock:
+            if self.clock() >= expires_at:
+                self.entries.pop(key, None)
+                return
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Tuple, Any
+
+from domain.exceptions import ServiceException
+
+# Client errors meaning the connection itself is gone (server gone away, lost connection, connection closed), as opposed to a bad query
+CONNECTION_LOST_ERRORS = {2006, 2013, 2055}
+
+
+def connect_from_env():
+    # Imported here so that a cold start only pays for pymysql once something actually needs the db
+    import pymysql
+    from pymysql.constants import FIELD_TYPE
+
+    conv = pymysql.converters.conversions.copy()
+    conv[FIELD_TYPE.DECIMAL] = float
+    conv[FIELD_TYPE.NEWDECIMAL] = float
+    conv[FIELD_TYPE.TINY] = lambda data: data == "1"
+    return pymysql.connect(
+        host=os.environ["DB_HOST"],
+        user=(os.environ["DB_USERNAME"]),
+        passwd=(os.environ["DB_PASSWORD"]),
+        db=(os.environ["DB_DATABASE_NAME"]),
+        conv=conv,
+        autocommit=True
+    )
+
+
+def is_connection_lost(e: Exception) -> bool:
+    import pymysql
+    return isinstance(e, pymysql.err.OperationalError) and len(e.args) > 0 and e.args[0] in CONNECTION_LOST_ERRORS
+
+
+class ConnectionPool:
+    """
+    Hands out MySQL connections, opening them lazily and checking that idle ones are still alive before reusing them.
+    Lambda only ever needs one connection (the default), but a long-lived server can share a small pool across threads.
+    """
+
+    def __init__(self, connect: Callable[[], Any] = connect_from_env, max_size: int = 1, ping_interval: float = 30, connect_attempts: int = 3,
+                 backoff: float = 0.1, max_backoff: float = 1.0, acquire_timeout: float = 10, clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.connect = connect
+        self.max_size = max_size
+        self.ping_interval = ping_interval
+        self.connect_attempts = connect_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.acquire_timeout = acquire_timeout
+        self.clock = clock
+        self.sleep = sleep
+
+        self.idle: List[Tuple[Any, float]] = []  # (connection, last used), most recently used last
+        self.size = 0  # Idle connections plus the ones currently checked out
+        self.available = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception as e:
+            self.release(conn, discard=is_connection_lost(e))
+            raise
+        else:
+            self.release(conn)
+
+    def acquire(self):
+        deadline = self.clock() + self.acquire_timeout
+        with self.available:
+            while len(self.idle) == 0 and self.size >= self.max_size:
+                remaining = deadline - self.clock()
+                if remaining <= 0 or not self.available.wait(remaining):
+                    raise ServiceException("Timed out waiting for a database connection")
+            if len(self.idle) > 0:
+                conn, last_used = self.idle.pop()
+            else:
+                conn, last_used = None, None
+                self.size += 1
+
+        # Connecting and pinging happen outside the lock so that one slow connection doesn't hold up the others
+        try:
+            if conn is None:
+                return self.open()
+            return self.revalidate(conn, last_used)
+        except Exception:
+            with self.available:
+                self.size -= 1
+                self.available.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        with self.available:
+            # pymysql flags a connection as closed once its socket errors, even if the caller didn't surface that error
+            if discard or not getattr(conn, "open", True):
+                self.size -= 1
+                close_quietly(conn)
+            else:
+                self.idle.append((conn, self.clock()))
+            self.available.notify()
+
+    def close(self):
+        with self.available:
+            for conn, _ in self.idle:
+                close_quietly(conn)
+            self.size -= len(self.idle)
+            self.idle = []
+
+    def open(self):
+        for attempt in range(self.connect_attempts):
+            try:
+                return self.connect()
+            except Exception as e:
+                print("ERROR: Could not connect to MySQL", e)
+                if attempt < self.connect_attempts - 1:
+                    self.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+        raise ServiceException("Failed to connect to database")
+
+    def revalidate(self, conn, last_used: float):
+        # Only pay for a ping when the connection has sat idle long enough for MySQL (or a NAT) to have dropped it
+        if self.clock() - last_used < self.ping_interval:
+            return conn
+        try:
+            conn.ping(reconnect=False)
+            return conn
+        except Exception as e:
+            print("Discarding stale database connection", e)
+            close_quietly(conn)
+            return self.open()
+
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
@@ -1,199 +1,763 @@
 import itertools
+import threading
+import time
 import uuid
-from dataclasses import dataclass
-from datetime import datetime
-from typing import List, Optional, Dict
-
-from pymysql.constants import FIELD_TYPE
-
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta, date
+from typing import List, Optional, Dict, Tuple
+
+from cache import TTLCache
+from connection_pool import ConnectionPool, is_connection_lost
 from domain.exceptions import ServiceException
-from domain.match import Match, GameScore, Stat
+from domain.match import Match, GameScore, Stat, MatchCursor, MatchPage, MatchQuery, MatchOutcome, MatchFilter, SINGLES
+from domain.pair import PairRecord, OPPONENT, PARTNER
 from domain.player import Player
+from domain.rating import PlayerRating
+from domain.stats import StatsQuery, ShotCount, PlayerStats
+from domain.sync import Watermark, PlayerChanges, MatchChanges
 from domain.user import User
-import pymysql
+from request_context import RequestContext
+import metrics
 import os
+import ratings
 
 
 class Dao:
-    def get_user(self, user_id: str) -> User: pass
+    def get_user(self, context: RequestContext, user_id: str) -> User: pass
 
-    def get_user_by_firebase_id(self, firebase_id: str) -> Optional[User]: pass
+    def get_user_by_firebase_id(self, context: RequestContext, firebase_id: str) -> Optional[User]: pass
 
-    def create_user(self, user: User): pass
+    def create_user(self, context: RequestContext, user: User): pass
 
-    def get_players(self, owner_user_id: str) -> List[Player]: pass
+    def invalidate_user(self, context: RequestContext, firebase_id: str): pass
 
-    def get_player(self, player_id: str) -> Optional[Player]: pass
+    def get_data_version(self, context: RequestContext, user_id: str) -> int: pass
 
-    def create_player(self, player: Player) -> Player: pass
+    def get_players(self, context: RequestContext, owner_user_id: str) -> List[Player]: pass
 
-    def update_player(self, player_id: str, player: Player) -> Player: pass
+    def get_player_changes(self, context: RequestContext, owner_user_id: str, since: Optional[datetime]) -> PlayerChanges: pass
 
-    def delete_player(self, player_id: str): pass
+    def get_player(self, context: RequestContext, player_id: str) -> Optional[Player]: pass
 
-    def get_matches(self, user_id: str) -> List[Match]: pass
+    def create_player(self, context: RequestContext, player: Player) -> Player: pass
 
-    def get_match(self, match_id: str) -> Optional[Match]: pass
+    def update_player(self, context: RequestContext, player_id: str, player: Player) -> Player: pass
 
-    def create_match(self, match: Match) -> Match: pass
+    def delete_player(self, context: RequestContext, player_id: str): pass
 
-    def delete_match(self, match_id: str): pass
+    def get_player_stats(self, context: RequestContext, user_id: str, player_id: str, query: StatsQuery = StatsQuery()) -> PlayerStats: pass
 
+    def get_matches(self, context: RequestContext, user_id: str, query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> List[Match]: pass
 
-class DaoImpl(Dao):
-    def __init__(self):
-        try:
-            conv = pymysql.converters.conversions.copy()
-            conv[FIELD_TYPE.DECIMAL] = float
-            conv[FIELD_TYPE.NEWDECIMAL] = float
-            conv[FIELD_TYPE.TINY] = lambda data: data == "1"
-            self.conn = pymysql.connect(
-                host=os.environ["DB_HOST"],
-                user=(os.environ["DB_USERNAME"]),
-                passwd=(os.environ["DB_PASSWORD"]),
-                db=(os.environ["DB_DATABASE_NAME"]),
-                conv=conv,
-                autocommit=True
-            )
-        except Exception as e:
-            print("ERROR: Could not connect to MySQL", e)
-            raise ServiceException("Failed to connect to database")
+    def get_match_page(self, context: RequestContext, user_id: str, limit: int, cursor: Optional[MatchCursor], query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> MatchPage: pass
 
-    ### DB ACCESS FUNCTIONS ###
+    def get_match_changes(self, context: RequestContext, user_id: str, since: Optional[datetime], query: MatchQuery = MatchQuery()) -> MatchChanges: pass
+
+    def get_match(self, context: RequestContext, match_id: str) -> Optional[Match]: pass
+
+    def create_match(self, context: RequestContext, match: Match) -> Match: pass
+
+    def create_matches(self, context: RequestContext, matches: List[Match]) -> List[Match]: pass
+
+    def get_existing_match_ids(self, context: RequestContext, match_ids: List[str]) -> List[str]: pass
+
+    def delete_match(self, context: RequestContext, match_id: str): pass
+
+    def get_latest_match(self, context: RequestContext, user_id: str, excluding_match_id: Optional[str] = None) -> Optional[MatchCursor]: pass
 
-    def get_user(self, user_id: str) -> User:
-        return self.get_one(User, "select id, firebase_id, first_name, last_name, image_url from users where id = %s", user_id)
+    def get_ratings(self, context: RequestContext, user_id: str, player_ids: Optional[List[str]] = None) -> List[PlayerRating]: pass
 
-    def get_user_by_firebase_id(self, firebase_id: str) -> Optional[User]:
-        return self.get_one(User, "select id, firebase_id, first_name, last_name, image_url from users where firebase_id = %s", firebase_id)
+    def save_ratings(self, context: RequestContext, user_id: str, ratings: List[PlayerRating], replace_all: bool = False): pass
 
-    def create_user(self, user: User):
-        self.execute("insert into users (id, firebase_id, first_name, last_name, image_url) values (%s, %s, %s, %s, %s)", user.user_id, user.firebase_id, user.first_name, user.last_name, user.image_url)
+    def apply_match_to_ratings(self, context: RequestContext, user_id: str, match: Match) -> List[PlayerRating]: pass
 
-    def get_players(self, owner_user_id: str) -> List[Player]:
-        return self.get_list(Player, "select id, owner_user_id, is_owner, image_url, first_name, last_name, dominant_hand, notes, phone_number, email_address, level from players where owner_user_id = %s", owner_user_id)
+    def get_pair_records(self, context: RequestContext, player_id: str, relation: str) -> List[PairRecord]: pass
 
-    def get_player(self, player_id: str) -> Optional[Player]:
-        return self.get_one(Player, "select id, owner_user_id, is_owner, image_url, first_name, last_name, dominant_hand, notes, phone_number, email_address, level from players where id = %s", player_id)
+    def rebuild_stat_rollups(self, user_id: Optional[str] = None): pass
 
-    def create_player(self, player: Player) -> Player:
-        self.execute("insert into players (id, owner_user_id, is_owner, image_url, first_name, last_name, dominant_hand, notes, phone_number, email_address, level) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                     player.player_id, player.owner_user_id, player.is_owner, player.image_url, player.first_name, player.last_name, player.dominant_hand, player.notes, player.phone_number, player.email, player.level)
-        return self.get_player(player.player_id)
+    def verify_stat_rollups(self, user_id: Optional[str] = None) -> List[tuple]: pass
 
-    def update_player(self, player_id: str, player: Player) -> Player:
-        self.execute("update players set image_url = %s, first_name = %s, last_name = %s, dominant_hand = %s, notes = %s, phone_number = %s, email_address = %s, level = %s where id = %s",
-                     player.image_url, player.first_name, player.last_name, player.dominant_hand, player.notes, player.phone_number, player.email, player.level, player_id)
-        return self.get_player(player_id)
+    def rebuild_pair_records(self, user_id: Optional[str] = None): pass
 
-    def delete_player(self, player_id: str):
-        self.execute("delete from players where id = %s", player_id)
+    def get_match_user_ids(self) -> List[str]: pass
 
-    def get_matches(self, user_id: str) -> List[Match]:
-        match_dtos = self.get_list(MatchDbDto, "select id, user_id, date, team1_player1_id, team1_player2_id, team2_player1_id, team2_player2_id, scores from matches where user_id = %s order by date desc", user_id)
-        return self.to_matches(match_dtos)
 
-    def get_match(self, match_id: str) -> Optional[Match]:
-        match_dto = self.get_one(MatchDbDto, "select id, user_id, date, team1_player1_id, team1_player2_id, team2_player1_id, team2_player2_id, scores from matches where id = %s", match_id)
-        return self.to_matches([match_dto])[0] if match_dto is not None else None
+# How long a firebase id -> user lookup is reused across warm invocations
+USER_CACHE_SECONDS = 5 * 60
 
-    def create_match(self, match: Match) -> Match:
-        self.conn.autocommit(False)
+# How far a sync watermark is set back from the time it's handed out, so that rows written by transactions still in flight at that moment are picked up by the next sync
+SYNC_OVERLAP_SECONDS = 5
+
+# Just who played in a match and its outcome columns. "outcome" isn't a field clients can ask for, so only the dao's own queries load it
+OUTCOME_QUERY = MatchQuery(frozenset(["match_id", "date", "team1", "team2", "outcome"]))
+
+# The live stats of the matches matching {condition}, counted the same way stat_rollups counts them (shot_side of '' standing in for none, since it's part of the key)
+STAT_ROLLUP_SOURCE_SQL = """
+    select s.user_id as user_id, s.player_id as player_id, date_format(m.date, '%%Y-%%m-01') as month, s.shot_type as shot_type, coalesce(s.shot_side, '') as shot_side, s.shot_result as shot_result, count(*) as count
+    from stats s join matches m on m.id = s.match_id
+    where m.deleted_at is null and {condition}
+    group by 1, 2, 3, 4, 5, 6
+"""
+
+
+class DaoImpl(Dao):
+    def __init__(self, pool: Optional[ConnectionPool] = None):
+        # No connection is opened until the first query, so routes that never touch the db don't pay for one
+        self.pool = pool if pool is not None else ConnectionPool(max_size=int(os.environ.get("DB_POOL_SIZE", "1")))
+        self.local = threading.local()
+        # Unlike the request's identity map, this is shared by every request (and thread). Every authenticated request looks its user up, and users rows are only ever inserted
+        self.user_cache = TTLCache(max_size=1024)
+
+    ### DB ACCESS FUNCTIONS ###
+
+    def get_user(self, context: RequestContext, user_id: str) -> User:
+        user = context.identity_map.get("users", user_id)
+        if user is None:
+            user = self.remember_user(context, self.get_one(User, "select id, firebase_id, first_name, last_name, image_url from users where id = %s", user_id))
+        return user
+
+    def get_user_by_firebase_id(self, context: RequestContext, firebase_id: str) -> Optional[User]:
+        user = context.identity_map.get("users_by_firebase_id", firebase_id) or self.user_cache.get(firebase_id)
+        if user is None:
+            user = self.get_one(User, "select id, firebase_id, first_name, last_name, image_url from users where firebase_id = %s", firebase_id)
+            if user is not None:
+                self.user_cache.put(firebase_id, user, time.time() + USER_CACHE_SECONDS)
+        return self.remember_user(context, user)
+
+    def create_user(self, context: RequestContext, user: User):
         try:
-            self.execute("insert into matches (id, user_id, date, team1_player1_id, team1_player2_id, team2_player1_id, team2_player2_id, scores) values (%s, %s, %s, %s, %s, %s, %s, %s)",
-                         match.match_id, match.user_id, match.date, match.team1_player1.player_id, match.team1_player2.player_id if match.team1_player2 is not None else None, match.team2_player1.player_id, match.team2_player2.player_id if match.team2_player2 is not None else None, match.scores_db_str())
-            if len(match.stats) > 0:
-                stats_params = [[match.user_id, match.match_id, stat.player_id, stat.game_index, stat.shot_result, stat.shot_type, stat.shot_side] for stat in match.stats]
+            self.execute("insert into users (id, firebase_id, first_name, last_name, image_url) values (%s, %s, %s, %s, %s)", user.user_id, user.firebase_id, user.first_name, user.last_name, user.image_url)
+        except ServiceException:
+            # Whatever we had cached for this firebase user clearly doesn't match the db any more
+            self.invalidate_user(context, user.firebase_id)
+            raise
+        self.user_cache.put(user.firebase_id, user, time.time() + USER_CACHE_SECONDS)
+        self.remember_user(context, user)
+
+    def invalidate_user(self, context: RequestContext, firebase_id: str):
+        self.user_cache.invalidate(firebase_id)
+        context.identity_map.evict("users_by_firebase_id", firebase_id)
+
+    def get_data_version(self, context: RequestContext, user_id: str) -> int:
+        # Bumped alongside every change to the user's players or matches, so it stands in for the whole data set when checking whether a client is up to date
+        data_version = self.get_one(int, "select data_version from users where id = %s", user_id)
+        return data_version if data_version is not None else 0
+
+    def get_players(self, context: RequestContext, owner_user_id: str) -> List[Player]:
+        players = self.get_list(Player, "select id, owner_user_id, is_owner, image_url, first_name, last_name, dominant_hand, notes, phone_number, email_address, level from players where owner_user_id = %s and deleted_at is null", owner_user_id)
+        for player in players:
+            context.identity_map.put("players", player.player_id, player)
+        return players
+
+    def get_player_changes(self, context: RequestContext, owner_user_id: str, since: Optional[datetime]) -> PlayerChanges:
+        # Taken before the changes are read, so anything written while they're being read is sent again next time rather than missed
+        watermark = self.next_watermark()
+        if since is None:
+            return PlayerChanges(self.get_players(context, owner_user_id), [], watermark)
+
+        return PlayerChanges(self.get_changed_players(owner_user_id, since), self.get_deleted_player_ids(owner_user_id, since), watermark)
+
+    def get_player(self, context: RequestContext, player_id: str) -> Optional[Player]:
+        player = context.identity_map.get("players", player_id)
+        if player is None:
+            player = self.get_one(Player, "select id, owner_user_id, is_owner, image_url, first_name, last_name, dominant_hand, notes, phone_number, email_address, level from players where id = %s and deleted_at is null", player_id)
+            if player is not None:
+                context.identity_map.put("players", player_id, player)
+        return player
+
+    def create_player(self, context: RequestContext, player: Player) -> Player:
+        with self.transaction():
+            self.execute("insert into players (id, owner_user_id, is_owner, image_url, first_name, last_name, dominant_hand, notes, phone_number, email_address, level) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                         player.player_id, player.owner_user_id, player.is_owner, player.image_url, player.first_name, player.last_name, player.dominant_hand, player.notes, player.phone_number, player.email, player.level)
+            self.bump_data_version(player.owner_user_id)
+        # Build the result from what we just inserted rather than reading it back
+        player = replace(player, level=db_level(player.level))
+        context.identity_map.put("players", player.player_id, player)
+        return player
+
+    def update_player(self, context: RequestContext, player_id: str, player: Player) -> Player:
+        # The id and ownership columns can't be changed, so those come from the current row (usually already loaded by the caller's existence check)
+        current_player = self.get_player(context, player_id)
+        with self.transaction():
+            self.execute("update players set image_url = %s, first_name = %s, last_name = %s, dominant_hand = %s, notes = %s, phone_number = %s, email_address = %s, level = %s where id = %s",
+                         player.image_url, player.first_name, player.last_name, player.dominant_hand, player.notes, player.phone_number, player.email, player.level, player_id)
+            self.execute("update users set data_version = data_version + 1 where id = (select owner_user_id from players where id = %s)", player_id)
+        if current_player is None:
+            return None
+
+        updated_player = replace(current_player, image_url=player.image_url, first_name=player.first_name, last_name=player.last_name, dominant_hand=player.dominant_hand, notes=player.notes,
+                                 phone_number=player.phone_number, email=player.email, level=db_level(player.level))
+        context.identity_map.put("players", player_id, updated_player)
+        return updated_player
+
+    def delete_player(self, context: RequestContext, player_id: str):
+        # Rows are tombstoned rather than deleted, so that syncing clients can be told to drop them
+        with self.transaction():
+            self.execute("update users set data_version = data_version + 1 where id = (select owner_user_id from players where id = %s)", player_id)
+            # The foreign keys used to cascade the delete to every match the player was in, so those go too
+            self.remove_from_stat_rollups("m.user_id = (select owner_user_id from players where id = %s) and %s in (m.team1_player1_id, m.team1_player2_id, m.team2_player1_id, m.team2_player2_id)", player_id, player_id)
+            self.update_pair_records(self.get_match_dtos(OUTCOME_QUERY, "where user_id = (select owner_user_id from players where id = %s) and deleted_at is null and %s in (team1_player1_id, team1_player2_id, team2_player1_id, team2_player2_id)",
+                                                         player_id, player_id), -1)
+            self.execute("update matches set deleted_at = now(6) where user_id = (select owner_user_id from players where id = %s) and deleted_at is null and %s in (team1_player1_id, team1_player2_id, team2_player1_id, team2_player2_id)",
+                         player_id, player_id)
+            self.execute("update players set deleted_at = now(6) where id = %s and deleted_at is null", player_id)
+        context.identity_map.evict("players", player_id)
+        context.identity_map.evict_all("matches")
+
+    def get_player_stats(self, context: RequestContext, user_id: str, player_id: str, query: StatsQuery = StatsQuery()) -> PlayerStats:
+        if query.match_ids is not None and len(query.match_ids) == 0:
+            return PlayerStats(player_id, 0, [])
+
+        if query.match_ids is None and is_month_start(query.start) and is_month_start(query.end):
+            # Whole months line up with the rollup's buckets, so there's no need to touch the (much larger) stats table
+            sql = "select shot_type, nullif(shot_side, ''), shot_result, cast(sum(count) as signed) from stat_rollups where user_id = %s and player_id = %s"
+            args = [user_id, player_id]
+            if query.start is not None:
+                sql += " and month >= %s"
+                args.append(query.start.date())
+            if query.end is not None:
+                sql += " and month < %s"
+                args.append(query.end.date())
+            sql += " group by shot_type, shot_side, shot_result having sum(count) > 0 order by shot_type, shot_side, shot_result"
+            shots = self.get_list(ShotCount, sql, *args)
+            return PlayerStats(player_id, sum(shot.count for shot in shots), shots)
+
+        # Counted by the db, so only one row per category comes back instead of one per shot
+        sql = "select s.shot_type, s.shot_side, s.shot_result, count(*) from stats s join matches m on m.id = s.match_id where s.user_id = %s and s.player_id = %s and m.deleted_at is null"
+        args = [user_id, player_id]
+        if query.start is not None:
+            sql += " and m.date >= %s"
+            args.append(query.start)
+        if query.end is not None:
+            sql += " and m.date < %s"
+            args.append(query.end)
+        if query.match_ids is not None:
+            sql += " and s.match_id in %s"
+            args.append(tuple(sorted(query.match_ids)))
+        sql += " group by s.shot_type, s.shot_side, s.shot_result order by s.shot_type, s.shot_side, s.shot_result"
+
+        shots = self.get_list(ShotCount, sql, *args)
+        return PlayerStats(player_id, sum(shot.count for shot in shots), shots)
+
+    def get_matches(self, context: RequestContext, user_id: str, query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> List[Match]:
+        match_dtos = self.get_match_dtos(query, *self.match_search_sql(user_id, match_filter))
+        if len(match_dtos) == 0:
+            return []
+        # Only the players these matches reference, which includes any that have since been deleted
+        player_ids = list({player_id for dto in match_dtos for player_id in dto.player_ids()})
+        players = self.get_players_by_ids(context, player_ids)
+        if not query.includes("stats"):
+            stats = None
+        elif match_filter.is_empty():
+            stats = self.get_stats(user_id)
+        else:
+            stats = self.get_stats_by_match_ids([dto.match_id for dto in match_dtos])
+        return self.to_matches(context, match_dtos, players, stats)
+
+    def get_match_page(self, context: RequestContext, user_id: str, limit: int, cursor: Optional[MatchCursor], query: MatchQuery = MatchQuery(), match_filter: MatchFilter = MatchFilter()) -> MatchPage:
+        # Grab one extra row so we know whether there's another page without a separate count query
+        match_dtos = self.get_match_dtos(query, *self.match_search_sql(user_id, match_filter, cursor, limit + 1))
+        next_cursor = None
+        if len(match_dtos) > limit:
+            match_dtos = match_dtos[:limit]
+            next_cursor = MatchCursor(match_dtos[-1].date, match_dtos[-1].match_id).encode()
+
+        player_ids = list({player_id for dto in match_dtos for player_id in dto.player_ids()})
+        stats = self.get_stats_by_match_ids([dto.match_id for dto in match_dtos]) if query.includes("stats") else None
+        return MatchPage(
+            matches=self.to_matches(context, match_dtos, self.get_players_by_ids(context, player_ids), stats),
+            next_cursor=next_cursor
+        )
+
+    def get_match_changes(self, context: RequestContext, user_id: str, since: Optional[datetime], query: MatchQuery = MatchQuery()) -> MatchChanges:
+        watermark = self.next_watermark()
+        if since is None:
+            return MatchChanges(self.get_matches(context, user_id, query), [], watermark)
+
+        match_dtos = self.get_changed_match_dtos(query, user_id, since)
+        deleted_ids = self.get_deleted_match_ids(user_id, since)
+        player_ids = list({player_id for dto in match_dtos for player_id in dto.player_ids()})
+        stats = self.get_stats_by_match_ids([dto.match_id for dto in match_dtos]) if query.includes("stats") else None
+        return MatchChanges(self.to_matches(context, match_dtos, self.get_players_by_ids(context, player_ids), stats), deleted_ids, watermark)
+
+    def get_match(self, context: RequestContext, match_id: str) -> Optional[Match]:
+        match = context.identity_map.get("matches", match_id)
+        if match is not None:
+            return match
+
+        match_dto = self.get_match_dto(match_id)
+        if match_dto is None:
+            return None
+        # Only load what this match references, so the cost doesn't grow with the user's history
+        return self.to_matches(context, [match_dto], self.get_players_by_ids(context, match_dto.player_ids()), self.get_stats_by_match_ids([match_id]))[0]
+
+    def create_match(self, context: RequestContext, match: Match) -> Match:
+        return self.create_matches(context, [match])[0]
+
+    def create_matches(self, context: RequestContext, matches: List[Match]) -> List[Match]:
+        """All or nothing, in one transaction. Each table gets a single executemany, which pymysql sends as multi-row inserts"""
+        with self.transaction():
+            # A deleted player's row still satisfies the foreign keys, so it's checked for here. The request body's copies of the players aren't
+            # authoritative, so these are also what the created matches are built from
+            player_ids = list({player.player_id for match in matches for player in match.players()})
+            players = {player.player_id: player for player in self.get_list(Player, "select id, owner_user_id, is_owner, image_url, first_name, last_name, dominant_hand, notes, phone_number, email_address, level from players where id in %s and deleted_at is null", tuple(player_ids))}
+            for match in matches:
+                for player in match.players():
+                    if player.player_id not in players or players[player.player_id].owner_user_id != match.user_id:
+                        raise ServiceException(f"Player not found: '{player.player_id}'", 400)
+                    context.identity_map.put("players", player.player_id, players[player.player_id])
+
+            match_params = []
+            for match in matches:
+                # Derived from the scores once here, so that reads can count and filter by who won in SQL rather than parsing every match's scores
+                outcome = match.outcome()
+                match_params.append([match.match_id, match.user_id, match.date, match.team1_player1.player_id, match.team1_player2.player_id if match.team1_player2 is not None else None, match.team2_player1.player_id,
+                                     match.team2_player2.player_id if match.team2_player2 is not None else None, match.scores_db_str(), outcome.team1_games, outcome.team2_games, outcome.team1_points, outcome.team2_points, outcome.winning_team])
+            self.execute_many("""
+                insert into matches (id, user_id, date, team1_player1_id, team1_player2_id, team2_player1_id, team2_player2_id, scores, team1_games, team2_games, team1_points, team2_points, winning_team)
+                values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, *match_params)
+            self.execute_many("insert into match_players (player_id, date, match_id, user_id, team) values (%s, %s, %s, %s, %s)",
+                              *[[player.player_id, match.date, match.match_id, match.user_id, team] for match in matches
+                                for team, players in [(1, [match.team1_player1, match.team1_player2]), (2, [match.team2_player1, match.team2_player2])] for player in players if player is not None])
+            stats_params = [[match.user_id, match.match_id, stat.player_id, stat.game_index, stat.shot_result, stat.shot_type, stat.shot_side] for match in matches for stat in match.stats]
+            if len(stats_params) > 0:
                 self.execute_many("insert into stats (user_id, match_id, player_id, game_index, shot_result, shot_type, shot_side) values (%s, %s, %s, %s, %s, %s, %s)", *stats_params)
-            self.conn.commit()
-        except ServiceException as e:
-            self.conn.rollback()
-            raise e
-        finally:
-            self.conn.autocommit(True)
-        return self.get_match(match.match_id)
+                self.add_to_stat_rollups(matches)
+            self.update_pair_records([MatchDbDto.from_match(match) for match in matches], 1)
+            for user_id in dict.fromkeys(match.user_id for match in matches):
+                self.bump_data_version(user_id)
+
+        # Build the results from what we just inserted
+        created_matches = []
+        for match in matches:
+            created_match = replace(
+                match,
+                # The date column doesn't store an offset, so this is what a read would give back
+                date=match.date.replace(tzinfo=None),
+                team1_player1=players[match.team1_player1.player_id],
+                team1_player2=players[match.team1_player2.player_id] if match.team1_player2 is not None else None,
+                team2_player1=players[match.team2_player1.player_id],
+                team2_player2=players[match.team2_player2.player_id] if match.team2_player2 is not None else None,
+                stats=[replace(stat, match_id=match.match_id) for stat in match.stats]
+            )
+            context.identity_map.put("matches", created_match.match_id, created_match)
+            created_matches.append(created_match)
+        return created_matches
 
-    def delete_match(self, match_id: str):
-        self.execute("delete from matches where id = %s", match_id)
+    def get_existing_match_ids(self, context: RequestContext, match_ids: List[str]) -> List[str]:
+        """Which of the ids are taken, including by deleted matches (whose rows are still there)"""
+        if len(match_ids) == 0:
+            return []
+        return self.get_list(str, "select id from matches where id in %s", tuple(match_ids))
+
+    def delete_match(self, context: RequestContext, match_id: str):
+        with self.transaction():
+            self.execute("update users set data_version = data_version + 1 where id = (select user_id from matches where id = %s)", match_id)
+            self.remove_from_stat_rollups("m.id = %s", match_id)
+            self.update_pair_records(self.get_match_dtos(OUTCOME_QUERY, "where id = %s and deleted_at is null", match_id), -1)
+            self.execute("update matches set deleted_at = now(6) where id = %s and deleted_at is null", match_id)
+        context.identity_map.evict("matches", match_id)
+
+    def get_latest_match(self, context: RequestContext, user_id: str, excluding_match_id: Optional[str] = None) -> Optional[MatchCursor]:
+        """Position of the user's most recent match (by date, then id), optionally ignoring one of them"""
+        return self.get_one(MatchCursor, "select date, id from matches where user_id = %s and deleted_at is null and id != %s order by date desc, id desc limit 1", user_id, excluding_match_id or "")
+
+    def get_ratings(self, context: RequestContext, user_id: str, player_ids: Optional[List[str]] = None) -> List[PlayerRating]:
+        if player_ids is None:
+            return self.get_list(PlayerRating, "select player_id, rating, matches_played from player_ratings where user_id = %s order by rating desc", user_id)
+        if len(player_ids) == 0:
+            return []
+        return self.get_list(PlayerRating, "select player_id, rating, matches_played from player_ratings where user_id = %s and player_id in %s", user_id, tuple(player_ids))
+
+    def save_ratings(self, context: RequestContext, user_id: str, ratings: List[PlayerRating], replace_all: bool = False):
+        with self.transaction():
+            # Ratings are written after the match that changed them, so clients holding the tag from in between need to refetch. Bumping first also
+            # takes the user's row lock, which queues this up behind (or ahead of) any other write of their ratings, see apply_match_to_ratings
+            self.bump_data_version(user_id)
+            if replace_all:
+                self.execute("delete from player_ratings where user_id = %s", user_id)
+            self.upsert_ratings(user_id, ratings)
+
+    def apply_match_to_ratings(self, context: RequestContext, user_id: str, match: Match) -> List[PlayerRating]:
+        """Moves the ratings of the match's players on from where they are now, and returns them"""
+        with self.transaction():
+            # Two matches (or a match and a replay) sharing a player mustn't both start from the same rating, or one of them is lost. The user's row
+            # lock covers players who don't have a rating row to lock yet, and the for update makes sure that the rows read are the latest ones
+            self.bump_data_version(user_id)
+            current = self.get_list(PlayerRating, "select player_id, rating, matches_played from player_ratings where user_id = %s and player_id in %s for update",
+                                    user_id, tuple(player.player_id for player in match.players()))
+            new_ratings = ratings.apply_match({rating.player_id: rating for rating in current}, match)
+            self.upsert_ratings(user_id, new_ratings)
+        return new_ratings
+
+    def get_pair_records(self, context: RequestContext, player_id: str, relation: str) -> List[PairRecord]:
+        # Pairs whose every match was deleted keep a row of zeroes
+        return self.get_list(PairRecord, "select player_id, other_player_id, matches, wins, losses, point_differential from pair_records where player_id = %s and relation = %s and matches > 0 order by matches desc, other_player_id",
+                             player_id, relation)
+
+    def rebuild_stat_rollups(self, user_id: Optional[str] = None):
+        condition, args = ("s.user_id = %s", [user_id]) if user_id is not None else ("1 = 1", [])
+        with self.transaction():
+            if user_id is not None:
+                self.execute("delete from stat_rollups where user_id = %s", user_id)
+            else:
+                self.execute("delete from stat_rollups")
+            self.execute(f"insert into stat_rollups (user_id, player_id, month, shot_type, shot_side, shot_result, count) {STAT_ROLLUP_SOURCE_SQL.format(condition=condition)}", *args)
+
+    def verify_stat_rollups(self, user_id: Optional[str] = None) -> List[tuple]:
+        """Every (user_id, player_id, month, shot_type, shot_side, shot_result, counted from stats, rolled up) that disagrees"""
+        condition, args = ("s.user_id = %s", [user_id]) if user_id is not None else ("1 = 1", [])
+        rollup_condition = "user_id = %s" if user_id is not None else "1 = 1"
+        return self.get_list(lambda *row: row, f"""
+            select user_id, player_id, month, shot_type, shot_side, shot_result, cast(sum(counted) as signed), cast(sum(rolled_up) as signed) from (
+                select user_id, player_id, month, shot_type, shot_side, shot_result, count as counted, 0 as rolled_up from ({STAT_ROLLUP_SOURCE_SQL.format(condition=condition)}) source
+                union all
+                select user_id, player_id, date_format(month, '%%Y-%%m-01'), shot_type, shot_side, shot_result, 0, count from stat_rollups where {rollup_condition}
+            ) both_sides
+            group by 1, 2, 3, 4, 5, 6
+            having sum(counted) != sum(rolled_up)
+            order by 1, 2, 3, 4, 5, 6
+        """, *(args + args))
+
+    def rebuild_pair_records(self, user_id: Optional[str] = None):
+        with self.transaction():
+            if user_id is not None:
+                self.execute("delete from pair_records where user_id = %s", user_id)
+                match_dtos = self.get_match_dtos(OUTCOME_QUERY, "where user_id = %s and deleted_at is null", user_id)
+            else:
+                self.execute("delete from pair_records")
+                match_dtos = self.get_match_dtos(OUTCOME_QUERY, "where deleted_at is null")
+            self.update_pair_records(match_dtos, 1)
+
+    def get_match_user_ids(self) -> List[str]:
+        # Deleted matches count too, so that a user who deleted all of theirs has their ratings cleared by a replay
+        return self.get_list(str, "select distinct user_id from matches order by user_id")
 
     # Private functions
 
+    def get_players_by_ids(self, context: RequestContext, player_ids: List[str]) -> List[Player]:
+        # Deleted players aren't filtered out here. They're only ever looked up by id to fill in a match that references them
+        missing_ids = [player_id for player_id in player_ids if context.identity_map.get("players", player_id) is None]
+        if len(missing_ids) > 0:
+            for player in self.get_list(Player, "select id, owner_user_id, is_owner, image_url, first_name, last_name, dominant_hand, notes, phone_number, email_address, level from players where id in %s", tuple(missing_ids)):
+                context.identity_map.put("players", player.player_id, player)
+        players = [context.identity_map.get("players", player_id) for player_id in player_ids]
+        return [player for player in players if player is not None]
+
+    def get_match_dto(self, match_id: str) -> Optional["MatchDbDto"]:
+        return self.get_one(MatchDbDto, "select id, user_id, date, team1_player1_id, team1_player2_id, team2_player1_id, team2_player2_id, scores from matches where id = %s and deleted_at is null", match_id)
+
+    def get_changed_players(self, owner_user_id: str, since: datetime) -> List[Player]:
+        return self.get_list(Player, "select id, owner_user_id, is_owner, image_url, first_name, last_name, dominant_hand, notes, phone_number, email_address, level from players where owner_user_id = %s and updated_at > %s and deleted_at is null", owner_user_id, since)
+
+    def get_deleted_player_ids(self, owner_user_id: str, since: datetime) -> List[str]:
+        return self.get_list(str, "select id from players where owner_user_id = %s and updated_at > %s and deleted_at is not null", owner_user_id, since)
+
+    def get_changed_match_dtos(self, query: MatchQuery, user_id: str, since: datetime) -> List:
+        # Matches are never edited, only created and deleted, so a changed match is always a new one
+        return self.get_match_dtos(query, "where user_id = %s and updated_at > %s and deleted_at is null order by date desc, id desc", user_id, since)
+
+    def get_deleted_match_ids(self, user_id: str, since: datetime) -> List[str]:
+        return self.get_list(str, "select id from matches where user_id = %s and updated_at > %s and deleted_at is not null", user_id, since)
+
     def get_stats(self, user_id: str) -> List[Stat]:
-        return self.get_list(Stat, "select match_id, player_id, game_index, shot_result, shot_type, shot_side from stats where user_id = %s order by match_id, id", user_id)
+        return self.get_list(Stat, "select s.match_id, s.player_id, s.game_index, s.shot_result, s.shot_type, s.shot_side from stats s join matches m on m.id = s.match_id where s.user_id = %s and m.deleted_at is null order by s.match_id, s.id", user_id)
 
-    def to_matches(self, match_dtos: List) -> List[Match]:
-        if len(match_dtos) == 0:
+    def get_stats_by_match_ids(self, match_ids: List[str]) -> List[Stat]:
+        if len(match_ids) == 0:
             return []
-
-        user_id = match_dtos[0].user_id
-        players = {k: list(v) for k, v in itertools.groupby(self.get_players(user_id), lambda player: player.player_id)}
-        stats = {k: list(v) for k, v in itertools.groupby(self.get_stats(user_id), lambda stat: stat.match_id)}
-
-        return [
-            Match(
-                match_id=dto.match_id,
-                user_id=dto.user_id,
-                date=dto.date,
-                team1_player1=players[dto.team1_player1_id][0],
-                team1_player2=players[dto.team1_player2_id][0] if dto.team1_player2_id is not None else None,
-                team2_player1=players[dto.team2_player1_id][0],
-                team2_player2=players[dto.team2_player2_id][0] if dto.team2_player2_id is not None else None,
-                scores=[GameScore.from_db_str(game) for game in dto.scores.split(",")],
-                stats=stats.get(dto.match_id, [])
-            )
-            for dto in match_dtos
-        ]
+        return self.get_list(Stat, "select match_id, player_id, game_index, shot_result, shot_type, shot_side from stats where match_id in %s order by match_id, id", tuple(match_ids))
+
+    def add_to_stat_rollups(self, matches: List[Match]):
+        # Counted up front so that each category is one upsert, however many shots (and matches) it has
+        counts = Counter((match.user_id, stat.player_id, date(match.date.year, match.date.month, 1), stat.shot_type, stat.shot_side or "", stat.shot_result) for match in matches for stat in match.stats)
+        self.execute_many("insert into stat_rollups (user_id, player_id, month, shot_type, shot_side, shot_result, count) values (%s, %s, %s, %s, %s, %s, %s) on duplicate key update count = count + values(count)",
+                          *[list(key) + [count] for key, count in counts.items()])
+
+    def remove_from_stat_rollups(self, condition: str, *args):
+        # Has to run before the matches are tombstoned, since only live matches are counted (which also keeps a repeated delete from counting twice)
+        self.execute(f"""
+            update stat_rollups r join ({STAT_ROLLUP_SOURCE_SQL.format(condition=condition)}) removed
+                on r.user_id = removed.user_id and r.player_id = removed.player_id and r.month = removed.month and r.shot_type = removed.shot_type and r.shot_side = removed.shot_side and r.shot_result = removed.shot_result
+            set r.count = r.count - removed.count
+        """, *args)
+
+    def upsert_ratings(self, user_id: str, ratings: List[PlayerRating]):
+        if len(ratings) > 0:
+            self.execute_many("insert into player_ratings (player_id, user_id, rating, matches_played) values (%s, %s, %s, %s) on duplicate key update rating = values(rating), matches_played = values(matches_played)",
+                              *[[rating.player_id, user_id, rating.rating, rating.matches_played] for rating in ratings])
+
+    def update_pair_records(self, match_dtos: List, sign: int):
+        """Adds (sign 1) or subtracts (sign -1) the matches from the records of every pair of players in them. Subtracting has to happen before they're tombstoned"""
+        # Summed up front so that each pair is one upsert, however many of the matches it played
+        changes: Dict[tuple, List[int]] = {}
+        for dto in match_dtos:
+            outcome = dto.outcome()
+            for team, own, others, point_differential in [(1, dto.team1_ids(), dto.team2_ids(), outcome.team1_points - outcome.team2_points),
+                                                          (2, dto.team2_ids(), dto.team1_ids(), outcome.team2_points - outcome.team1_points)]:
+                won, lost = outcome.winning_team == team, outcome.winning_team not in (team, None)
+                pairs = [(player_id, other_id, PARTNER) for player_id in own for other_id in own if other_id != player_id] + [(player_id, other_id, OPPONENT) for player_id in own for other_id in others]
+                for player_id, other_id, relation in pairs:
+                    change = changes.setdefault((dto.user_id, player_id, other_id, relation), [0, 0, 0, 0])
+                    change[0] += sign
+                    change[1] += sign * won
+                    change[2] += sign * lost
+                    change[3] += sign * point_differential
+        if len(changes) > 0:
+            self.execute_many("""
+                insert into pair_records (user_id, player_id, other_player_id, relation, matches, wins, losses, point_differential) values (%s, %s, %s, %s, %s, %s, %s, %s)
+                on duplicate key update matches = matches + values(matches), wins = wins + values(wins), losses = losses + values(losses), point_differential = point_differential + values(point_differential)
+            """, *[list(key) + change for key, change in changes.items()])
+
+    def next_watermark(self) -> str:
+        # The db's clock rather than ours, since that's the one that stamps updated_at
+        now = self.get_one(lambda now: now, "select now(6)")
+        return Watermark(now - timedelta(seconds=SYNC_OVERLAP_SECONDS)).encode()
+
+    def bump_data_version(self, user_id: str):
+        self.execute("update users set data_version = data_version + 1 where id = %s", user_id)
+
+    def remember_user(self, context: RequestContext, user: Optional[User]) -> Optional[User]:
+        if user is not None:
+            context.identity_map.put("users", user.user_id, user)
+            context.identity_map.put("users_by_firebase_id", user.firebase_id, user)
+        return user
+
+    def get_match_dtos(self, query: MatchQuery, sql: str, *args) -> List:
+        # Only select the columns behind the requested fields. They're qualified so that sql can join matches (as m) to other tables
+        columns = [column for column in MatchDbDto.COLUMNS if MatchDbDto.COLUMNS[column] is None or query.includes(MatchDbDto.COLUMNS[column])]
+        return self.get_list(lambda *row: MatchDbDto.from_row(columns, row), f"select {', '.join('m.' + column for column in columns)} from matches m {sql}", *args)
+
+    def match_search_sql(self, user_id: str, match_filter: MatchFilter, cursor: Optional[MatchCursor] = None, limit: Optional[int] = None) -> Tuple[str, List]:
+        """
+        The rest of a select from matches m that lists the user's live matches passing the filter, newest first, for get_match_dtos.
+        Without a player, that's a range of the matches_user_id_deleted_at_date index. With one, it's a range of the player's match_players rows (ordered the
+        same way) instead of a check of all four player columns of every match, and the partner/opponent are looked up by match_players' match_id index.
+        """
+        if match_filter.player_id is None:
+            joins, join_args = "", []
+            date_column, id_column = "m.date", "m.id"
+            conditions, args = ["m.user_id = %s", "m.deleted_at is null"], [user_id]
+        else:
+            joins, join_args = "join match_players mp on mp.match_id = m.id", []
+            date_column, id_column = "mp.date", "mp.match_id"
+            conditions, args = ["mp.player_id = %s", "m.user_id = %s", "m.deleted_at is null"], [match_filter.player_id, user_id]
+            for alias, other_id, team_operator in [("partner", match_filter.partner_id, "="), ("opponent", match_filter.opponent_id, "!=")]:
+                if other_id is not None:
+                    joins += f" join match_players {alias} on {alias}.match_id = mp.match_id and {alias}.player_id = %s and {alias}.player_id != mp.player_id and {alias}.team {team_operator} mp.team"
+                    join_args.append(other_id)
+
+        if match_filter.start is not None:
+            conditions.append(f"{date_column} >= %s")
+            args.append(match_filter.start)
+        if match_filter.end is not None:
+            conditions.append(f"{date_column} < %s")
+            args.append(match_filter.end)
+        if match_filter.format is not None:
+            conditions.append(f"m.team1_player2_id is {'' if match_filter.format == SINGLES else 'not '}null")
+        if cursor is not None:
+            conditions.append(f"({date_column} < %s or ({date_column} = %s and {id_column} < %s))")
+            args += [cursor.date, cursor.date, cursor.match_id]
+
+        sql = f"{joins} where {' and '.join(conditions)} order by {date_column} desc, {id_column} desc".strip()
+        if limit is not None:
+            sql += " limit %s"
+            args.append(limit)
+        return sql, join_args + args
+
+    def to_matches(self, context: RequestContext, match_dtos: List, players: List[Player], stats: Optional[List[Stat]]) -> List[Match]:
+        """Parts of the match that weren't loaded (no player ids/scores selected, or stats of None) are left as None"""
+        with metrics.span(metrics.MAPPING):
+            players = {player.player_id: player for player in players}
+            stats_by_match = {k: list(v) for k, v in itertools.groupby(stats, lambda stat: stat.match_id)} if stats is not None else None
+
+            matches = [
+                Match(
+                    match_id=dto.match_id,
+                    user_id=dto.user_id,
+                    date=dto.date,
+                    team1_player1=players[dto.team1_player1_id] if dto.team1_player1_id is not None else None,
+                    team1_player2=players[dto.team1_player2_id] if dto.team1_player2_id is not None else None,
+                    team2_player1=players[dto.team2_player1_id] if dto.team2_player1_id is not None else None,
+                    team2_player2=players[dto.team2_player2_id] if dto.team2_player2_id is not None else None,
+                    scores=[GameScore.from_db_str(game) for game in dto.scores.split(",")] if dto.scores is not None else None,
+                    stats=stats_by_match.get(dto.match_id, []) if stats_by_match is not None else None
+                )
+                for dto in match_dtos
+            ]
+            for match in matches:
+                # Partially loaded matches can't stand in for a full one later in the request
+                if match.team1_player1 is not None and match.team2_player1 is not None and match.scores is not None and match.stats is not None:
+                    context.identity_map.put("matches", match.match_id, match)
+            return matches
 
     # UTILS
 
+    @contextmanager
+    def transaction(self):
+        try:
+            with self.pool.connection() as conn:
+                # Statements on this thread run on the transaction's connection until it's done
+                self.local.conn = conn
+                try:
+                    conn.begin()
+                    yield conn
+                    conn.commit()
+                except Exception:
+                    try:
+                        conn.rollback()
+                    except Exception as e:
+                        print("Failed to roll back transaction", e)
+                    raise
+                finally:
+                    self.local.conn = None
+        except ServiceException:
+            raise
+        except Exception as e:
+            # Only wrapped once the pool has seen it, so that a connection lost during begin or commit is thrown away rather than reused
+            print(e)
+            raise ServiceException("Error executing database command")
+
+    @contextmanager
+    def cursor(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            with conn.cursor() as cur:
+                yield cur
+        else:
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                yield cur
+
+    def read(self, fun):
+        try:
+            with self.cursor() as cur:
+                return fun(cur)
+        except Exception as e:
+            # A read outside of a transaction can safely be replayed if the connection died underneath it. The pool has already thrown the dead one away
+            if not is_connection_lost(e) or getattr(self.local, "conn", None) is not None:
+                raise
+        with self.cursor() as cur:
+            return fun(cur)
+
     def get_list(self, klass, sql, *args):
+        def fetch(cur):
+            cur.execute(sql, args)
+            return cur.fetchall()
+
         try:
-            with self.conn.cursor() as cur:
-                cur.execute(sql, args)
-                results = []
-                for row in cur.fetchall():
-                    results.append(klass(*row))
-                return results
+            with metrics.query(sql) as query:
+                rows = self.read(fetch)
+                query.rows = len(rows)
+            with metrics.span(metrics.MAPPING):
+                return [klass(*row) for row in rows]
+        except ServiceException:
+            raise
         except Exception as e:
             print(e)
             raise ServiceException("Error getting data from database")
 
     def get_one(self, klass, sql, *args):
+        def fetch(cur):
+            cur.execute(sql, args)
+            return cur.fetchone()
+
         try:
-            with self.conn.cursor() as cur:
-                cur.execute(sql, args)
-                row = cur.fetchone()
-                if row is not None:
+            with metrics.query(sql) as query:
+                row = self.read(fetch)
+                query.rows = 1 if row is not None else 0
+            if row is not None:
+                with metrics.span(metrics.MAPPING):
                     return klass(*row)
-                return None
+            return None
+        except ServiceException:
+            raise
         except Exception as e:
             print(e)
             raise ServiceException("Error getting data from database")
 
     def execute(self, sql, *args):
         try:
-            with self.conn.cursor() as cur:
+            with metrics.query(sql), self.cursor() as cur:
                 cur.execute(sql, args)
+        except ServiceException:
+            raise
         except Exception as e:
             print(e)
             raise ServiceException("Error executing database command")
 
     def execute_many(self, sql, *args):
         try:
-            with self.conn.cursor() as cur:
+            with metrics.query(sql), self.cursor() as cur:
                 cur.executemany(sql, args)
+        except ServiceException:
+            raise
         except Exception as e:
             print(e)
             raise ServiceException("Error executing database command")
 
 
+def is_month_start(d: Optional[datetime]) -> bool:
+    return d is None or d == datetime(d.year, d.month, 1)
+
+
+def db_level(level: Optional[float]) -> Optional[float]:
+    # Mirrors the one decimal place that the players.level column stores
+    return round(level, 1) if level is not None else None
+
+
 @dataclass
 class MatchDbDto:
     match_id: str
     user_id: str
     date: datetime
-    team1_player1_id: str
-    team1_player2_id: str
-    team2_player1_id: str
-    team2_player2_id: str
-    scores: str
+    team1_player1_id: Optional[str] = None
+    team1_player2_id: Optional[str] = None
+    team2_player1_id: Optional[str] = None
+    team2_player2_id: Optional[str] = None
+    scores: Optional[str] = None
+    team1_games: Optional[int] = None
+    team2_games: Optional[int] = None
+    team1_points: Optional[int] = None
+    team2_points: Optional[int] = None
+
+    # Column -> the match field that needs it (None if it's always needed)
+    COLUMNS = {
+        "id": None,
+        "user_id": None,
+        "date": None,
+        "team1_player1_id": "team1",
+        "team1_player2_id": "team1",
+        "team2_player1_id": "team2",
+        "team2_player2_id": "team2",
+        "scores": "scores",
+        "team1_games": "outcome",
+        "team2_games": "outcome",
+        "team1_points": "outcome",
+        "team2_points": "outcome",
+    }
+
+    @classmethod
+    def from_row(cls, columns: List[str], row):
+        return MatchDbDto(**{("match_id" if column == "id" else column): value for column, value in zip(columns, row)})
+
+    @classmethod
+    def from_match(cls, match: Match):
+        outcome = match.outcome()
+        return MatchDbDto(match.match_id, match.user_id, match.date, *[player.player_id if player is not None else None for player in [match.team1_player1, match.team1_player2, match.team2_player1, match.team2_player2]],
+                          scores=match.scores_db_str(), team1_games=outcome.team1_games, team2_games=outcome.team2_games, team1_points=outcome.team1_points, team2_points=outcome.team2_points)
+
+    def team1_ids(self) -> List[str]:
+        return [player_id for player_id in [self.team1_player1_id, self.team1_player2_id] if player_id is not None]
+
+    def team2_ids(self) -> List[str]:
+        return [player_id for player_id in [self.team2_player1_id, self.team2_player2_id] if player_id is not None]
+
+    def outcome(self) -> MatchOutcome:
+        # Only set when the query asked for the outcome columns
+        return MatchOutcome(self.team1_games, self.team2_games, self.team1_points, self.team2_points)
+
+    def player_ids(self) -> List[str]:
+        return list({player_id for player_id in [self.team1_player1_id, self.team1_player2_id, self.team2_player1_id, self.team2_player2_id] if player_id is not None})
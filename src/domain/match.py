@@ -1,7 +1,8 @@
+import base64
 import uuid
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, FrozenSet, Callable
 
 from domain.base import DomainBase
 from domain.exceptions import DomainException
@@ -48,11 +49,41 @@ class Stat(DomainBase):
             raise DomainException(f"Missing required key '{e.args[0]}' in request body")
 
 
+@dataclass
+class MatchOutcome:
+    """Who won a match and by how much, derived from its scores"""
+    team1_games: int
+    team2_games: int
+    team1_points: int
+    team2_points: int
+
+    @classmethod
+    def from_scores(cls, scores: List[GameScore]):
+        return MatchOutcome(
+            team1_games=sum(1 for score in scores if score.team1_score > score.team2_score),
+            team2_games=sum(1 for score in scores if score.team2_score > score.team1_score),
+            team1_points=sum(score.team1_score for score in scores),
+            team2_points=sum(score.team2_score for score in scores),
+        )
+
+    @property
+    def winning_team(self) -> Optional[int]:
+        """1 or 2, or None for a tie (as many games won as lost)"""
+        if self.team1_games == self.team2_games:
+            return None
+        return 1 if self.team1_games > self.team2_games else 2
+
+
+# Every field a match listing can return. match_id and date are always sent
+MATCH_FIELDS = ["match_id", "date", "team1", "team2", "scores", "stats"]
+
+
 @dataclass
 class Match(DomainBase):
     match_id: str
     user_id: str
     date: datetime
+    # Listings can skip loading some fields (see MatchQuery). Those are left as None and aren't sent
     team1_player1: Player
     team1_player2: Optional[Player]
     team2_player1: Player
@@ -60,9 +91,15 @@ class Match(DomainBase):
     scores: List[GameScore]
     stats: List[Stat]
 
+    def players(self) -> List[Player]:
+        return [player for player in [self.team1_player1, self.team1_player2, self.team2_player1, self.team2_player2] if player is not None]
+
     def scores_db_str(self):
         return ",".join([score.to_db_str() for score in self.scores])
 
+    def outcome(self) -> MatchOutcome:
+        return MatchOutcome.from_scores(self.scores)
+
     @classmethod
     def from_dict(cls, d: Dict[str, Any], user: User):
         try:
@@ -79,7 +116,7 @@ class Match(DomainBase):
                 raise DomainException("No scores in the request body. A match must consist of at least one game")
             stats = [Stat.from_dict(stat) for stat in d.get("stats", [])]
 
-            return Match(
+            match = Match(
                 match_id=match_id,
                 user_id=user.user_id,
                 date=datetime.strptime(d["date"], "%Y-%m-%dT%H:%M:%S%z"),
@@ -90,15 +127,172 @@ class Match(DomainBase):
                 scores=scores,
                 stats=stats
             )
+            # match_players has a row per player per match
+            player_ids = [player.player_id for player in match.players()]
+            if len(set(player_ids)) < len(player_ids):
+                raise DomainException("The same player can't be in a match more than once")
+            return match
         except KeyError as e:
             raise DomainException(f"Missing required key '{e.args[0]}' in request body")
 
-    def to_dict(self) -> Dict[str, Any]:
-        return {
-            "match_id": self.match_id,
-            "date": self.date,
-            "team1": [player.to_dict() for player in [self.team1_player1, self.team1_player2] if player is not None],
-            "team2": [player.to_dict() for player in [self.team2_player1, self.team2_player2] if player is not None],
-            "scores": [score.to_dict() for score in self.scores],
-            "stats": [stat.to_dict() for stat in self.stats],
-        }
+    @classmethod
+    def batch_from_dict(cls, d: Dict[str, Any], user: User) -> List["Match"]:
+        """Every match in the batch is validated before any of them is written. The first bad one fails the whole batch"""
+        if not isinstance(d, dict) or not isinstance(d.get("matches"), list):
+            raise DomainException("Missing required key 'matches' in request body")
+        if len(d["matches"]) == 0:
+            raise DomainException("No matches in the request body")
+
+        matches = []
+        for i, match_dict in enumerate(d["matches"]):
+            try:
+                if not isinstance(match_dict, dict):
+                    raise DomainException("Must be an object")
+                matches.append(Match.from_dict(match_dict, user))
+            except DomainException as e:
+                raise DomainException(f"Match {i}: {e.error_message}")
+
+        match_ids = set()
+        for i, match in enumerate(matches):
+            if match.match_id in match_ids:
+                raise DomainException(f"Match {i}: Duplicate match_id '{match.match_id}'")
+            match_ids.add(match.match_id)
+        return matches
+
+    def to_dict(self, player_to_dict: Callable[[Player], Any] = Player.to_dict, score_to_dict: Callable[[GameScore], Any] = GameScore.to_dict,
+                stat_to_dict: Callable[[Stat], Any] = Stat.to_dict) -> Dict[str, Any]:
+        # The serializers pass in their own encoders, so that this is the only place the shape of a match is written down
+        d = {"match_id": self.match_id, "date": self.date}
+        if self.team1_player1 is not None:
+            d["team1"] = [player_to_dict(player) for player in [self.team1_player1, self.team1_player2] if player is not None]
+        if self.team2_player1 is not None:
+            d["team2"] = [player_to_dict(player) for player in [self.team2_player1, self.team2_player2] if player is not None]
+        if self.scores is not None:
+            d["scores"] = [score_to_dict(score) for score in self.scores]
+        if self.stats is not None:
+            d["stats"] = [stat_to_dict(stat) for stat in self.stats]
+        return d
+
+
+@dataclass
+class MatchQuery:
+    """Which parts of each match a listing should load. By default that's everything, which is what clients got before projection existed"""
+    fields: FrozenSet[str] = frozenset(MATCH_FIELDS)
+
+    def includes(self, field: str) -> bool:
+        return field in self.fields
+
+    @classmethod
+    def from_query_params(cls, query_params: Dict[str, str]):
+        fields_param, include_param = query_params.get("fields"), query_params.get("include")
+        if fields_param is None and include_param is None:
+            return MatchQuery()
+
+        # Once a client asks for a projection, stats (by far the largest part of a match) are only sent when asked for
+        fields = set(split_param(fields_param)) if fields_param is not None else set(MATCH_FIELDS) - {"stats"}
+        unknown_fields = fields - set(MATCH_FIELDS)
+        if len(unknown_fields) > 0:
+            raise DomainException(f"Unknown field(s): {', '.join(sorted(unknown_fields))}")
+
+        includes = set(split_param(include_param)) if include_param is not None else set()
+        unknown_includes = includes - {"stats"}
+        if len(unknown_includes) > 0:
+            raise DomainException(f"Unknown include(s): {', '.join(sorted(unknown_includes))}")
+
+        return MatchQuery(frozenset(fields | includes | {"match_id", "date"}))
+
+
+SINGLES, DOUBLES = "singles", "doubles"
+
+
+@dataclass
+class MatchFilter:
+    """Narrows a match listing down. partner_id and opponent_id are relative to player_id, who can have played on either team"""
+    player_id: Optional[str] = None
+    partner_id: Optional[str] = None
+    opponent_id: Optional[str] = None
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    format: Optional[str] = None
+
+    @classmethod
+    def from_query_params(cls, query_params: Dict[str, str]):
+        match_format = query_params.get("format")
+        if match_format is not None and match_format not in [SINGLES, DOUBLES]:
+            raise DomainException(f"Invalid format: '{match_format}'. Must be {SINGLES} or {DOUBLES}")
+
+        match_filter = MatchFilter(
+            player_id=query_params.get("player_id"),
+            partner_id=query_params.get("partner_id"),
+            opponent_id=query_params.get("opponent_id"),
+            start=parse_date_param(query_params, "from"),
+            end=parse_date_param(query_params, "to"),
+            format=match_format
+        )
+        if match_filter.player_id is None and (match_filter.partner_id is not None or match_filter.opponent_id is not None):
+            raise DomainException("partner_id and opponent_id can only be used along with player_id")
+        return match_filter
+
+    def is_empty(self) -> bool:
+        return self == MatchFilter()
+
+
+def split_param(param: str) -> List[str]:
+    return [value.strip() for value in param.split(",") if value.strip() != ""]
+
+
+def parse_date_param(query_params: Dict[str, str], key: str) -> Optional[datetime]:
+    value = query_params.get(key)
+    if value is None:
+        return None
+    try:
+        # Same format that match dates are sent and received in. The db stores them without an offset
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z").replace(tzinfo=None)
+    except ValueError:
+        raise DomainException(f"Query parameter '{key}' must be a date like 2021-10-26T18:35:12Z")
+
+
+@dataclass
+class MatchCursor:
+    """Keyset position in a user's match history, which is ordered by (date, match_id) descending"""
+    date: datetime
+    match_id: str
+
+    def encode(self) -> str:
+        raw = f"{self.date.strftime('%Y-%m-%dT%H:%M:%S.%f')}|{self.match_id}"
+        return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+    @classmethod
+    def decode(cls, cursor: str):
+        try:
+            date_str, match_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|", 1)
+            return MatchCursor(datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S.%f"), match_id)
+        except ValueError:
+            raise DomainException("Invalid cursor")
+
+
+CREATED, ALREADY_EXISTS = "CREATED", "ALREADY_EXISTS"
+
+
+@dataclass
+class BatchResult(DomainBase):
+    """What happened to one match of a batch. ALREADY_EXISTS means its match_id was taken, most likely by an earlier upload of the same batch"""
+    match_id: str
+    status: str
+
+
+@dataclass
+class MatchPage(DomainBase):
+    matches: List[Match]
+    next_cursor: Optional[str]
+
+
+@dataclass
+class NormalizedMatches(DomainBase):
+    """Matches with each player sent once in a top level map, instead of embedded in every match they played"""
+    matches: List[Match]
+    next_cursor: Optional[str] = None
+
+    def players(self) -> Dict[str, Player]:
+        return {player.player_id: player for match in self.matches for player in match.players()}
+
@@ -0,0 +1,16 @@
+from dataclasses import dataclass
+
+from domain.base import DomainBase
+
+OPPONENT, PARTNER = "OPPONENT", "PARTNER"
+
+
+@dataclass
+class PairRecord(DomainBase):
+    """A player's record against (or alongside) one other player. Matches that were neither won nor lost were tied"""
+    player_id: str
+    other_player_id: str
+    matches: int
+    wins: int
+    losses: int
+    point_differential: int
@@ -0,0 +1,10 @@
+from dataclasses import dataclass
+
+from domain.base import DomainBase
+
+
+@dataclass
+class PlayerRating(DomainBase):
+    player_id: str
+    rating: float
+    matches_played: int
@@ -0,0 +1,39 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, List, Dict, FrozenSet
+
+from domain.base import DomainBase
+from domain.match import split_param, parse_date_param
+
+
+@dataclass
+class StatsQuery:
+    """Narrows a player's stats down to matches played in [start, end) and/or to an explicit set of matches"""
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    match_ids: Optional[FrozenSet[str]] = None
+
+    @classmethod
+    def from_query_params(cls, query_params: Dict[str, str]):
+        match_ids = query_params.get("match_ids")
+        return StatsQuery(
+            start=parse_date_param(query_params, "from"),
+            end=parse_date_param(query_params, "to"),
+            match_ids=frozenset(split_param(match_ids)) if match_ids is not None else None
+        )
+
+
+@dataclass
+class ShotCount(DomainBase):
+    shot_type: str
+    shot_side: Optional[str]
+    shot_result: str
+    count: int
+
+
+@dataclass
+class PlayerStats(DomainBase):
+    """A player's shots counted by type, side and result, rather than sent one by one"""
+    player_id: str
+    total: int
+    shots: List[ShotCount]
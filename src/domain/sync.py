@@ -0,0 +1,48 @@
+import base64
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, List
+
+from domain.base import DomainBase
+from domain.exceptions import DomainException
+from domain.match import Match
+from domain.player import Player
+
+# A since value that asks for everything, for a client's first sync
+FROM_THE_START = "0"
+
+
+@dataclass
+class Watermark:
+    """Point in the server's change history that a client has synced up to. A timestamp of None is the very start"""
+    timestamp: Optional[datetime]
+
+    def encode(self) -> str:
+        if self.timestamp is None:
+            return FROM_THE_START
+        return base64.urlsafe_b64encode(self.timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f").encode("utf-8")).decode("ascii")
+
+    @classmethod
+    def decode(cls, since: str):
+        if since == FROM_THE_START:
+            return Watermark(None)
+        try:
+            return Watermark(datetime.strptime(base64.urlsafe_b64decode(since.encode("ascii")).decode("utf-8"), "%Y-%m-%dT%H:%M:%S.%f"))
+        except ValueError:
+            raise DomainException("Invalid since watermark")
+
+
+@dataclass
+class PlayerChanges(DomainBase):
+    """Players created or updated after a watermark, the ids of those deleted after it, and the watermark to send next time"""
+    players: List[Player]
+    deleted: List[str]
+    watermark: str
+
+
+@dataclass
+class MatchChanges(DomainBase):
+    """Matches created after a watermark, the ids of those deleted after it, and the watermark to send next time"""
+    matches: List[Match]
+    deleted: List[str]
+    watermark: str
@@ -1,18 +1,47 @@
-from typing import Optional
+import hashlib
+import threading
+import time
 
-import firebase_admin
-from firebase_admin import auth
+from cache import TTLCache
+
+# Verified tokens are trusted for at most this long (and never past their own expiry)
+MAX_TOKEN_CACHE_SECONDS = 15 * 60
+
+
+class InvalidTokenError(ValueError):
+    pass
 
 
 class FirebaseClient:
-    @staticmethod
-    def get_firebase_user(token: str): pass
+    def get_firebase_user(self, token: str): pass
 
 
 class FirebaseClientImpl(FirebaseClient):
     def __init__(self):
-        firebase_admin.initialize_app()
+        # firebase_admin takes a few hundred ms to import, so it isn't loaded (or initialized) until a token actually needs verifying
+        self._auth = None
+        self.init_lock = threading.Lock()
+        self.token_cache = TTLCache(max_size=1024)
+
+    def get_firebase_user(self, token: str):
+        # Key on a digest so raw tokens don't sit in memory any longer than the request that sent them
+        key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        claims = self.token_cache.get(key)
+        if claims is None:
+            auth = self.auth()
+            try:
+                claims = auth.verify_id_token(token)
+            except auth.InvalidIdTokenError as e:
+                raise InvalidTokenError(str(e)) from e
+            self.token_cache.put(key, claims, min(claims.get("exp", 0), time.time() + MAX_TOKEN_CACHE_SECONDS))
+        return claims
 
-    @staticmethod
-    def get_firebase_user(token: str):
-        return auth.verify_id_token(token)
+    def auth(self):
+        if self._auth is None:
+            with self.init_lock:
+                if self._auth is None:
+                    import firebase_admin
+                    from firebase_admin import auth
+                    firebase_admin.initialize_app()
+                    self._auth = auth
+        return self._auth
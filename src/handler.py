@@ -1,13 +1,65 @@
-import datetime
+import hashlib
 import json
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
 
 from bl import ManagerImpl
-from domain.base import DomainBase
 from domain.exceptions import ServiceException
 from domain.player import Player
-from domain.match import Match
+from domain.match import Match, NormalizedMatches, MatchQuery, MatchFilter
+from domain.stats import StatsQuery
 from da import DaoImpl
 from firebase_client import FirebaseClientImpl
+from request_context import RequestContext
+import metrics
+import serialization
+
+
+DEFAULT_PAGE_SIZE = 50
+
+# GETs whose responses only change when one of the user's players or matches does, so they can be answered with a 304
+CACHEABLE_RESOURCES = ["/players", "/players/{id}/stats", "/players/{id}/head-to-head", "/players/{id}/partners", "/matches", "/ratings"]
+
+
+@dataclass
+class Call:
+    """The manager method a request maps to (if any), the arguments it's passed after the context, and what to make of its result"""
+    method: Optional[str]
+    args: Tuple = ()
+    to_body: Callable[[Any], Any] = lambda result: result
+
+
+def get_matches_call(context, path_params, query_params, body) -> Call:
+    shape, query, match_filter = Handler.parse_match_params(query_params)
+    if "since" in query_params:
+        return Call("get_match_changes", (query_params["since"], query))
+    elif "limit" in query_params or "cursor" in query_params:
+        return Call("get_match_page", (Handler.get_int_param(query_params, "limit", DEFAULT_PAGE_SIZE), query_params.get("cursor"), query, match_filter),
+                    lambda page: NormalizedMatches(page.matches, page.next_cursor) if shape == "normalized" else page)
+    else:
+        return Call("get_matches", (query, match_filter), lambda matches: NormalizedMatches(matches) if shape == "normalized" else matches)
+
+
+# Every (method, resource) the API Gateway routes to the handler, and how its request is turned into a Call. Shared by Handler and AsyncHandler
+ROUTES: Dict[Tuple[str, str], Callable[[RequestContext, Dict, Dict, Any], Call]] = {
+    ("POST", "/users"): lambda context, path_params, query_params, body: Call(None, to_body=lambda _: context.user),
+    ("GET", "/players"): lambda context, path_params, query_params, body: Call("get_player_changes", (query_params["since"],)) if "since" in query_params else Call("get_players"),
+    ("POST", "/players"): lambda context, path_params, query_params, body: Call("create_player", (Player.from_dict(body, context.user),)),
+    ("PUT", "/players/{id}"): lambda context, path_params, query_params, body: Call("update_player", (path_params["id"], Player.from_dict(body, context.user))),
+    ("DELETE", "/players/{id}"): lambda context, path_params, query_params, body: Call("delete_player", (path_params["id"],)),
+    ("GET", "/players/{id}/stats"): lambda context, path_params, query_params, body: Call("get_player_stats", (path_params["id"], StatsQuery.from_query_params(query_params))),
+    ("GET", "/players/{id}/head-to-head"): lambda context, path_params, query_params, body: Call("get_head_to_head", (path_params["id"],)),
+    ("GET", "/players/{id}/partners"): lambda context, path_params, query_params, body: Call("get_partners", (path_params["id"],)),
+    ("GET", "/matches"): get_matches_call,
+    ("POST", "/matches"): lambda context, path_params, query_params, body: Call("create_match", (Match.from_dict(body, context.user),)),
+    ("POST", "/matches/batch"): lambda context, path_params, query_params, body: Call("create_matches", (Match.batch_from_dict(body, context.user),)),
+    ("DELETE", "/matches/{id}"): lambda context, path_params, query_params, body: Call("delete_match", (path_params["id"],)),
+    ("GET", "/ratings"): lambda context, path_params, query_params, body: Call("get_ratings"),
+}
+
+# server.py matches request paths against these
+RESOURCES = list(dict.fromkeys(resource for _, resource in ROUTES))
 
 
 def handle(event, _):
@@ -15,74 +67,130 @@ def handle(event, _):
 
 
 class Handler:
+    # Shared by every request the process serves. Anything that belongs to one request lives in its RequestContext instead
     instance = None
+    instance_lock = threading.Lock()
 
     @staticmethod
     def get_instance():
         if Handler.instance is None:
-            Handler.instance = Handler(ManagerImpl(FirebaseClientImpl(), DaoImpl()))
+            with Handler.instance_lock:
+                if Handler.instance is None:
+                    Handler.instance = Handler(ManagerImpl(FirebaseClientImpl(), DaoImpl()))
         return Handler.instance
 
     def __init__(self, manager):
         self.manager = manager
 
     def handle(self, event):
+        context = RequestContext()
+        with metrics.recording(context.metrics):
+            response = self.dispatch(context, event)
+            context.metrics.finish(response)
+            return response
+
+    def dispatch(self, context, event):
         try:
-            if event is None or "resource" not in event or "httpMethod" not in event:
-                raise ServiceException("Invalid request. No 'resource', or 'httpMethod' found in the event", 400)
-
-            resource, method = event["resource"], event["httpMethod"]  # These will be used to specify which endpoint was being hit
-            print(f"Received a {method} on {resource}")
-            path_params = event.get("pathParameters", {}) if event.get("pathParameters") is not None else {}  # This will be used to get IDs and other parameters from the URL
-            query_params = event.get("queryStringParameters", {}) if event.get("queryStringParameters") is not None else {}  # This will be used to get IDs and other parameters from the URL
-            try:
-                body = json.loads(event["body"])  # This will be used for most POSTs and PUTs
-            except (TypeError, KeyError, ValueError):
-                body = None
-
-            self.manager.validate_token(self.get_token(event))
-
-            if resource == "/users" and method == "POST":
-                response_body = self.manager.user
-            elif resource == "/players" and method == "GET":
-                response_body = self.manager.get_players()
-            elif resource == "/players" and method == "POST":
-                response_body = self.manager.create_player(Player.from_dict(body, self.manager.user))
-            elif resource == "/players/{id}" and method == "PUT":
-                response_body = self.manager.update_player(path_params["id"], Player.from_dict(body, self.manager.user))
-            elif resource == "/players/{id}" and method == "DELETE":
-                response_body = self.manager.delete_player(path_params["id"])
-            elif resource == "/matches" and method == "GET":
-                response_body = self.manager.get_matches()
-            elif resource == "/matches" and method == "POST":
-                response_body = self.manager.create_match(Match.from_dict(body, self.manager.user))
-            elif resource == "/matches/{id}" and method == "DELETE":
-                response_body = self.manager.delete_match(path_params["id"])
-            else:
-                raise ServiceException("Invalid path: '{} {}'".format(resource, method))
-
-            print("Responding with", response_body)
-            return format_response(response_body)
+            resource, method, path_params, query_params, body = self.parse_event(event)
+            context.metrics.route = f"{method} {resource}"
+
+            with context.metrics.span(metrics.AUTH):
+                self.manager.validate_token(context, self.get_token(event))
+
+            etag = None
+            if method == "GET" and resource in CACHEABLE_RESOURCES:
+                # The version is read before the data, so a write landing in between can only ever make the tag stale (costing a refetch), never wrong
+                data_version = self.manager.get_data_version(context)
+                etag = self.get_etag(context.user.user_id, resource, path_params, query_params, data_version)
+                if etag in self.get_if_none_match(event):
+                    return format_response(status_code=304, headers=self.get_etag_headers(etag))
+
+            call = self.route(context, resource, method, path_params, query_params, body)
+            response_body = call.to_body(getattr(self.manager, call.method)(context, *call.args) if call.method is not None else None)
+            return format_response(response_body, headers=self.get_etag_headers(etag) if etag is not None else None)
         except ServiceException as e:
             return format_response({"error": e.error_message}, e.status_code)
 
+    @staticmethod
+    def parse_event(event):
+        """The resource, method, path params, query params and JSON body of an API Gateway event"""
+        if event is None or "resource" not in event or "httpMethod" not in event:
+            raise ServiceException("Invalid request. No 'resource', or 'httpMethod' found in the event", 400)
+
+        resource, method = event["resource"], event["httpMethod"]  # These will be used to specify which endpoint was being hit
+        path_params = event.get("pathParameters", {}) if event.get("pathParameters") is not None else {}  # This will be used to get IDs and other parameters from the URL
+        query_params = event.get("queryStringParameters", {}) if event.get("queryStringParameters") is not None else {}  # This will be used to get IDs and other parameters from the URL
+        try:
+            body = json.loads(event["body"])  # This will be used for most POSTs and PUTs
+        except (TypeError, KeyError, ValueError):
+            body = None
+        return resource, method, path_params, query_params, body
+
+    @staticmethod
+    def route(context, resource, method, path_params, query_params, body) -> Call:
+        if (method, resource) not in ROUTES:
+            raise ServiceException("Invalid path: '{} {}'".format(resource, method))
+        return ROUTES[(method, resource)](context, path_params, query_params, body)
+
+    @staticmethod
+    def parse_match_params(query_params):
+        """The shape, MatchQuery and MatchFilter of a GET /matches"""
+        shape = query_params.get("shape", "embedded")
+        if shape not in ["embedded", "normalized"]:
+            raise ServiceException(f"Invalid shape: '{shape}'", 400)
+
+        query = MatchQuery.from_query_params(query_params)
+        match_filter = MatchFilter.from_query_params(query_params)
+        if "since" in query_params:
+            # A sync is already as small as it gets, so it isn't paged, reshaped or filtered
+            if "limit" in query_params or "cursor" in query_params or shape != "embedded":
+                raise ServiceException("The since parameter can't be combined with limit, cursor or shape", 400)
+            if not match_filter.is_empty():
+                raise ServiceException("The since parameter can't be combined with filters", 400)
+        return shape, query, match_filter
+
     @staticmethod
     def get_token(event):
-        # Lower case all the keys, then look for token
-        return {k.lower(): v for k, v in event["headers"].items()}.get("x-firebase-token")
+        return Handler.get_header(event, "x-firebase-token")
 
+    @staticmethod
+    def get_header(event, name):
+        # Lower case all the keys, then look for the header
+        return {k.lower(): v for k, v in (event.get("headers") or {}).items()}.get(name)
 
-def format_response(body=None, status_code=200):
-    return {
-        "statusCode": status_code,
-        "body": json.dumps(body, default=default_serialize) if body is not None else None
-    }
+    @staticmethod
+    def get_if_none_match(event):
+        header = Handler.get_header(event, "if-none-match")
+        return [tag.strip() for tag in header.split(",")] if header is not None else []
 
+    @staticmethod
+    def get_etag(user_id, resource, path_params, query_params, data_version):
+        # Every user's versions count up from the same place, so the user is part of the tag. Different params (and json backends) produce different
+        # bytes, so they're part of it too
+        key = f"{user_id}|{data_version}|{resource}|{sorted(path_params.items())}|{sorted(query_params.items())}|{serialization.backend()}"
+        return '"' + hashlib.sha256(key.encode("utf-8")).hexdigest()[:32] + '"'
 
-def default_serialize(x):
-    if isinstance(x, datetime.datetime):
-        return x.strftime("%Y-%m-%dT%H:%M:%SZ")
-    elif isinstance(x, DomainBase):
-        return x.to_dict()
-    else:
-        return x.__dict__
+    @staticmethod
+    def get_etag_headers(etag):
+        # The same URL means something different for every user, so shared caches mustn't store it, and a private one has to key it on the token
+        return {"ETag": etag, "Cache-Control": "private", "Vary": "X-Firebase-Token"}
+
+    @staticmethod
+    def get_int_param(query_params, key, default=None):
+        try:
+            return int(query_params[key]) if query_params.get(key) is not None else default
+        except ValueError:
+            raise ServiceException(f"Query parameter '{key}' must be an integer", 400)
+
+
+def format_response(body=None, status_code=200, headers=None):
+    response = {
+        "statusCode": status_code,
+        "body": None
+    }
+    if body is not None:
+        with metrics.span(metrics.ENCODE):
+            response["body"] = serialization.dumps(body)
+    if headers is not None:
+        response["headers"] = headers
+    return response
@@ -0,0 +1,222 @@
+"""
+Timings and counts for a single request, logged as one JSON line when it's done, e.g.
+
+    {"metrics": "request", "route": "GET /matches", "status": 200, "db_round_trips": 3, "rows": 240, "bytes_out": 48213,
+     "ms": {"total": 41.2, "auth": 3.1, "db": 22.7, "mapping": 6.5, "encode": 7.9}}
+
+The phases are auth (validating the token, including looking the user up), db (every query, counted from checking out a connection to the last row
+arriving), mapping (turning rows into domain objects) and encode (turning the response into JSON). auth overlaps db, and when a request's queries run
+concurrently, db can add up to more than total.
+
+Every request's statements are also checked against its route's query budget, and for the same statement being run over and over (a query per row,
+or N+1). An overrun is logged as a second line, or with QUERY_BUDGET_STRICT=1 (as test_runner sets), raised.
+
+The Handler starts recording a request's metrics in its RequestContext. The queries themselves are made too far below the calls that are handed the
+context (and in AsyncDaoImpl's case, on another thread), so they find the request's metrics through a ContextVar. Outside of a request (the rollup
+rebuilds, plan checks and the like) there are none, and nothing is recorded.
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+AUTH, DB, MAPPING, ENCODE, TOTAL = "auth", "db", "mapping", "encode", "total"
+
+# The most statements each route may run once the caller is authenticated, over every branch it can take. None of them depends on how many matches
+# or players the user has, so a change that makes one grow with the history (a query per match, say) blows through it. One that genuinely needs
+# another statement should raise the budget here, on purpose. Overridden per route by QUERY_BUDGETS, a JSON object in the environment
+QUERY_BUDGETS: Dict[str, int] = {
+    "POST /users": 0,
+    "GET /players": 4,  # With since: the version, watermark, changed and deleted
+    "POST /players": 2,
+    "PUT /players/{id}": 3,
+    "DELETE /players/{id}": 12,  # The tombstoning transaction, then replaying the ratings
+    "GET /players/{id}/stats": 3,
+    "GET /players/{id}/head-to-head": 3,
+    "GET /players/{id}/partners": 3,
+    "GET /matches": 6,  # With since: the version, watermark, changed, deleted, players and stats
+    "POST /matches": 13,  # Backdated: the insert transaction, then replaying the ratings
+    "POST /matches/batch": 13,
+    "DELETE /matches/{id}": 13,
+    "GET /ratings": 2,
+}
+
+
+def parse_budget_overrides(raw: str) -> Dict[str, int]:
+    # A bad override mustn't stop every request from being served, so it's logged and the defaults are kept
+    try:
+        overrides = json.loads(raw)
+        if not isinstance(overrides, dict):
+            raise ValueError("QUERY_BUDGETS must be a JSON object")
+        for route, budget in overrides.items():
+            if not isinstance(budget, int) or isinstance(budget, bool) or budget < 0:
+                raise ValueError(f"QUERY_BUDGETS['{route}'] must be a non-negative integer, not {budget!r}")
+        return overrides
+    except ValueError as e:
+        print(f"Ignoring QUERY_BUDGETS: {e}")
+        return {}
+
+
+QUERY_BUDGETS.update(parse_budget_overrides(os.environ.get("QUERY_BUDGETS", "{}")))
+# Looking the user up and, on their first request, creating them and their player
+AUTH_QUERY_BUDGET = 4
+# The most times one statement may run in a request. Only the data version bump runs twice (after the match, then after its ratings)
+REPEATED_QUERY_LIMIT = 2
+
+strict_budgets = os.environ.get("QUERY_BUDGET_STRICT") == "1"
+
+current_metrics: ContextVar[Optional["RequestMetrics"]] = ContextVar("current_metrics", default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+@dataclass
+class QuerySpan:
+    sql: str
+    seconds: float
+    rows: int
+
+
+class RequestMetrics:
+    def __init__(self, clock: Callable[[], float] = time.perf_counter):
+        self.clock = clock
+        self.route: Optional[str] = None
+        self.status: Optional[int] = None
+        self.bytes_out = 0
+        self.rows = 0
+        self.queries: List[QuerySpan] = []
+        self.auth_round_trips = 0
+        self.phases: Dict[str, float] = {}  # phase -> seconds
+        # An AsyncDaoImpl runs a request's queries on several threads at once
+        self.lock = threading.Lock()
+
+    @property
+    def db_round_trips(self) -> int:
+        return len(self.queries)
+
+    def add(self, phase: str, seconds: float):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def add_query(self, sql: str, seconds: float, rows: int):
+        with self.lock:
+            self.queries.append(QuerySpan(sql, seconds, rows))
+            self.rows += rows
+            self.phases[DB] = self.phases.get(DB, 0.0) + seconds
+
+    @contextmanager
+    def span(self, phase: str):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(phase, self.clock() - start)
+            if phase == AUTH:
+                self.auth_round_trips = self.db_round_trips
+
+    def finish(self, response: Dict):
+        self.status = response["statusCode"]
+        body = response.get("body")
+        if body is not None:
+            # JSON is usually all ASCII, which saves encoding the body just to count it
+            self.bytes_out = len(body) if body.isascii() else len(body.encode("utf-8"))
+
+    def to_dict(self) -> Dict:
+        return {
+            "metrics": "request",
+            "route": self.route,
+            "status": self.status,
+            "db_round_trips": self.db_round_trips,
+            "rows": self.rows,
+            "bytes_out": self.bytes_out,
+            "ms": {phase: round(seconds * 1000, 1) for phase, seconds in self.phases.items()},
+        }
+
+    def budget_overrun(self) -> Optional[Dict]:
+        """What went over budget, or None if nothing did"""
+        budget = QUERY_BUDGETS.get(self.route)
+        route_round_trips = self.db_round_trips - self.auth_round_trips
+        repeated = {" ".join(sql.split()): count for sql, count in Counter(query.sql for query in self.queries).items() if count > REPEATED_QUERY_LIMIT}
+        if (budget is None or route_round_trips <= budget) and self.auth_round_trips <= AUTH_QUERY_BUDGET and len(repeated) == 0:
+            return None
+        return {
+            "metrics": "query_budget_exceeded",
+            "route": self.route,
+            "auth_round_trips": self.auth_round_trips,
+            "auth_budget": AUTH_QUERY_BUDGET,
+            "route_round_trips": route_round_trips,
+            "route_budget": budget,
+            "repeated": repeated,
+        }
+
+
+@contextmanager
+def recording(request_metrics: RequestMetrics):
+    """Makes these the current request's metrics, and logs them (and any budget overrun) once the request is done"""
+    token = current_metrics.set(request_metrics)
+    overrun = None
+    try:
+        with request_metrics.span(TOTAL):
+            yield request_metrics
+    except Exception:
+        # Lambda turns an unhandled error into a 502, but as far as we're concerned it's ours
+        request_metrics.status = request_metrics.status or 500
+        raise
+    finally:
+        current_metrics.reset(token)
+        print(json.dumps(request_metrics.to_dict()))
+        overrun = request_metrics.budget_overrun()
+        if overrun is not None:
+            print(json.dumps(overrun))
+    # Only reached when the request itself succeeded, so this never hides its error
+    if overrun is not None and strict_budgets:
+        raise QueryBudgetExceeded(json.dumps(overrun))
+
+
+@contextmanager
+def counting():
+    """Counts the statements run in the block (outside of any request), for checking a Dao call's cost without going through the Handler"""
+    request_metrics = RequestMetrics()
+    token = current_metrics.set(request_metrics)
+    try:
+        yield request_metrics
+    finally:
+        current_metrics.reset(token)
+
+
+@contextmanager
+def span(phase: str):
+    """Times a phase of the current request, if there is one"""
+    request_metrics = current_metrics.get()
+    if request_metrics is None:
+        yield
+    else:
+        with request_metrics.span(phase):
+            yield
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.rows = 0
+
+
+@contextmanager
+def query(sql: str):
+    """Times a round trip for the current request, if there is one. Whoever fetches the rows sets the recorder's count"""
+    recorder = QueryRecorder()
+    request_metrics = current_metrics.get()
+    if request_metrics is None:
+        yield recorder
+        return
+    start = request_metrics.clock()
+    try:
+        yield recorder
+    finally:
+        request_metrics.add_query(sql, request_metrics.clock() - start, recorder.rows)
@@ -0,0 +1,167 @@
+"""
+Applies the versioned schema migrations in migrations/ (NNN_description.sql, in version order) that the database hasn't had yet.
+Connects with the same DB_* environment variables as the Lambda. Applied versions are recorded in schema_migrations, so running it again is a no-op.
+
+    venv/bin/python src/migrate.py apply
+    venv/bin/python src/migrate.py status
+    venv/bin/python src/migrate.py baseline VERSION
+
+DDL that finds its table, column, index or foreign key already there is skipped rather than failing, so a migration that was half applied (or
+partly applied by hand) can be rerun. So is an index the table already has under another name, i.e. one on the same columns. Backfills aren't
+idempotent though, so a database that was migrated by hand before schema_migrations existed has to be marked with `baseline` (the last version it
+already has) before its first `apply`.
+"""
+import argparse
+import os
+import re
+import sys
+from dataclasses import dataclass
+from typing import List, Optional, Set, Tuple
+
+import pymysql
+
+from da import DaoImpl
+
+MIGRATIONS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "migrations"))
+
+# Table, column, index and foreign key already exist
+ALREADY_APPLIED_ERRORS = {1050, 1060, 1061, 1826}
+# create [unique] index name on table (columns)
+CREATE_INDEX = re.compile(r"create\s+(unique\s+)?index\s+`?(\w+)`?\s+on\s+`?(\w+)`?\s*\((.*)\)\s*$", re.IGNORECASE | re.DOTALL)
+
+
+class MigrationException(Exception):
+    pass
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    sql: str
+
+    def statements(self) -> List[str]:
+        # Comment lines are dropped, and a statement ends at a ; that ends a line
+        lines = [line for line in self.sql.splitlines() if not line.strip().startswith("--")]
+        return [statement.strip() for statement in re.split(r";[ \t]*$", "\n".join(lines), flags=re.MULTILINE) if statement.strip() != ""]
+
+
+def load_migrations(directory: str = MIGRATIONS_DIR) -> List[Migration]:
+    migrations = []
+    for file_name in os.listdir(directory):
+        match = re.fullmatch(r"(\d+)_(\w+)\.sql", file_name)
+        if match is not None:
+            with open(os.path.join(directory, file_name)) as f:
+                migrations.append(Migration(int(match.group(1)), match.group(2), f.read()))
+    migrations.sort(key=lambda migration: migration.version)
+
+    versions = [migration.version for migration in migrations]
+    if len(set(versions)) != len(versions):
+        raise MigrationException(f"More than one migration has the same version: {sorted({version for version in versions if versions.count(version) > 1})}")
+    return migrations
+
+
+def applied_versions(dao: DaoImpl) -> Optional[Set[int]]:
+    """None if the database has never been migrated with this script"""
+    if not table_exists(dao, "schema_migrations"):
+        return None
+    return set(dao.get_list(int, "select version from schema_migrations"))
+
+
+def apply(dao: DaoImpl, migrations: List[Migration]) -> List[Migration]:
+    """Applies the pending migrations, oldest first, and returns them"""
+    applied = applied_versions(dao)
+    if applied is None and table_exists(dao, "users"):
+        raise MigrationException("This database predates schema_migrations. Mark the migrations it already has with `baseline VERSION` first")
+    create_schema_migrations(dao)
+
+    pending = [migration for migration in migrations if migration.version not in (applied or set())]
+    for migration in pending:
+        print(f"Applying {migration.version:03d}_{migration.name}")
+        # MySQL commits DDL as it goes, so a migration can't be wrapped in a transaction. It's only recorded once every statement has run
+        for statement in migration.statements():
+            run_statement(dao, statement)
+        dao.execute("insert into schema_migrations (version, name) values (%s, %s)", migration.version, migration.name)
+    return pending
+
+
+def baseline(dao: DaoImpl, migrations: List[Migration], version: int):
+    """Records every migration up to and including version as applied, without running them"""
+    create_schema_migrations(dao)
+    for migration in migrations:
+        if migration.version <= version:
+            dao.execute("insert ignore into schema_migrations (version, name) values (%s, %s)", migration.version, migration.name)
+
+
+def run_statement(dao: DaoImpl, statement: str):
+    existing_index = find_equivalent_index(dao, statement)
+    if existing_index is not None:
+        print(f"  Skipping, already applied: {existing_index} has the same columns")
+        return
+    try:
+        with dao.cursor() as cur:
+            # No args, so that the % in statements like date_format(date, '%Y-%m-01') is left alone
+            cur.execute(statement)
+    except pymysql.err.MySQLError as e:
+        if len(e.args) == 0 or e.args[0] not in ALREADY_APPLIED_ERRORS:
+            raise
+        print(f"  Skipping, already applied: {e.args[1] if len(e.args) > 1 else e}")
+
+
+def find_equivalent_index(dao: DaoImpl, statement: str) -> Optional[str]:
+    """For a create index, the name of an index the table already has on the same columns (that's unique too, if the new one is)"""
+    match = CREATE_INDEX.match(statement.strip())
+    if match is None:
+        return None
+    unique, table, columns = match.group(1) is not None, match.group(3), index_columns(match.group(4))
+    indexes = dao.get_list(
+        lambda index_name, non_unique, existing_columns: (index_name, non_unique == 0, existing_columns),
+        "select index_name, max(non_unique), group_concat(column_name order by seq_in_index) from information_schema.statistics "
+        "where table_schema = database() and table_name = %s group by index_name",
+        table,
+    )
+    return next((index_name for index_name, index_unique, existing in indexes if existing.lower() == ",".join(columns) and (index_unique or not unique)), None)
+
+
+def index_columns(columns: str) -> Tuple[str, ...]:
+    # Just the column names, without any prefix lengths or asc/desc
+    return tuple(re.match(r"\s*`?(\w+)", column).group(1).lower() for column in re.split(r",(?![^(]*\))", columns))
+
+
+def create_schema_migrations(dao: DaoImpl):
+    dao.execute("create table if not exists schema_migrations (version int not null primary key, name varchar(255) not null, applied_at datetime(6) not null default current_timestamp(6))")
+
+
+def table_exists(dao: DaoImpl, table: str) -> bool:
+    return dao.get_one(lambda count: count > 0, "select count(*) from information_schema.tables where table_schema = database() and table_name = %s", table)
+
+
+def main(argv=None, dao: DaoImpl = None, migrations: List[Migration] = None) -> int:
+    parser = argparse.ArgumentParser(description="Apply versioned schema migrations")
+    parser.add_argument("command", choices=["apply", "status", "baseline"])
+    parser.add_argument("version", nargs="?", type=int, help="For baseline: the last version the database already has")
+    args = parser.parse_args(argv)
+    dao = dao if dao is not None else DaoImpl()
+    migrations = migrations if migrations is not None else load_migrations()
+
+    try:
+        if args.command == "apply":
+            applied = apply(dao, migrations)
+            print(f"Applied {len(applied)} migration(s)")
+        elif args.command == "baseline":
+            if args.version is None:
+                parser.error("baseline needs the last version the database already has")
+            baseline(dao, migrations, args.version)
+            print(f"Marked migrations up to {args.version:03d} as applied")
+        else:
+            applied = applied_versions(dao) or set()
+            for migration in migrations:
+                print(f"{'applied' if migration.version in applied else 'pending':<8} {migration.version:03d}_{migration.name}")
+    except MigrationException as e:
+        print(e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
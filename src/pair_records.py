@@ -0,0 +1,25 @@
+"""
+Recomputes the pair_records table from the live matches. Connects with the same DB_* environment variables as the Lambda.
+Migration 010 fills the table in to begin with, and create_match/delete_match/delete_player keep it up to date, so this is only for repairing it.
+
+    venv/bin/python src/pair_records.py [--user USER_ID]
+"""
+import argparse
+import sys
+
+from da import Dao, DaoImpl
+
+
+def main(argv=None, dao: Dao = None) -> int:
+    parser = argparse.ArgumentParser(description="Rebuild the pair_records table")
+    parser.add_argument("--user", help="Only this user's records (default: everyone's)")
+    args = parser.parse_args(argv)
+    dao = dao if dao is not None else DaoImpl()
+
+    dao.rebuild_pair_records(args.user)
+    print("Rebuilt pair records")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
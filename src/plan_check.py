@@ -0,0 +1,183 @@
+"""
+Runs DaoImpl's request paths against a scratch database and EXPLAINs every query they send, flagging the ones that scan a whole table.
+Connects with the same DB_* environment variables as the Lambda. Point those at a local database (never a real one) that `migrate.py apply` has built.
+
+    venv/bin/python src/plan_check.py [--users 5] [--matches 100]
+
+The data is seeded for several users, since the optimizer will happily scan a table that holds nothing but the one user being queried. It's all
+deleted again afterwards.
+"""
+import argparse
+import random
+import sys
+import uuid
+from contextlib import contextmanager
+from dataclasses import replace
+from datetime import datetime, timedelta
+from typing import List, Tuple, Dict, Any, Optional
+
+from da import DaoImpl
+from domain.match import Match, GameScore, Stat, MatchFilter, MatchQuery, MatchCursor
+from domain.pair import OPPONENT, PARTNER
+from domain.player import Player
+from domain.rating import PlayerRating
+from domain.stats import StatsQuery
+from domain.user import User
+from request_context import RequestContext
+
+# Statements that read tables. Inserts of literal values don't, and a plan for one says nothing
+EXPLAINABLE = ("select", "update", "delete")
+
+
+class RecordingCursor:
+    """Passes everything through to cur, remembering each statement (and the first row of args for an executemany)"""
+
+    def __init__(self, cur, statements: List[Tuple[str, Any]]):
+        self.cur = cur
+        self.statements = statements
+
+    def execute(self, sql, args=None):
+        self.statements.append((sql, args))
+        return self.cur.execute(sql, args)
+
+    def executemany(self, sql, args):
+        self.statements.append((sql, args[0] if len(args) > 0 else None))
+        return self.cur.executemany(sql, args)
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+
+class RecordingDaoImpl(DaoImpl):
+    def __init__(self):
+        super().__init__()
+        self.statements: List[Tuple[str, Any]] = []
+
+    @contextmanager
+    def cursor(self):
+        with super().cursor() as cur:
+            yield RecordingCursor(cur, self.statements)
+
+
+def explain(dao: DaoImpl, sql: str, args=None) -> List[Dict[str, Any]]:
+    """One dict (id, select_type, table, type, possible_keys, key, rows, Extra...) per step of the plan"""
+    with dao.cursor() as cur:
+        cur.execute(f"explain {sql}", args)
+        columns = [column[0] for column in cur.description]
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def full_scans(plan: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Derived tables (<derived2>, <union1,2>...) are the output of another step, which is checked on its own
+    return [step for step in plan if step.get("type") == "ALL" and step.get("table") is not None and not step["table"].startswith("<")]
+
+
+def check(dao: DaoImpl, statements: List[Tuple[str, Any]]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Every (sql, plan step) that scans a whole table, once per distinct statement"""
+    flagged = []
+    # Copied, since the EXPLAINs below go through the same dao
+    statements = list(statements)
+    for sql in dict.fromkeys(sql for sql, _ in statements):
+        if not sql.strip().lower().startswith(EXPLAINABLE):
+            continue
+        args = next(args for statement_sql, args in statements if statement_sql == sql)
+        for step in full_scans(explain(dao, sql, args)):
+            flagged.append((sql, step))
+    return flagged
+
+
+def seed(dao: DaoImpl, user_count: int, match_count: int) -> List[Tuple[User, List[Player], List[Match]]]:
+    rng = random.Random(42)
+    context = RequestContext()
+    seeded = []
+    for i in range(user_count):
+        user = User(f"__PLAN{i}", f"__plan_fb{i}", "Plan", f"Check{i}", None)
+        dao.create_user(context, user)
+        players = [dao.create_player(context, Player(str(uuid.uuid4()), user.user_id, j == 0, None, "Player", str(j))) for j in range(8)]
+        matches = []
+        for j in range(match_count):
+            doubles = rng.random() < 0.7
+            team_players = rng.sample(players, 4 if doubles else 2)
+            scores = [GameScore(11, rng.randint(0, 9)) if rng.random() < 0.5 else GameScore(rng.randint(0, 9), 11) for _ in range(rng.choice([1, 3]))]
+            stats = [Stat(None, rng.choice(team_players).player_id, rng.randrange(len(scores)), rng.choice(["WINNER", "ERROR"]), rng.choice(["DROP", "DINK", "DRIVE"]), rng.choice(["FOREHAND", None]))
+                     for _ in range(10)]
+            matches.append(dao.create_match(context, Match(
+                str(uuid.uuid4()), user.user_id, datetime(2020, 1, 1) + timedelta(hours=j),
+                team_players[0], team_players[2] if doubles else None, team_players[1], team_players[3] if doubles else None, scores, stats
+            )))
+        seeded.append((user, players, matches))
+    for table in ["users", "players", "matches", "stats", "stat_rollups", "pair_records", "player_ratings", "match_players"]:
+        dao.get_list(lambda *row: row, f"analyze table {table}")
+    return seeded
+
+
+def exercise(dao: DaoImpl, user: User, players: List[Player], matches: List[Match]):
+    """Every request path's reads and writes, for one seeded user"""
+    player, partner, opponent = players[0], players[1], players[2]
+    latest = sorted(matches, key=lambda match: (match.date, match.match_id))[-1]
+    context = RequestContext()
+    dao.get_user(context, user.user_id)
+    dao.user_cache.clear()
+    dao.get_user_by_firebase_id(context, user.firebase_id)
+    dao.get_data_version(context, user.user_id)
+    dao.get_players(context, user.user_id)
+    dao.get_player_changes(context, user.user_id, None)
+    dao.get_player_changes(context, user.user_id, datetime(2020, 1, 1))
+    dao.get_player(context, player.player_id)
+    dao.get_player_stats(context, user.user_id, player.player_id)
+    dao.get_player_stats(context, user.user_id, player.player_id, StatsQuery(start=datetime(2020, 1, 1, 12)))
+    dao.get_player_stats(context, user.user_id, player.player_id, StatsQuery(match_ids=frozenset([latest.match_id])))
+    dao.get_matches(context, user.user_id)
+    dao.get_matches(context, user.user_id, MatchQuery(frozenset(["match_id", "date", "scores"])))
+    for match_filter in [MatchFilter(), MatchFilter(start=datetime(2020, 1, 2), format="doubles"), MatchFilter(player_id=player.player_id),
+                         MatchFilter(player_id=player.player_id, partner_id=partner.player_id, opponent_id=opponent.player_id)]:
+        dao.get_matches(context, user.user_id, match_filter=match_filter)
+        dao.get_match_page(context, user.user_id, 10, MatchCursor(latest.date, latest.match_id), match_filter=match_filter)
+    dao.get_match_changes(context, user.user_id, None)
+    dao.get_match_changes(context, user.user_id, datetime(2020, 1, 1))
+    # A new request, so the match is read rather than found in the identity map
+    context = RequestContext()
+    dao.get_match(context, latest.match_id)
+    dao.get_latest_match(context, user.user_id, excluding_match_id=latest.match_id)
+    dao.get_ratings(context, user.user_id)
+    dao.save_ratings(context, user.user_id, [PlayerRating(player.player_id, 1500.0, 1)])
+    dao.get_ratings(context, user.user_id, [player.player_id])
+    dao.get_pair_records(context, player.player_id, OPPONENT)
+    dao.get_pair_records(context, player.player_id, PARTNER)
+    dao.update_player(context, player.player_id, replace(player, notes="checked"))
+    dao.delete_match(context, latest.match_id)
+    dao.delete_player(context, opponent.player_id)
+
+
+def clean_up(dao: DaoImpl, user_ids: List[str]):
+    for table in ["stat_rollups", "pair_records", "player_ratings", "match_players"]:
+        dao.execute(f"delete from {table} where user_id in %s", tuple(user_ids))
+    # Cascades to everything else
+    dao.execute("delete from users where id in %s", tuple(user_ids))
+
+
+def main(argv=None, dao: Optional[RecordingDaoImpl] = None) -> int:
+    parser = argparse.ArgumentParser(description="Flag DaoImpl queries that scan a whole table")
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--matches", type=int, default=100, help="Per user")
+    args = parser.parse_args(argv)
+    dao = dao if dao is not None else RecordingDaoImpl()
+
+    seeded = seed(dao, args.users, args.matches)
+    try:
+        dao.statements.clear()
+        user, players, matches = seeded[0]
+        exercise(dao, user, players, matches)
+        statements = list(dao.statements)
+        flagged = check(dao, statements)
+    finally:
+        clean_up(dao, [user.user_id for user, _, _ in seeded])
+
+    for sql, step in flagged:
+        print(f"FULL SCAN of {step['table']} (possible keys: {step.get('possible_keys') or 'none'}, ~{step.get('rows')} rows):\n    {' '.join(sql.split())}")
+    print(f"{len(flagged)} full table scan(s) in {len({sql for sql, _ in statements})} distinct statement(s)")
+    return 1 if len(flagged) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,33 @@
+"""
+Recomputes the player_ratings table by replaying each user's live matches. Connects with the same DB_* environment variables as the Lambda.
+
+    venv/bin/python src/player_ratings.py [--user USER_ID]
+
+create_match only moves the ratings of the new match's players, starting from the ratings they already have, so the table has to be filled in once
+for the history that predates it (see migrations/005_player_ratings.sql) before the API starts rating new matches.
+"""
+import argparse
+import sys
+
+import ratings
+from bl import RATINGS_QUERY
+from da import Dao, DaoImpl
+from request_context import RequestContext
+
+
+def main(argv=None, dao: Dao = None) -> int:
+    parser = argparse.ArgumentParser(description="Rebuild the player_ratings table")
+    parser.add_argument("--user", help="Only this user's ratings (default: everyone's)")
+    args = parser.parse_args(argv)
+    dao = dao if dao is not None else DaoImpl()
+
+    user_ids = [args.user] if args.user is not None else dao.get_match_user_ids()
+    for user_id in user_ids:
+        context = RequestContext()
+        dao.save_ratings(context, user_id, ratings.replay(dao.get_matches(context, user_id, RATINGS_QUERY)), replace_all=True)
+    print(f"Replayed the ratings of {len(user_ids)} user(s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""
+Elo-style player ratings, computed from a user's match history in date order.
+
+A team's rating is the average of its players'. After each match, every player on a team moves by the same amount (and the other team by the
+opposite amount): K_FACTOR * margin multiplier * (actual score - expected score). The actual score is 1, 0.5 or 0 by games won. The margin multiplier
+grows with the points won per game, so an 11-0 sweep moves ratings further than an 11-9 squeaker.
+"""
+import math
+from typing import List, Dict, Tuple, Iterable
+
+from domain.match import Match
+from domain.rating import PlayerRating
+
+INITIAL_RATING = 1500.0
+K_FACTOR = 24.0
+
+
+def match_result(match: Match) -> Tuple[float, float]:
+    """Team 1's actual score, and the margin multiplier"""
+    outcome = match.outcome()
+    actual = {1: 1.0, 2: 0.0, None: 0.5}[outcome.winning_team]
+    point_margin = abs(outcome.team1_points - outcome.team2_points) / max(len(match.scores), 1)
+    return actual, math.log(2 + point_margin)
+
+
+def rating_change(team1_rating: float, team2_rating: float, actual: float, margin: float) -> float:
+    """How far each team 1 player moves (team 2 players move the opposite way)"""
+    expected = 1 / (1 + 10 ** ((team2_rating - team1_rating) / 400))
+    return K_FACTOR * margin * (actual - expected)
+
+
+def team_ids(match: Match) -> Tuple[List[str], List[str]]:
+    return ([player.player_id for player in [match.team1_player1, match.team1_player2] if player is not None],
+            [player.player_id for player in [match.team2_player1, match.team2_player2] if player is not None])
+
+
+def apply_match(ratings: Dict[str, PlayerRating], match: Match) -> List[PlayerRating]:
+    """The new ratings of the match's players, given their ratings before it (players missing from ratings haven't played yet)"""
+    team1, team2 = team_ids(match)
+    before = {player_id: ratings.get(player_id, PlayerRating(player_id, INITIAL_RATING, 0)) for player_id in team1 + team2}
+    delta = rating_change(
+        sum(before[player_id].rating for player_id in team1) / len(team1),
+        sum(before[player_id].rating for player_id in team2) / len(team2),
+        *match_result(match)
+    )
+    return [PlayerRating(player_id, before[player_id].rating + (delta if player_id in team1 else -delta), before[player_id].matches_played + 1) for player_id in team1 + team2]
+
+
+def replay(matches: Iterable[Match]) -> List[PlayerRating]:
+    """
+    Every player's rating after the whole history, from scratch. Used when a match lands before others that were already rated, or one is deleted.
+    Each match's actual score and margin are computed up front for the whole history as arrays. Only the rating updates themselves are sequential, and
+    those run over flat lists indexed by small player codes (plain list indexing beats NumPy's for scalar access) rather than objects and dicts.
+    """
+    # Only replays need numpy, so the API's cold start doesn't pay for it
+    import numpy as np
+
+    matches = sorted(matches, key=lambda match: (match.date, match.match_id))
+    codes: Dict[str, int] = {}
+    slots = [[codes.setdefault(player.player_id, len(codes)) if player is not None else -1 for player in [match.team1_player1, match.team1_player2, match.team2_player1, match.team2_player2]]
+             for match in matches]
+
+    # Same as match_result, for every match at once
+    game_matches = np.array([i for i, match in enumerate(matches) for _ in match.scores], dtype=np.int64)
+    team1_points = np.array([score.team1_score for match in matches for score in match.scores], dtype=np.float64)
+    team2_points = np.array([score.team2_score for match in matches for score in match.scores], dtype=np.float64)
+    team1_games = np.bincount(game_matches, weights=team1_points > team2_points, minlength=len(matches))
+    team2_games = np.bincount(game_matches, weights=team2_points > team1_points, minlength=len(matches))
+    actuals = np.where(team1_games > team2_games, 1.0, np.where(team2_games > team1_games, 0.0, 0.5)).tolist()
+    point_margins = np.abs(np.bincount(game_matches, weights=team1_points - team2_points, minlength=len(matches))) / np.maximum(np.bincount(game_matches, minlength=len(matches)), 1)
+    scales = (K_FACTOR * np.log(2 + point_margins)).tolist()
+
+    ratings = [INITIAL_RATING] * len(codes)
+    played = [0] * len(codes)
+    for (team1_player1, team1_player2, team2_player1, team2_player2), actual, scale in zip(slots, actuals, scales):
+        team1_rating = (ratings[team1_player1] + ratings[team1_player2]) / 2 if team1_player2 >= 0 else ratings[team1_player1]
+        team2_rating = (ratings[team2_player1] + ratings[team2_player2]) / 2 if team2_player2 >= 0 else ratings[team2_player1]
+        # rating_change, inlined since this runs once per match
+        delta = scale * (actual - 1 / (1 + 10 ** ((team2_rating - team1_rating) / 400)))
+        for p, change in [(team1_player1, delta), (team1_player2, delta), (team2_player1, -delta), (team2_player2, -delta)]:
+            if p >= 0:
+                ratings[p] += change
+                played[p] += 1
+    return [PlayerRating(player_id, ratings[code], played[code]) for player_id, code in codes.items()]
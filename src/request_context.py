@@ -0,0 +1,41 @@
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any
+
+from domain.user import User
+from metrics import RequestMetrics
+
+
+class IdentityMap:
+    """Rows that have already been loaded or written during the current request, keyed by table and id"""
+
+    def __init__(self):
+        self.rows: Dict[str, Dict[str, Any]] = {}
+
+    def get(self, table: str, key: str) -> Optional[Any]:
+        return self.rows.get(table, {}).get(key)
+
+    def put(self, table: str, key: str, row: Any):
+        self.rows.setdefault(table, {})[key] = row
+
+    def evict(self, table: str, key: str):
+        self.rows.get(table, {}).pop(key, None)
+
+    def evict_all(self, table: str):
+        self.rows.pop(table, None)
+
+    def clear(self):
+        self.rows = {}
+
+
+@dataclass(eq=False)
+class RequestContext:
+    """
+    Everything that belongs to a single request. Handler.handle creates one per event and passes it to every Manager call, which passes it on to every
+    Dao call. The Handler, ManagerImpl and DaoImpl themselves only hold what's safe to share between requests (and threads).
+    """
+    # Set by Manager.validate_token. None for an unauthenticated request
+    user: Optional[User] = None
+    # Rows are only trusted for the lifetime of a single request. Warm invocations must see other containers' writes
+    identity_map: IdentityMap = field(default_factory=IdentityMap)
+    # Logged as one line when the request is done. See metrics.py
+    metrics: RequestMetrics = field(default_factory=RequestMetrics)
@@ -0,0 +1,247 @@
+"""
+Serves the API over plain HTTP from a long-running process, for hosts that stay warm instead of Lambda.
+Each request is turned into the API Gateway event Lambda would have been handed, and run through the same Handler. Connects with the same DB_*
+environment variables as the Lambda.
+
+    venv/bin/python src/server.py [--host 0.0.0.0] [--port 8080] [--workers 8] [--db-pool-size WORKERS] [--asyncio]
+
+Requests are served by a fixed pool of worker threads that share one Handler, and so one DB connection pool and the user and token caches. A worker
+only holds a connection while it's running a query, so the DB pool defaults to one connection per worker.
+
+With --asyncio, requests are instead served from one event loop by an AsyncHandler, so the number in flight isn't capped by a worker count. Only their
+queries take a thread, from a pool with one per DB connection (--db-pool-size, still defaulting to --workers).
+"""
+import argparse
+import asyncio
+import re
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from http import HTTPStatus
+from typing import Optional, Dict, Tuple, List
+from urllib.parse import urlsplit, parse_qsl, unquote
+
+from async_bl import AsyncManagerImpl
+from async_da import AsyncDaoImpl
+from async_handler import AsyncHandler
+from bl import ManagerImpl
+from connection_pool import ConnectionPool
+from da import DaoImpl
+from firebase_client import FirebaseClientImpl
+from handler import Handler, RESOURCES
+
+# Literal resources first, so /matches/batch isn't taken for the match with an id of "batch"
+RESOURCE_PATTERNS: List[Tuple[str, re.Pattern]] = [
+    (resource, re.compile("^" + re.sub(r"\\{(\w+)\\}", r"(?P<\1>[^/]+)", re.escape(resource)) + "$"))
+    for resource in sorted(RESOURCES, key=lambda resource: resource.count("{"))
+]
+
+
+def match_resource(path: str) -> Optional[Tuple[str, Dict[str, str]]]:
+    """The resource the path belongs to and its path parameters, or None if it's not part of the API"""
+    path = path.rstrip("/") or "/"
+    for resource, pattern in RESOURCE_PATTERNS:
+        match = pattern.match(path)
+        if match is not None:
+            return resource, {name: unquote(value) for name, value in match.groupdict().items()}
+    return None
+
+
+def to_event(method: str, url: str, headers: Dict[str, str], body: Optional[bytes]) -> Optional[Dict]:
+    """The API Gateway (REST API proxy integration) event for a request, or None if the path isn't part of the API"""
+    parts = urlsplit(url)
+    matched = match_resource(parts.path)
+    if matched is None:
+        return None
+    resource, path_params = matched
+    # Like API Gateway, a repeated query parameter keeps its last value, and missing params and bodies are None rather than empty
+    query_params = dict(parse_qsl(parts.query, keep_blank_values=True))
+    return {
+        "resource": resource,
+        "path": parts.path,
+        "httpMethod": method,
+        "headers": headers,
+        "queryStringParameters": query_params or None,
+        "pathParameters": path_params or None,
+        "body": body.decode("utf-8") if body else None,
+        "isBase64Encoded": False,
+    }
+
+
+def to_http_response(response: Dict) -> Tuple[int, List[Tuple[str, str]], bytes]:
+    """The status, headers and body to send back for a Handler response"""
+    body = response["body"].encode("utf-8") if response.get("body") is not None else b""
+    headers = list((response.get("headers") or {}).items())
+    if len(body) > 0:
+        headers.append(("Content-Type", "application/json"))
+    headers.append(("Content-Length", str(len(body))))
+    return response["statusCode"], headers, body
+
+
+NOT_FOUND = {"statusCode": 404, "body": '{"error": "Not found"}'}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server: "PooledHTTPServer"
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def do_PUT(self):
+        self.respond()
+
+    def do_DELETE(self):
+        self.respond()
+
+    def respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        event = to_event(self.command, self.path, dict(self.headers.items()), self.rfile.read(length) if length > 0 else None)
+        status, headers, body = to_http_response(self.server.handler.handle(event) if event is not None else NOT_FOUND)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # The handler already logs every request
+        pass
+
+
+class PooledHTTPServer(HTTPServer):
+    """Hands each connection to a fixed pool of worker threads, rather than starting a thread per connection like ThreadingHTTPServer"""
+    # socketserver's default backlog of 5 drops connections under any real concurrency, and a dropped SYN is only retried after a second
+    request_queue_size = 128
+
+    def __init__(self, address: Tuple[str, int], handler: Handler, workers: int):
+        super().__init__(address, RequestHandler)
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="worker")
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        # The same as ThreadingMixIn's
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+class AsyncHTTPServer:
+    """
+    Serves every connection from the event loop it's started on. Like BaseHTTPRequestHandler (which the threaded server uses), it speaks HTTP/1.0: one
+    request per connection
+    """
+
+    # Sized for hundreds of connections arriving at once, since none of them has to wait for a free worker once accepted
+    request_queue_size = 1024
+
+    def __init__(self, handler: AsyncHandler):
+        self.handler = handler
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def server_port(self) -> int:
+        return self.server.sockets[0].getsockname()[1]
+
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(self.serve_connection, host, port, backlog=self.request_queue_size)
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                method, url, headers, body = await self.read_request(reader)
+            except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                response = {"statusCode": 400, "body": '{"error": "Bad request"}'}
+            else:
+                event = to_event(method, url, headers, body)
+                try:
+                    response = await self.handler.handle(event) if event is not None else NOT_FOUND
+                except Exception:
+                    traceback.print_exc()
+                    response = {"statusCode": 500, "body": '{"error": "Internal server error"}'}
+
+            status, response_headers, response_body = to_http_response(response)
+            writer.write(f"HTTP/1.0 {status} {HTTPStatus(status).phrase}\r\n".encode("latin-1"))
+            writer.write("".join(f"{name}: {value}\r\n" for name, value in response_headers + [("Connection", "close")]).encode("latin-1") + b"\r\n")
+            writer.write(response_body)
+            await writer.drain()
+        except ConnectionError:
+            # The client went away. There's no one to answer
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_request(reader: asyncio.StreamReader) -> Tuple[str, str, Dict[str, str], Optional[bytes]]:
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+        request_line, *header_lines = head.split("\r\n")
+        method, url, _ = request_line.split(" ")
+        headers = {}
+        for line in header_lines:
+            if line != "":
+                name, value = line.split(":", 1)
+                headers[name.strip()] = value.strip()
+        length = int({name.lower(): value for name, value in headers.items()}.get("content-length") or 0)
+        return method, url, headers, await reader.readexactly(length) if length > 0 else None
+
+
+def create_handler(db_pool_size: int) -> Handler:
+    return Handler(ManagerImpl(FirebaseClientImpl(), DaoImpl(ConnectionPool(max_size=db_pool_size))))
+
+
+def create_async_handler(db_pool_size: int) -> AsyncHandler:
+    return AsyncHandler(AsyncManagerImpl(FirebaseClientImpl(), AsyncDaoImpl(DaoImpl(ConnectionPool(max_size=db_pool_size)))))
+
+
+async def serve_async(host: str, port: int, db_pool_size: int):
+    server = AsyncHTTPServer(create_async_handler(db_pool_size))
+    await server.start(host, port)
+    print(f"Serving on {host}:{server.server_port} from an event loop with {db_pool_size} DB connection(s)")
+    async with server.server:
+        await server.server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the API over HTTP with a pool of worker threads")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--db-pool-size", type=int, help="Default: one connection per worker")
+    parser.add_argument("--asyncio", action="store_true", help="Serve from an event loop instead of the worker threads")
+    args = parser.parse_args(argv)
+
+    if args.asyncio:
+        try:
+            asyncio.run(serve_async(args.host, args.port, args.db_pool_size or args.workers))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    server = PooledHTTPServer((args.host, args.port), create_handler(args.db_pool_size or args.workers), args.workers)
+    print(f"Serving on {args.host}:{server.server_port} with {args.workers} worker(s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+Recomputes the stat_rollups table from the raw stats rows, and/or checks that the two agree.
+Connects with the same DB_* environment variables as the Lambda.
+
+    venv/bin/python src/stat_rollups.py rebuild [--user USER_ID]
+    venv/bin/python src/stat_rollups.py verify [--user USER_ID]
+"""
+import argparse
+import sys
+
+from da import Dao, DaoImpl
+
+
+def main(argv=None, dao: Dao = None) -> int:
+    parser = argparse.ArgumentParser(description="Rebuild or verify the stat_rollups table")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    parser.add_argument("--user", help="Only this user's rollups (default: everyone's)")
+    args = parser.parse_args(argv)
+    dao = dao if dao is not None else DaoImpl()
+
+    if args.command == "rebuild":
+        dao.rebuild_stat_rollups(args.user)
+        print("Rebuilt stat rollups")
+
+    # A rebuild is verified too, which catches a create_match or delete_match that raced with it
+    mismatches = dao.verify_stat_rollups(args.user)
+    for user_id, player_id, month, shot_type, shot_side, shot_result, counted, rolled_up in mismatches:
+        print(f"MISMATCH user={user_id} player={player_id} month={month} {shot_type}/{shot_side or '-'}/{shot_result}: {counted} in stats, {rolled_up} rolled up")
+    print(f"{len(mismatches)} mismatched rollup(s)")
+    return 1 if len(mismatches) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
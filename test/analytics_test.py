@@ -0,0 +1,79 @@
+import unittest
+from dataclasses import replace
+from datetime import datetime
+
+import analytics
+from analytics import History, Record, ShotRecord
+from domain.match import Match, GameScore, Stat
+from test import fixtures
+
+
+def player(player_id): return replace(fixtures.player(), player_id=player_id)
+
+
+def match(team1, team2, scores, stats=()):
+    return Match("match", "user", datetime(2020, 1, 1), player(team1[0]), player(team1[1]) if len(team1) > 1 else None, player(team2[0]), player(team2[1]) if len(team2) > 1 else None,
+                 [GameScore(*score) for score in scores], list(stats))
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.history = History.from_matches([
+            # a beats b in singles, 2 games to 1
+            match(["a"], ["b"], [(11, 5), (8, 11), (11, 9)], [
+                Stat("match", "a", 0, "WINNER", "DROP", "FOREHAND"),
+                Stat("match", "a", 0, "ERROR", "DROP", "BACKHAND"),
+                Stat("match", "a", 2, "WINNER", "LOB", None),
+                Stat("match", "b", 1, "ERROR", "SERVE", None),
+            ]),
+            # b and c beat a and d
+            match(["a", "d"], ["b", "c"], [(3, 11)], [
+                Stat("match", "c", 0, "WINNER", "DROP", "FOREHAND"),
+                Stat("match", "a", 0, "NEUTRAL", "DROP", "FOREHAND"),
+            ]),
+            # A tie is played, but nobody wins it
+            match(["a", "c"], ["b", "d"], [(11, 5), (5, 11)]),
+        ])
+
+    def test_win_rates(self):
+        rates = analytics.win_rates(self.history)
+        self.assertEqual({"a": Record(1, 3), "b": Record(1, 3), "c": Record(1, 2), "d": Record(0, 2)}, rates)
+        self.assertAlmostEqual(1 / 3, rates["a"].rate)
+
+    def test_shot_efficiency(self):
+        self.assertEqual({
+            "a": {"DROP": ShotRecord(1, 1), "LOB": ShotRecord(1, 0)},
+            "b": {"SERVE": ShotRecord(0, 1)},
+            "c": {"DROP": ShotRecord(1, 0)},
+        }, analytics.shot_efficiency(self.history))
+        self.assertEqual(0.5, ShotRecord(1, 1).efficiency)
+        self.assertIsNone(ShotRecord(0, 0).efficiency)
+
+    def test_game_splits(self):
+        self.assertEqual({
+            "a": {0: ShotRecord(1, 1), 2: ShotRecord(1, 0)},
+            "b": {1: ShotRecord(0, 1)},
+            "c": {0: ShotRecord(1, 0)},
+        }, analytics.game_splits(self.history))
+
+    def test_partner_records(self):
+        self.assertEqual({
+            "a": {"d": Record(0, 1), "c": Record(0, 1)},
+            "d": {"a": Record(0, 1), "b": Record(0, 1)},
+            "b": {"c": Record(1, 1), "d": Record(0, 1)},
+            "c": {"b": Record(1, 1), "a": Record(0, 1)},
+        }, analytics.partner_records(self.history))
+
+    def test_opponent_records(self):
+        records = analytics.opponent_records(self.history)
+        self.assertEqual({"b": Record(1, 3), "c": Record(0, 1), "d": Record(0, 1)}, records["a"])
+        self.assertEqual({"a": Record(1, 3), "d": Record(1, 1), "c": Record(0, 1)}, records["b"])
+        self.assertEqual({"a": Record(1, 1), "d": Record(1, 2), "b": Record(0, 1)}, records["c"])
+
+    def test_empty_history(self):
+        history = History.from_matches([])
+        self.assertEqual({}, analytics.win_rates(history))
+        self.assertEqual({}, analytics.shot_efficiency(history))
+        self.assertEqual({}, analytics.game_splits(history))
+        self.assertEqual({}, analytics.partner_records(history))
+        self.assertEqual({}, analytics.opponent_records(history))
@@ -0,0 +1,112 @@
+import asyncio
+import inspect
+import unittest
+from dataclasses import replace
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+
+import ratings
+from async_bl import AsyncManager, AsyncManagerImpl
+from bl import Manager
+from async_da import AsyncDao
+from domain.exceptions import ServiceException
+from domain.match import MatchCursor, MatchQuery, GameScore
+from firebase_client import FirebaseClient
+from request_context import RequestContext
+from test import fixtures
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.manager = AsyncManagerImpl(FirebaseClient(), AsyncDao())
+        self.context = RequestContext()
+
+    def test_same_methods_as_manager(self):
+        # Handler and AsyncHandler share their routes, so every manager method has to be there in both, taking the same arguments
+        for name, method in inspect.getmembers(Manager, inspect.isfunction):
+            self.assertTrue(inspect.iscoroutinefunction(getattr(AsyncManager, name)), name)
+            self.assertEqual(list(inspect.signature(method).parameters), list(inspect.signature(getattr(AsyncManager, name)).parameters), name)
+
+    async def test_validate_token(self):
+        await self.manager.validate_token(self.context, None)
+        self.assertIsNone(self.context.user)
+
+        with patch.object(self.manager.firebase_client, "get_firebase_user", return_value={}):
+            await self.manager.validate_token(self.context, "token")
+        self.assertIsNone(self.context.user)
+
+        with patch.object(self.manager.firebase_client, "get_firebase_user", return_value={"user_id": "fb1"}) as get_firebase_user_mock, \
+                patch.object(self.manager.dao, "get_user_by_firebase_id", return_value=fixtures.user()) as get_user_by_firebase_id_mock:
+            await self.manager.validate_token(self.context, "token")
+        get_firebase_user_mock.assert_called_once_with("token")
+        get_user_by_firebase_id_mock.assert_called_once_with(self.context, "fb1")
+        self.assertEqual(fixtures.user(), self.context.user)
+
+    async def test_first_login(self):
+        # The player can only be written once its user has been, so it mustn't get in while the user's insert is in flight
+        calls = MagicMock()
+
+        async def create_user(*args):
+            await asyncio.sleep(0)
+            calls.create_user(*args)
+
+        with patch.object(self.manager.firebase_client, "get_firebase_user", return_value={"user_id": "NEW_FB_ID", "name": "FIRST MIDDLE LAST", "email": "EMAIL", "picture": "PICTURE"}), \
+                patch.object(self.manager.dao, "get_user_by_firebase_id", return_value=None), \
+                patch.object(self.manager.dao, "create_user", side_effect=create_user), \
+                patch.object(self.manager.dao, "create_player", side_effect=lambda *args: calls.create_player(*args)):
+            await self.manager.validate_token(self.context, "token")
+        self.assertEqual(["create_user", "create_player"], [call[0] for call in calls.mock_calls])
+
+        user = calls.create_user.call_args.args[1]
+        self.assertEqual(user, self.context.user)
+        self.assertEqual(("NEW_FB_ID", "FIRST", "MIDDLE LAST"), (user.firebase_id, user.first_name, user.last_name))
+        player = calls.create_player.call_args.args[1]
+        self.assertEqual((user.user_id, True, "EMAIL"), (player.owner_user_id, player.is_owner, player.email))
+
+    async def test_require_auth(self):
+        with self.assertRaises(ServiceException) as e:
+            await self.manager.get_players(self.context)
+        self.assertEqual(401, e.exception.status_code)
+
+        self.context.user = fixtures.user()
+        with patch.object(self.manager.dao, "get_players", return_value=[fixtures.player()]) as get_players_mock:
+            self.assertEqual([fixtures.player()], await self.manager.get_players(self.context))
+        get_players_mock.assert_called_once_with(self.context, self.context.user.user_id)
+
+    async def test_delete_match(self):
+        self.context.user = fixtures.user()
+        with patch.object(self.manager.dao, "get_match", return_value=None):
+            with self.assertRaises(ServiceException) as e:
+                await self.manager.delete_match(self.context, "m1")
+        self.assertEqual(404, e.exception.status_code)
+
+        with patch.object(self.manager.dao, "get_match", return_value=replace(fixtures.match(), user_id="not you")), patch.object(self.manager.dao, "delete_match") as delete_match_mock:
+            with self.assertRaises(ServiceException) as e:
+                await self.manager.delete_match(self.context, "m1")
+        self.assertEqual(403, e.exception.status_code)
+        delete_match_mock.assert_not_called()
+
+    async def test_create_match_updates_ratings(self):
+        self.context.user = fixtures.user()
+        match = replace(fixtures.match(), team1_player1=replace(fixtures.player(), player_id="a"), team1_player2=None, team2_player1=replace(fixtures.player(), player_id="b"), team2_player2=None,
+                        scores=[GameScore(11, 5)])
+        earlier, later = MatchCursor(datetime(2019, 1, 1), "earlier"), MatchCursor(datetime(2021, 1, 1), "later")
+
+        with patch.object(self.manager.dao, "create_match", return_value=match), patch.object(self.manager.dao, "get_latest_match", return_value=earlier), \
+                patch.object(self.manager.dao, "apply_match_to_ratings") as apply_match_to_ratings_mock, patch.object(self.manager.dao, "save_ratings") as save_ratings_mock:
+            self.assertEqual(match, await self.manager.create_match(self.context, match))
+        apply_match_to_ratings_mock.assert_awaited_once_with(self.context, self.context.user.user_id, match)
+        save_ratings_mock.assert_not_called()
+
+        # A backdated match means replaying the history
+        with patch.object(self.manager.dao, "create_match", return_value=match), patch.object(self.manager.dao, "get_latest_match", return_value=later), \
+                patch.object(self.manager.dao, "apply_match_to_ratings") as apply_match_to_ratings_mock, patch.object(self.manager.dao, "get_matches", return_value=[match]) as get_matches_mock, \
+                patch.object(self.manager.dao, "save_ratings") as save_ratings_mock:
+            await self.manager.create_match(self.context, match)
+        apply_match_to_ratings_mock.assert_not_called()
+        get_matches_mock.assert_called_once_with(self.context, self.context.user.user_id, MatchQuery(frozenset(["match_id", "date", "team1", "team2", "scores"])))
+        save_ratings_mock.assert_called_once_with(self.context, self.context.user.user_id, ratings.replay([match]), replace_all=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
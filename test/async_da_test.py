@@ -0,0 +1,125 @@
+import asyncio
+import io
+import threading
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+import metrics
+from async_da import AsyncDaoImpl
+from connection_pool import ConnectionPool
+from da import DaoImpl, MatchDbDto
+from domain.exceptions import ServiceException
+from domain.match import MatchQuery, MatchFilter
+from domain.sync import Watermark
+from metrics import RequestMetrics
+from request_context import RequestContext
+from test import fixtures
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dao = DaoImpl(ConnectionPool(lambda: MagicMock(), max_size=3))
+        self.async_dao = AsyncDaoImpl(self.dao)
+        self.context = RequestContext()
+        self.match = fixtures.match()
+        # Both halves of a concurrent read have to reach it before either can carry on, so a read made one after the other would time out
+        self.barrier = threading.Barrier(2, timeout=5)
+
+    def tearDown(self):
+        self.async_dao.executor.shutdown()
+
+    def together(self, result):
+        def wait(*_):
+            self.barrier.wait()
+            return result
+        return wait
+
+    async def test_calls_run_off_the_event_loop(self):
+        threads = []
+
+        def get_players(context, owner_user_id):
+            threads.append(threading.current_thread())
+            return [fixtures.player()]
+
+        with patch.object(self.dao, "get_players", side_effect=get_players) as get_players_mock:
+            self.assertEqual([fixtures.player()], await self.async_dao.get_players(self.context, "1"))
+        get_players_mock.assert_called_once_with(self.context, "1")
+        self.assertNotEqual(threading.current_thread(), threads[0])
+
+        with patch.object(self.dao, "get_player", side_effect=ServiceException("Error getting data from database")):
+            with self.assertRaises(ServiceException) as e:
+                await self.async_dao.get_player(self.context, "1")
+        self.assertEqual(500, e.exception.status_code)
+
+    async def test_queries_are_counted_against_the_request(self):
+        request_metrics = RequestMetrics()
+        with patch.object(self.dao, "read", return_value=[("p1",), ("p2",)]), redirect_stdout(io.StringIO()), metrics.recording(request_metrics):
+            await asyncio.gather(self.async_dao.run(self.dao.get_list, str, "select id from players"), self.async_dao.run(self.dao.get_list, str, "select id from matches"))
+        self.assertEqual((2, 4), (request_metrics.db_round_trips, request_metrics.rows))
+
+    async def test_get_match_page(self):
+        with patch.object(self.dao, "get_match_dtos", return_value=[MatchDbDto.from_match(self.match)]) as get_match_dtos_mock, \
+                patch.object(self.dao, "get_players_by_ids", side_effect=self.together(self.match.players())) as get_players_by_ids_mock, \
+                patch.object(self.dao, "get_stats_by_match_ids", side_effect=self.together(self.match.stats)):
+            page = await self.async_dao.get_match_page(self.context, "1", 1, None)
+        self.assertEqual([self.match], page.matches)
+        self.assertIsNone(page.next_cursor)
+        self.assertEqual(MatchQuery(), get_match_dtos_mock.call_args.args[0])
+        self.assertEqual(MatchDbDto.from_match(self.match).player_ids(), get_players_by_ids_mock.call_args.args[1])
+
+    async def test_get_matches(self):
+        # The players are the ones the matches reference, so only the whole history's stats can be read alongside the matches
+        with patch.object(self.dao, "get_match_dtos", side_effect=self.together([MatchDbDto.from_match(self.match)])), \
+                patch.object(self.dao, "get_players_by_ids", return_value=self.match.players()) as get_players_by_ids_mock, \
+                patch.object(self.dao, "get_stats", side_effect=self.together(self.match.stats)):
+            self.assertEqual([self.match], await self.async_dao.get_matches(self.context, "1"))
+        self.assertEqual(MatchDbDto.from_match(self.match).player_ids(), get_players_by_ids_mock.call_args.args[1])
+
+        # A filtered list only needs the stats of the matches it found, so those wait for the matches too
+        with patch.object(self.dao, "get_match_dtos", return_value=[MatchDbDto.from_match(self.match)]), \
+                patch.object(self.dao, "get_players_by_ids", side_effect=self.together(self.match.players())), \
+                patch.object(self.dao, "get_stats_by_match_ids", side_effect=self.together(self.match.stats)) as get_stats_by_match_ids_mock:
+            self.assertEqual([self.match], await self.async_dao.get_matches(self.context, "1", match_filter=MatchFilter(player_id="p1")))
+        get_stats_by_match_ids_mock.assert_called_once_with([self.match.match_id])
+
+        with patch.object(self.dao, "get_match_dtos", return_value=[]), patch.object(self.dao, "read") as read_mock:
+            self.assertEqual([], await self.async_dao.get_matches(self.context, "1", MatchQuery(frozenset(["match_id", "scores"]))))
+        read_mock.assert_not_called()
+
+    async def test_get_match(self):
+        with patch.object(self.dao, "get_match_dto", return_value=MatchDbDto.from_match(self.match)), \
+                patch.object(self.dao, "get_players_by_ids", side_effect=self.together(self.match.players())), \
+                patch.object(self.dao, "get_stats_by_match_ids", side_effect=self.together(self.match.stats)):
+            self.assertEqual(self.match, await self.async_dao.get_match(self.context, self.match.match_id))
+
+        # The identity map still answers repeat lookups within the request
+        with patch.object(self.dao, "get_match_dto") as get_match_dto_mock:
+            self.assertEqual(self.match, await self.async_dao.get_match(self.context, self.match.match_id))
+        get_match_dto_mock.assert_not_called()
+
+        with patch.object(self.dao, "get_match_dto", return_value=None):
+            self.assertIsNone(await self.async_dao.get_match(RequestContext(), "missing"))
+
+    async def test_get_changes(self):
+        watermark = Watermark(datetime(2020, 1, 1)).encode()
+        since = datetime(2019, 1, 1)
+        with patch.object(self.dao, "next_watermark", return_value=watermark), \
+                patch.object(self.dao, "get_changed_players", side_effect=self.together([fixtures.player()])) as get_changed_players_mock, \
+                patch.object(self.dao, "get_deleted_player_ids", side_effect=self.together(["p2"])):
+            changes = await self.async_dao.get_player_changes(self.context, "1", since)
+        self.assertEqual(([fixtures.player()], ["p2"], watermark), (changes.players, changes.deleted, changes.watermark))
+        get_changed_players_mock.assert_called_once_with("1", since)
+
+        with patch.object(self.dao, "next_watermark", return_value=watermark), \
+                patch.object(self.dao, "get_changed_match_dtos", side_effect=self.together([MatchDbDto.from_match(self.match)])), \
+                patch.object(self.dao, "get_deleted_match_ids", side_effect=self.together(["m2"])), \
+                patch.object(self.dao, "get_players_by_ids", return_value=self.match.players()), \
+                patch.object(self.dao, "get_stats_by_match_ids", return_value=self.match.stats):
+            changes = await self.async_dao.get_match_changes(self.context, "1", since)
+        self.assertEqual(([self.match], ["m2"], watermark), (changes.matches, changes.deleted, changes.watermark))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+import unittest
+from contextlib import ExitStack
+from unittest.mock import patch, MagicMock
+
+from async_bl import AsyncManager, AsyncManagerImpl
+from async_da import AsyncDaoImpl
+from async_handler import AsyncHandler
+from connection_pool import ConnectionPool
+from da import DaoImpl
+from domain.match import MatchPage
+from domain.stats import PlayerStats
+from firebase_client import FirebaseClient
+from handler import Handler
+from request_context import RequestContext
+from test import fixtures
+from test.handler_test import USER, SignedInManager, create_event
+
+
+class SignedInAsyncManager(AsyncManager):
+    """Authenticates every request as USER"""
+
+    async def validate_token(self, context: RequestContext, token: str):
+        context.user = USER
+
+
+class SignedInFirebaseClient(FirebaseClient):
+    def get_firebase_user(self, token: str):
+        return {"user_id": USER.firebase_id}
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.handler = AsyncHandler(SignedInAsyncManager())
+
+    async def test_routes_like_handler(self):
+        results = {
+            "get_data_version": 3,
+            "get_players": [fixtures.player()],
+            "get_player_stats": PlayerStats("p1", 0, []),
+            "get_matches": [fixtures.match()],
+            "get_match_page": MatchPage([fixtures.match()], "next"),
+            "create_player": fixtures.player(),
+            "delete_match": {},
+        }
+        events = [
+            create_event("/users", method="POST"),
+            create_event("/players"),
+            create_event("/players/{id}/stats", path_params={"id": "p1"}, query_params={"from": "2020-01-01T00:00:00Z"}),
+            create_event("/matches", query_params={"shape": "normalized"}),
+            create_event("/matches", query_params={"limit": "1"}),
+            create_event("/matches", query_params={"limit": "ten"}),
+            create_event("/matches", query_params={"since": "x", "limit": "1"}),
+            create_event("/players", method="POST", body='{"first_name": "First", "last_name": "Last"}'),
+            create_event("/matches/{id}", path_params={"id": "m1"}, method="DELETE"),
+            create_event("/players", method="PATCH"),
+            {"httpMethod": "GET"},
+        ]
+        sync_handler = Handler(SignedInManager())
+        with ExitStack() as stack:
+            for name, result in results.items():
+                stack.enter_context(patch.object(sync_handler.manager, name, return_value=result))
+                stack.enter_context(patch.object(self.handler.manager, name, return_value=result))
+            for event in events:
+                self.assertEqual(sync_handler.handle(event), await self.handler.handle(event), event)
+
+        # An up to date client gets a 304 without the data being loaded
+        with patch.object(self.handler.manager, "get_data_version", return_value=3), patch.object(self.handler.manager, "get_players", return_value=[]) as get_players_mock:
+            etag = (await self.handler.handle(create_event("/players")))["headers"]["ETag"]
+            response = await self.handler.handle(create_event("/players", headers={"If-None-Match": etag}))
+        self.assertEqual(304, response["statusCode"])
+        self.assertEqual({"ETag": etag, "Cache-Control": "private", "Vary": "X-Firebase-Token"}, response["headers"])
+        self.assertEqual(1, get_players_mock.await_count)
+
+    async def test_requests_are_multiplexed(self):
+        # Both requests' queries have to be running at once for either to finish, which they can't be if a request holds the event loop while it waits on the db
+        dao = DaoImpl(ConnectionPool(lambda: MagicMock(), max_size=2))
+        barrier = threading.Barrier(2, timeout=5)
+
+        def get_players(context, owner_user_id):
+            barrier.wait()
+            return [fixtures.player()]
+
+        async_dao = AsyncDaoImpl(dao)
+        handler = AsyncHandler(AsyncManagerImpl(SignedInFirebaseClient(), async_dao))
+        try:
+            with patch.object(dao, "get_user_by_firebase_id", return_value=USER), patch.object(dao, "get_data_version", return_value=1), \
+                    patch.object(dao, "get_players", side_effect=get_players):
+                responses = await asyncio.gather(handler.handle(create_event("/players")), handler.handle(create_event("/players")))
+        finally:
+            async_dao.executor.shutdown()
+        self.assertEqual([200, 200], [response["statusCode"] for response in responses])
+
+
+if __name__ == '__main__':
+    unittest.main()
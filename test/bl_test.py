@@ -1,64 +1,89 @@
 import unittest
+from contextlib import contextmanager
+from dataclasses import replace
+from datetime import datetime
 from typing import Callable
 from unittest.mock import patch
 
+import ratings
 from bl import ManagerImpl
 from da import Dao
+from domain.match import MatchPage, MatchCursor, MatchQuery, MatchFilter, GameScore, BatchResult, CREATED, ALREADY_EXISTS
+from domain.pair import PairRecord, OPPONENT, PARTNER
+from domain.rating import PlayerRating
 from domain.exceptions import ServiceException
+from domain.stats import StatsQuery, PlayerStats, ShotCount
+from domain.sync import Watermark, PlayerChanges, MatchChanges
 from firebase_client import FirebaseClient
+from request_context import RequestContext
 from test import fixtures
 
 
 class Test(unittest.TestCase):
     def setUp(self):
         self.manager = ManagerImpl(FirebaseClient(), Dao())
+        self.context = RequestContext()
+
+    def test_contexts_are_separate(self):
+        # One manager serves every request, so authenticating one mustn't authenticate another
+        other_context = RequestContext()
+        with patch.object(self.manager.firebase_client, "get_firebase_user", return_value={"user_id": "fb1"}), \
+                patch.object(self.manager.dao, "get_user_by_firebase_id", return_value=fixtures.user()) as get_user_by_firebase_id_mock:
+            self.manager.validate_token(self.context, "token")
+        get_user_by_firebase_id_mock.assert_called_once_with(self.context, "fb1")
+        self.assertEqual(fixtures.user(), self.context.user)
+        self.assertIsNone(other_context.user)
+
+        with self.assertRaises(ServiceException) as e:
+            self.manager.get_players(other_context)
+        self.assertEqual(401, e.exception.status_code)
 
     def test_validate_token(self):
         # Test without a token (unauthenticated request)
-        self.manager.validate_token(None)
-        self.assertIsNone(self.manager.user)
+        self.manager.validate_token(self.context, None)
+        self.assertIsNone(self.context.user)
 
         # Test when firebase throws an error (invalid token)
         def raise_error(_): raise ValueError()
 
         with patch.object(self.manager.firebase_client, "get_firebase_user", side_effect=raise_error):
-            self.manager.validate_token(None)
-            self.assertIsNone(self.manager.user)
+            self.manager.validate_token(self.context, None)
+            self.assertIsNone(self.context.user)
 
         # Test invalid token response
         with patch.object(self.manager.firebase_client, "get_firebase_user", return_value={}) as mock:
-            self.manager.validate_token("token")
-            self.assertIsNone(self.manager.user)
+            self.manager.validate_token(self.context, "token")
+            self.assertIsNone(self.context.user)
         mock.assert_called_once_with("token")
 
         # Test a new user with an empty name
         with patch.object(self.manager.firebase_client, "get_firebase_user", return_value={"user_id": "NEW_FB_ID", "name": "", "email": "EMAIL", "picture": "PICTURE"}):
             with patch.object(self.manager.dao, "get_user_by_firebase_id", return_value=None):
-                self.manager.validate_token("")
-                self.assertIsNotNone(self.manager.user)
-                self.assertIsNotNone(self.manager.user.user_id)
-                self.assertEqual("NEW_FB_ID", self.manager.user.firebase_id)
-                self.assertEqual("", self.manager.user.first_name)
-                self.assertEqual("", self.manager.user.last_name)
-                self.assertEqual("PICTURE", self.manager.user.image_url)
+                self.manager.validate_token(self.context, "")
+                self.assertIsNotNone(self.context.user)
+                self.assertIsNotNone(self.context.user.user_id)
+                self.assertEqual("NEW_FB_ID", self.context.user.firebase_id)
+                self.assertEqual("", self.context.user.first_name)
+                self.assertEqual("", self.context.user.last_name)
+                self.assertEqual("PICTURE", self.context.user.image_url)
 
         # Test a new user
         with patch.object(self.manager.firebase_client, "get_firebase_user", return_value={"user_id": "NEW_FB_ID", "name": "FIRST MIDDLE LAST", "email": "EMAIL", "picture": "PICTURE"}):
             with patch.object(self.manager.dao, "get_user_by_firebase_id", return_value=None):
                 with patch.object(self.manager.dao, "create_user") as create_user_mock:
                     with patch.object(self.manager.dao, "create_player") as create_player_mock:
-                        self.manager.validate_token("")
-                        self.assertIsNotNone(self.manager.user)
+                        self.manager.validate_token(self.context, "")
+                        self.assertIsNotNone(self.context.user)
 
                 create_user_mock.assert_called_once()
-                user = create_user_mock.call_args.args[0]
+                user = create_user_mock.call_args.args[1]
                 self.assertEqual("NEW_FB_ID", user.firebase_id)
                 self.assertEqual("FIRST", user.first_name)
                 self.assertEqual("MIDDLE LAST", user.last_name)
                 self.assertEqual("PICTURE", user.image_url)
 
                 create_player_mock.assert_called_once()
-                player = create_player_mock.call_args.args[0]
+                player = create_player_mock.call_args.args[1]
                 self.assertEqual(user.user_id, player.owner_user_id)
                 self.assertTrue(player.is_owner)
                 self.assertEqual("PICTURE", player.image_url)
@@ -69,116 +94,294 @@ class Test(unittest.TestCase):
         # Test a saved user
         with patch.object(self.manager.firebase_client, "get_firebase_user", return_value={"user_id": "NEW_FB_ID", "name": "FIRST MIDDLE LAST", "email": "EMAIL", "picture": "PICTURE"}):
             with patch.object(self.manager.dao, "get_user_by_firebase_id", return_value=fixtures.user()):
-                self.manager.validate_token("")
-                self.assertIsNotNone(self.manager.user)
-                self.assertEqual(fixtures.user(), self.manager.user)
+                self.manager.validate_token(self.context, "")
+                self.assertIsNotNone(self.context.user)
+                self.assertEqual(fixtures.user(), self.context.user)
+
+    def test_get_data_version(self):
+        self.assert_requires_auth(lambda: self.manager.get_data_version(self.context))
+
+        with patch.object(self.manager.dao, "get_data_version", return_value=3) as get_data_version_mock:
+            self.assertEqual(3, self.manager.get_data_version(self.context))
+        get_data_version_mock.assert_called_once_with(self.context, self.context.user.user_id)
 
     def test_get_players(self):
-        self.assert_requires_auth(lambda: self.manager.get_players())
+        self.assert_requires_auth(lambda: self.manager.get_players(self.context))
 
         with patch.object(self.manager.dao, "get_players", return_value=[fixtures.player()]):
-            players = self.manager.get_players()
+            players = self.manager.get_players(self.context)
             self.assertEqual([fixtures.player()], players)
 
+    def test_get_player_changes(self):
+        self.assert_requires_auth(lambda: self.manager.get_player_changes(self.context, "0"))
+
+        with self.assertRaises(ServiceException) as e:
+            self.manager.get_player_changes(self.context, "garbage")
+        self.assertEqual(400, e.exception.status_code)
+
+        changes = PlayerChanges([fixtures.player()], ["deleted"], "watermark")
+        since = datetime(2020, 1, 1)
+        with patch.object(self.manager.dao, "get_player_changes", return_value=changes) as get_player_changes_mock:
+            self.assertEqual(changes, self.manager.get_player_changes(self.context, Watermark(since).encode()))
+            get_player_changes_mock.assert_called_once_with(self.context, self.context.user.user_id, since)
+
+            # A first sync asks for everything
+            self.manager.get_player_changes(self.context, "0")
+            get_player_changes_mock.assert_called_with(self.context, self.context.user.user_id, None)
+
     def test_create_player(self):
-        self.assert_requires_auth(lambda: self.manager.create_player(fixtures.player()))
+        self.assert_requires_auth(lambda: self.manager.create_player(self.context, fixtures.player()))
 
         with patch.object(self.manager.dao, "create_player", return_value=fixtures.player()) as create_player_mock:
-            player = self.manager.create_player(fixtures.player())
+            player = self.manager.create_player(self.context, fixtures.player())
             self.assertEqual(fixtures.player(), player)
 
-        create_player_mock.assert_called_once_with(fixtures.player())
+        create_player_mock.assert_called_once_with(self.context, fixtures.player())
 
     def test_update_player(self):
-        self.assert_requires_auth(lambda: self.manager.update_player("", fixtures.player()))
+        self.assert_requires_auth(lambda: self.manager.update_player(self.context, "", fixtures.player()))
 
         with patch.object(self.manager.dao, "get_player", return_value=None) as get_player_mock:
             with self.assertRaises(ServiceException) as e:
-                self.manager.update_player("", fixtures.player())
+                self.manager.update_player(self.context, "", fixtures.player())
             self.assertEqual(404, e.exception.status_code)
-            get_player_mock.assert_called_once_with("")
+            get_player_mock.assert_called_once_with(self.context, "")
 
         with patch.object(self.manager.dao, "get_player", return_value=fixtures.player()):
             with patch.object(self.manager.dao, "update_player", return_value=fixtures.player()) as update_player_mock:
-                result = self.manager.update_player("", fixtures.player())
+                result = self.manager.update_player(self.context, "", fixtures.player())
                 self.assertEqual(fixtures.player(), result)
-            update_player_mock.assert_called_once_with("", fixtures.player())
+            update_player_mock.assert_called_once_with(self.context, "", fixtures.player())
 
     def test_delete_player(self):
-        self.assert_requires_auth(lambda: self.manager.delete_player(""))
+        self.assert_requires_auth(lambda: self.manager.delete_player(self.context, ""))
 
         with patch.object(self.manager.dao, "get_player", return_value=None) as get_player_mock:
             with self.assertRaises(ServiceException) as e:
-                self.manager.delete_player("")
+                self.manager.delete_player(self.context, "")
             self.assertEqual(404, e.exception.status_code)
-            get_player_mock.assert_called_once_with("")
+            get_player_mock.assert_called_once_with(self.context, "")
 
         not_your_player = fixtures.player()
         not_your_player.owner_user_id = "not you"
         with patch.object(self.manager.dao, "get_player", return_value=not_your_player):
             with self.assertRaises(ServiceException) as e:
-                self.manager.delete_player("")
+                self.manager.delete_player(self.context, "")
             self.assertEqual(403, e.exception.status_code)
 
         you = fixtures.player()
         you.is_owner = True
         with patch.object(self.manager.dao, "get_player", return_value=you):
             with self.assertRaises(ServiceException) as e:
-                self.manager.delete_player("")
+                self.manager.delete_player(self.context, "")
             self.assertEqual(403, e.exception.status_code)
 
         your_player = fixtures.player()
-        your_player.owner_user_id = self.manager.user.user_id
+        your_player.owner_user_id = self.context.user.user_id
         with patch.object(self.manager.dao, "get_player", return_value=your_player):
-            with patch.object(self.manager.dao, "delete_player") as delete_player_mock:
-                result = self.manager.delete_player("")
+            with patch.object(self.manager.dao, "delete_player") as delete_player_mock, self.patch_ratings() as save_ratings_mock:
+                result = self.manager.delete_player(self.context, "")
                 self.assertEqual({}, result)
-            delete_player_mock.assert_called_once_with("")
+            delete_player_mock.assert_called_once_with(self.context, "")
+            save_ratings_mock.assert_called_once_with(self.context, self.context.user.user_id, [], replace_all=True)
+
+    def test_get_player_stats(self):
+        self.assert_requires_auth(lambda: self.manager.get_player_stats(self.context, ""))
+
+        with patch.object(self.manager.dao, "get_player", return_value=None):
+            with self.assertRaises(ServiceException) as e:
+                self.manager.get_player_stats(self.context, "")
+            self.assertEqual(404, e.exception.status_code)
+
+        not_your_player = fixtures.player()
+        not_your_player.owner_user_id = "not you"
+        with patch.object(self.manager.dao, "get_player", return_value=not_your_player):
+            with self.assertRaises(ServiceException) as e:
+                self.manager.get_player_stats(self.context, "")
+            self.assertEqual(403, e.exception.status_code)
+
+        your_player = fixtures.player()
+        your_player.owner_user_id = self.context.user.user_id
+        stats = PlayerStats(your_player.player_id, 3, [ShotCount("DROP", "FOREHAND", "WINNER", 3)])
+        query = StatsQuery(start=datetime(2020, 1, 1))
+        with patch.object(self.manager.dao, "get_player", return_value=your_player):
+            with patch.object(self.manager.dao, "get_player_stats", return_value=stats) as get_player_stats_mock:
+                self.assertEqual(stats, self.manager.get_player_stats(self.context, your_player.player_id, query))
+            get_player_stats_mock.assert_called_once_with(self.context, self.context.user.user_id, your_player.player_id, query)
+
+    def test_get_pair_records(self):
+        for get_records, relation in [(self.manager.get_head_to_head, OPPONENT), (self.manager.get_partners, PARTNER)]:
+            self.assert_requires_auth(lambda: get_records(self.context, ""))
+
+            with patch.object(self.manager.dao, "get_player", return_value=None):
+                with self.assertRaises(ServiceException) as e:
+                    get_records(self.context, "")
+                self.assertEqual(404, e.exception.status_code)
+
+            not_your_player = fixtures.player()
+            not_your_player.owner_user_id = "not you"
+            with patch.object(self.manager.dao, "get_player", return_value=not_your_player):
+                with self.assertRaises(ServiceException) as e:
+                    get_records(self.context, "")
+                self.assertEqual(403, e.exception.status_code)
+
+            your_player = fixtures.player()
+            your_player.owner_user_id = self.context.user.user_id
+            records = [PairRecord(your_player.player_id, "other", 3, 2, 1, 12)]
+            with patch.object(self.manager.dao, "get_player", return_value=your_player):
+                with patch.object(self.manager.dao, "get_pair_records", return_value=records) as get_pair_records_mock:
+                    self.assertEqual(records, get_records(self.context, your_player.player_id))
+                get_pair_records_mock.assert_called_once_with(self.context, your_player.player_id, relation)
 
     def test_get_matches(self):
-        self.assert_requires_auth(lambda: self.manager.get_players())
+        self.assert_requires_auth(lambda: self.manager.get_players(self.context))
 
-        with patch.object(self.manager.dao, "get_matches", return_value=[fixtures.match()]):
-            matches = self.manager.get_matches()
+        with patch.object(self.manager.dao, "get_matches", return_value=[fixtures.match()]) as get_matches_mock:
+            matches = self.manager.get_matches(self.context)
             self.assertEqual([fixtures.match()], matches)
+            get_matches_mock.assert_called_once_with(self.context, self.context.user.user_id, MatchQuery(), MatchFilter())
+
+            match_filter = MatchFilter(player_id="p1", opponent_id="p2")
+            self.manager.get_matches(self.context, match_filter=match_filter)
+            get_matches_mock.assert_called_with(self.context, self.context.user.user_id, MatchQuery(), match_filter)
+
+    def test_get_match_changes(self):
+        self.assert_requires_auth(lambda: self.manager.get_match_changes(self.context, "0"))
+
+        with self.assertRaises(ServiceException) as e:
+            self.manager.get_match_changes(self.context, "garbage")
+        self.assertEqual(400, e.exception.status_code)
+
+        changes = MatchChanges([fixtures.match()], ["deleted"], "watermark")
+        since = datetime(2020, 1, 1)
+        query = MatchQuery(frozenset(["match_id", "date", "scores"]))
+        with patch.object(self.manager.dao, "get_match_changes", return_value=changes) as get_match_changes_mock:
+            self.assertEqual(changes, self.manager.get_match_changes(self.context, Watermark(since).encode(), query))
+            get_match_changes_mock.assert_called_once_with(self.context, self.context.user.user_id, since, query)
+
+    def test_get_match_page(self):
+        self.assert_requires_auth(lambda: self.manager.get_match_page(self.context, 10, None))
+
+        for bad_limit in [0, -1, 201]:
+            with self.assertRaises(ServiceException) as e:
+                self.manager.get_match_page(self.context, bad_limit, None)
+            self.assertEqual(400, e.exception.status_code)
+
+        with self.assertRaises(ServiceException) as e:
+            self.manager.get_match_page(self.context, 10, "garbage")
+        self.assertEqual(400, e.exception.status_code)
+
+        page = MatchPage([fixtures.match()], "next")
+        cursor = MatchCursor(datetime(2020, 1, 1), "match_id")
+        with patch.object(self.manager.dao, "get_match_page", return_value=page) as get_match_page_mock:
+            self.assertEqual(page, self.manager.get_match_page(self.context, 10, None))
+            get_match_page_mock.assert_called_once_with(self.context, self.context.user.user_id, 10, None, MatchQuery(), MatchFilter())
+
+            query = MatchQuery(frozenset(["match_id", "date", "scores"]))
+            match_filter = MatchFilter(format="doubles")
+            self.assertEqual(page, self.manager.get_match_page(self.context, 1, cursor.encode(), query, match_filter))
+            get_match_page_mock.assert_called_with(self.context, self.context.user.user_id, 1, cursor, query, match_filter)
 
     def test_create_match(self):
-        self.assert_requires_auth(lambda: self.manager.create_match(fixtures.match()))
+        self.assert_requires_auth(lambda: self.manager.create_match(self.context, fixtures.match()))
 
-        with patch.object(self.manager.dao, "create_match", return_value=fixtures.match()) as create_match_mock:
-            match = self.manager.create_match(fixtures.match())
+        with patch.object(self.manager.dao, "create_match", return_value=fixtures.match()) as create_match_mock, self.patch_ratings():
+            match = self.manager.create_match(self.context, fixtures.match())
             self.assertEqual(fixtures.match(), match)
 
-        create_match_mock.assert_called_once_with(fixtures.match())
+        create_match_mock.assert_called_once_with(self.context, fixtures.match())
+
+    def test_create_matches(self):
+        self.assert_requires_auth(lambda: self.manager.create_matches(self.context, [fixtures.match()]))
+
+        self.context.user = fixtures.user()
+        with self.assertRaises(ServiceException) as e:
+            self.manager.create_matches(self.context, [replace(fixtures.match(), match_id=str(i)) for i in range(501)])
+        self.assertEqual(400, e.exception.status_code)
+
+        matches = [replace(fixtures.match(), match_id=match_id) for match_id in ["new1", "old", "new2"]]
+        with patch.object(self.manager.dao, "get_existing_match_ids", return_value=["old"]) as get_existing_match_ids_mock, \
+                patch.object(self.manager.dao, "create_matches") as create_matches_mock, self.patch_ratings() as save_ratings_mock:
+            self.assertEqual([BatchResult("new1", CREATED), BatchResult("old", ALREADY_EXISTS), BatchResult("new2", CREATED)], self.manager.create_matches(self.context, matches))
+        get_existing_match_ids_mock.assert_called_once_with(self.context, ["new1", "old", "new2"])
+        create_matches_mock.assert_called_once_with(self.context, [matches[0], matches[2]])
+        # The whole batch is rated with one replay
+        save_ratings_mock.assert_called_once_with(self.context, self.context.user.user_id, [], replace_all=True)
+
+        # Nothing new, so nothing to write or rate
+        with patch.object(self.manager.dao, "get_existing_match_ids", return_value=["new1", "old", "new2"]), \
+                patch.object(self.manager.dao, "create_matches") as create_matches_mock, self.patch_ratings() as save_ratings_mock:
+            self.assertEqual([ALREADY_EXISTS] * 3, [result.status for result in self.manager.create_matches(self.context, matches)])
+        create_matches_mock.assert_not_called()
+        save_ratings_mock.assert_not_called()
+
+    def test_create_match_updates_ratings(self):
+        self.context.user = fixtures.user()
+        match = replace(fixtures.match(), team1_player1=replace(fixtures.player(), player_id="a"), team1_player2=None, team2_player1=replace(fixtures.player(), player_id="b"), team2_player2=None,
+                        scores=[GameScore(11, 5)])
+        earlier, later = MatchCursor(datetime(2019, 1, 1), "earlier"), MatchCursor(datetime(2021, 1, 1), "later")
+
+        # The newest match only moves its own players, starting from their current ratings
+        with patch.object(self.manager.dao, "create_match", return_value=match), patch.object(self.manager.dao, "get_latest_match", return_value=earlier) as get_latest_match_mock, \
+                patch.object(self.manager.dao, "apply_match_to_ratings") as apply_match_to_ratings_mock, patch.object(self.manager.dao, "save_ratings") as save_ratings_mock, \
+                patch.object(self.manager.dao, "get_matches") as get_matches_mock:
+            self.manager.create_match(self.context, match)
+        get_latest_match_mock.assert_called_once_with(self.context, self.context.user.user_id, excluding_match_id=match.match_id)
+        apply_match_to_ratings_mock.assert_called_once_with(self.context, self.context.user.user_id, match)
+        save_ratings_mock.assert_not_called()
+        get_matches_mock.assert_not_called()
+
+        # A backdated match means replaying the history
+        with patch.object(self.manager.dao, "create_match", return_value=match), patch.object(self.manager.dao, "get_latest_match", return_value=later), \
+                patch.object(self.manager.dao, "get_matches", return_value=[match]) as get_matches_mock, patch.object(self.manager.dao, "save_ratings") as save_ratings_mock:
+            self.manager.create_match(self.context, match)
+        get_matches_mock.assert_called_once_with(self.context, self.context.user.user_id, MatchQuery(frozenset(["match_id", "date", "team1", "team2", "scores"])))
+        save_ratings_mock.assert_called_once_with(self.context, self.context.user.user_id, ratings.replay([match]), replace_all=True)
+
+    def test_get_ratings(self):
+        self.assert_requires_auth(lambda: self.manager.get_ratings(self.context))
+
+        with patch.object(self.manager.dao, "get_ratings", return_value=[PlayerRating("a", 1600, 10)]) as get_ratings_mock:
+            self.assertEqual([PlayerRating("a", 1600, 10)], self.manager.get_ratings(self.context))
+        get_ratings_mock.assert_called_once_with(self.context, self.context.user.user_id)
 
     def test_delete_match(self):
-        self.assert_requires_auth(lambda: self.manager.delete_match(""))
+        self.assert_requires_auth(lambda: self.manager.delete_match(self.context, ""))
 
         with patch.object(self.manager.dao, "get_match", return_value=None) as get_match_mock:
             with self.assertRaises(ServiceException) as e:
-                self.manager.delete_match("")
+                self.manager.delete_match(self.context, "")
             self.assertEqual(404, e.exception.status_code)
-            get_match_mock.assert_called_once_with("")
+            get_match_mock.assert_called_once_with(self.context, "")
 
         not_your_match = fixtures.match()
         not_your_match.user_id = "not you"
         with patch.object(self.manager.dao, "get_match", return_value=not_your_match):
             with self.assertRaises(ServiceException) as e:
-                self.manager.delete_match("")
+                self.manager.delete_match(self.context, "")
             self.assertEqual(403, e.exception.status_code)
 
         your_match = fixtures.match()
-        your_match.user_id = self.manager.user.user_id
+        your_match.user_id = self.context.user.user_id
         with patch.object(self.manager.dao, "get_match", return_value=your_match):
-            with patch.object(self.manager.dao, "delete_match") as delete_match_mock:
-                result = self.manager.delete_match("")
+            with patch.object(self.manager.dao, "delete_match") as delete_match_mock, self.patch_ratings() as save_ratings_mock:
+                result = self.manager.delete_match(self.context, "")
                 self.assertEqual({}, result)
-            delete_match_mock.assert_called_once_with("")
+            delete_match_mock.assert_called_once_with(self.context, "")
+            # Ratings are replayed without the match
+            save_ratings_mock.assert_called_once_with(self.context, self.context.user.user_id, [], replace_all=True)
+
+    @contextmanager
+    def patch_ratings(self):
+        """Stubs out the rating updates that follow every match write, yielding the save_ratings mock"""
+        with patch.object(self.manager.dao, "get_latest_match", return_value=None), patch.object(self.manager.dao, "apply_match_to_ratings"), \
+                patch.object(self.manager.dao, "get_matches", return_value=[]), patch.object(self.manager.dao, "save_ratings") as save_ratings_mock:
+            yield save_ratings_mock
 
     def assert_requires_auth(self, fun: Callable):
-        self.manager.user = None
+        self.context.user = None
         with self.assertRaises(ServiceException) as e:
             fun()
         self.assertEqual(401, e.exception.status_code)
         self.assertEqual("Unable to authenticate", e.exception.error_message)
-        self.manager.user = fixtures.user()
+        self.context.user = fixtures.user()
@@ -0,0 +1,84 @@
+import unittest
+from unittest.mock import MagicMock
+
+from cache import TTLCache
+from connection_pool import ConnectionPool
+from da import DaoImpl
+from domain.user import User
+from request_context import RequestContext
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.cache = TTLCache(max_size=2, clock=lambda: self.now)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.put("a", 1, expires_at=10)
+        self.assertEqual(1, self.cache.get("a"))
+
+    def test_expiry(self):
+        self.cache.put("a", 1, expires_at=10)
+        self.now = 9.9
+        self.assertEqual(1, self.cache.get("a"))
+        self.now = 10
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(0, len(self.cache))
+
+        # Entries that are already expired are never stored
+        self.cache.put("b", 2, expires_at=5)
+        self.assertIsNone(self.cache.get("b"))
+
+    def test_bounded_lru(self):
+        self.cache.put("a", 1, expires_at=10)
+        self.cache.put("b", 2, expires_at=10)
+        self.cache.get("a")
+        self.cache.put("c", 3, expires_at=10)
+        # "b" was the least recently used
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(1, self.cache.get("a"))
+        self.assertEqual(3, self.cache.get("c"))
+
+    def test_invalidate(self):
+        self.cache.put("a", 1, expires_at=10)
+        self.cache.invalidate("a")
+        self.cache.invalidate("missing")
+        self.assertIsNone(self.cache.get("a"))
+
+
+class UserCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = MagicMock()
+        self.cursor = self.conn.cursor.return_value.__enter__.return_value
+        self.cursor.fetchone.return_value = ("1", "fb1", "First", "Last", "hello.jpg")
+        self.dao = DaoImpl(ConnectionPool(lambda: self.conn))
+
+    def test_lookup_survives_requests(self):
+        user = self.dao.get_user_by_firebase_id(RequestContext(), "fb1")
+        self.assertEqual(user, self.dao.get_user_by_firebase_id(RequestContext(), "fb1"))
+        self.cursor.execute.assert_called_once()
+
+    def test_missing_users_are_not_cached(self):
+        self.cursor.fetchone.return_value = None
+        self.assertIsNone(self.dao.get_user_by_firebase_id(RequestContext(), "fb1"))
+        self.assertIsNone(self.dao.get_user_by_firebase_id(RequestContext(), "fb1"))
+        self.assertEqual(2, self.cursor.execute.call_count)
+
+    def test_create_user_writes_through(self):
+        user = User("2", "fb2", "First", "Last", "hello.jpg")
+        self.dao.create_user(RequestContext(), user)
+        self.assertEqual(user, self.dao.get_user_by_firebase_id(RequestContext(), "fb2"))
+        # Only the insert hit the db
+        self.cursor.execute.assert_called_once()
+
+    def test_invalidate_user(self):
+        # Within one request, so the identity map has to let go of the user too
+        context = RequestContext()
+        self.dao.get_user_by_firebase_id(context, "fb1")
+        self.dao.invalidate_user(context, "fb1")
+        self.dao.get_user_by_firebase_id(context, "fb1")
+        self.assertEqual(2, self.cursor.execute.call_count)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+import pymysql
+
+from connection_pool import ConnectionPool
+from da import DaoImpl
+from domain.exceptions import ServiceException
+from domain.user import User
+from request_context import RequestContext
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.connect = MagicMock(side_effect=lambda: MagicMock())
+        self.pool = ConnectionPool(self.connect, ping_interval=30, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_connects_lazily(self):
+        self.connect.assert_not_called()
+        with self.pool.connection() as conn:
+            self.assertIsNotNone(conn)
+        self.connect.assert_called_once()
+
+    def test_reuse_pings_only_after_idling(self):
+        with self.pool.connection() as first:
+            pass
+
+        # Back to back requests reuse the connection without a round trip
+        self.clock.now += 10
+        with self.pool.connection() as conn:
+            self.assertIs(first, conn)
+        first.ping.assert_not_called()
+
+        # A connection that has sat idle gets checked first
+        self.clock.now += 60
+        with self.pool.connection() as conn:
+            self.assertIs(first, conn)
+        first.ping.assert_called_once_with(reconnect=False)
+        self.connect.assert_called_once()
+
+    def test_stale_connection_is_replaced(self):
+        with self.pool.connection() as first:
+            first.ping.side_effect = pymysql.err.OperationalError(2006, "MySQL server has gone away")
+
+        self.clock.now += 60
+        with self.pool.connection() as conn:
+            self.assertIsNot(first, conn)
+        first.close.assert_called_once()
+        self.assertEqual(2, self.connect.call_count)
+        self.assertEqual(1, self.pool.size)
+
+    def test_lost_connection_is_discarded(self):
+        with self.assertRaises(pymysql.err.OperationalError):
+            with self.pool.connection() as first:
+                raise pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")
+        self.assertEqual(0, self.pool.size)
+
+        with self.pool.connection() as conn:
+            self.assertIsNot(first, conn)
+
+        # Other errors leave the connection alone
+        with self.assertRaises(ValueError):
+            with self.pool.connection() as second:
+                raise ValueError()
+        with self.pool.connection() as conn:
+            self.assertIs(second, conn)
+
+    def test_connect_retries_with_bounded_backoff(self):
+        self.connect.side_effect = pymysql.err.OperationalError(2003, "Can't connect")
+        pool = ConnectionPool(self.connect, connect_attempts=4, backoff=0.1, max_backoff=0.25, clock=self.clock, sleep=self.clock.sleep)
+        with self.assertRaises(ServiceException) as e:
+            pool.acquire()
+        self.assertEqual("Failed to connect to database", e.exception.error_message)
+        self.assertEqual(4, self.connect.call_count)
+        self.assertAlmostEqual(0.1 + 0.2 + 0.25, self.clock.now)
+        # The failed slot is given back
+        self.assertEqual(0, pool.size)
+
+        # Recovers once the db comes back
+        self.connect.side_effect = lambda: MagicMock()
+        self.assertIsNotNone(pool.acquire())
+
+    def test_pool_is_bounded(self):
+        pool = ConnectionPool(self.connect, max_size=2, acquire_timeout=0.05)
+        first, second = pool.acquire(), pool.acquire()
+        self.assertIsNot(first, second)
+        with self.assertRaises(ServiceException) as e:
+            pool.acquire()
+        self.assertEqual("Timed out waiting for a database connection", e.exception.error_message)
+
+        pool.release(first)
+        self.assertIs(first, pool.acquire())
+        self.assertEqual(2, self.connect.call_count)
+
+    def test_pool_is_thread_safe(self):
+        pool = ConnectionPool(self.connect, max_size=3)
+        in_use, shared, lock = set(), [], threading.Lock()
+
+        def work():
+            for _ in range(50):
+                with pool.connection() as conn:
+                    with lock:
+                        if conn in in_use:
+                            shared.append(conn)
+                        in_use.add(conn)
+                    with lock:
+                        in_use.remove(conn)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # No connection was ever handed to two threads at once
+        self.assertEqual([], shared)
+        self.assertLessEqual(self.connect.call_count, 3)
+
+
+class DaoConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.connect = MagicMock(side_effect=lambda: MagicMock())
+        self.dao = DaoImpl(ConnectionPool(self.connect))
+
+    def test_no_connection_until_first_query(self):
+        self.connect.assert_not_called()
+
+    def test_read_is_retried_on_lost_connection(self):
+        dead, alive = MagicMock(), MagicMock()
+        dead.cursor.return_value.__enter__.return_value.execute.side_effect = pymysql.err.OperationalError(2006, "MySQL server has gone away")
+        alive.cursor.return_value.__enter__.return_value.fetchone.return_value = ("1", "fb1", "First", "Last", "hello.jpg")
+        self.connect.side_effect = [dead, alive]
+
+        self.assertEqual(User("1", "fb1", "First", "Last", "hello.jpg"), self.dao.get_user(RequestContext(), "1"))
+        dead.close.assert_called_once()
+
+    def test_write_is_not_retried(self):
+        dead = MagicMock()
+        dead.cursor.return_value.__enter__.return_value.execute.side_effect = pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")
+        self.connect.side_effect = [dead]
+
+        with self.assertRaises(ServiceException) as e:
+            self.dao.execute("delete from matches where id = %s", "1")
+        self.assertEqual("Error executing database command", e.exception.error_message)
+        self.connect.assert_called_once()
+
+    def test_transaction_uses_one_connection(self):
+        with self.dao.transaction() as conn:
+            self.dao.execute("insert into a values (%s)", 1)
+            self.dao.execute_many("insert into b values (%s)", [1], [2])
+        conn.begin.assert_called_once()
+        conn.commit.assert_called_once()
+        conn.rollback.assert_not_called()
+        self.connect.assert_called_once()
+
+        with self.assertRaises(ServiceException):
+            with self.dao.transaction() as conn:
+                conn.cursor.return_value.__enter__.return_value.execute.side_effect = pymysql.err.IntegrityError(1452, "Cannot add or update a child row")
+                self.dao.execute("insert into a values (%s)", 1)
+        conn.rollback.assert_called_once()
+
+    def test_transaction_errors_are_wrapped(self):
+        # A connection that dropped while it sat idle (inside the no-ping window) first fails on begin
+        dead = MagicMock()
+        dead.begin.side_effect = pymysql.err.OperationalError(2006, "MySQL server has gone away")
+        self.connect.side_effect = [dead]
+        with self.assertRaises(ServiceException) as e:
+            with self.dao.transaction():
+                pass
+        self.assertEqual((500, "Error executing database command"), (e.exception.status_code, e.exception.error_message))
+        dead.close.assert_called_once()
+
+        failing = MagicMock()
+        failing.commit.side_effect = pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")
+        self.connect.side_effect = [failing]
+        with self.assertRaises(ServiceException):
+            with self.dao.transaction():
+                self.dao.execute("insert into a values (%s)", 1)
+        failing.rollback.assert_called_once()
+        failing.close.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,28 @@
+import io
 import os
 import unittest
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from unittest.mock import patch
+from dataclasses import replace
+from datetime import datetime, timedelta
 
 from domain.exceptions import ServiceException
-from domain.match import Match, GameScore, Stat
+from domain.match import Match, GameScore, Stat, MatchCursor, MatchQuery, MatchFilter
+from domain.pair import PairRecord, OPPONENT, PARTNER
 from domain.player import Player
+from domain.rating import PlayerRating
+from domain.stats import StatsQuery, ShotCount, PlayerStats
+from domain.sync import Watermark
 from domain.user import User
 from test import properties, fixtures
-from da import DaoImpl
+from da import DaoImpl, SYNC_OVERLAP_SECONDS
+from request_context import RequestContext
+import metrics
+import migrate
+import plan_check
+import player_ratings
+import ratings
 
 
 class Test(unittest.TestCase):
@@ -23,6 +38,7 @@ class Test(unittest.TestCase):
         cls.dao = DaoImpl()
 
     def setUp(self) -> None:
+        self.context = RequestContext()
         try:
             self.dao.execute("""insert into users (id, firebase_id, first_name, last_name, image_url) values 
                 ('TEST1', 'fb1', 'Tester', 'One', 'test1.jpg'),
@@ -36,14 +52,24 @@ class Test(unittest.TestCase):
                 ('player3', 'TEST1', True, 'image.jpg', 'first', 'last', 'LEFT', 'notes', 'phone', 'email', 5.2),
                 ('player4', 'TEST1', True, 'image.jpg', 'first', 'last', 'LEFT', 'notes', 'phone', 'email', 5.2)
             """)
-            self.dao.execute("""insert into matches (id, user_id, date, team1_player1_id, team1_player2_id, team2_player1_id, team2_player2_id, scores) values 
-                ('match1', 'TEST1', '2020-01-01 00:00:01', 'player1', null, 'player2', null, '10-1'),
-                ('match2', 'TEST1', '2020-01-01 00:00:02', 'player1', 'player2', 'player3', 'player4', '10-1,2-10')
+            self.dao.execute("""insert into matches (id, user_id, date, team1_player1_id, team1_player2_id, team2_player1_id, team2_player2_id, scores, team1_games, team2_games, team1_points, team2_points, winning_team) values 
+                ('match1', 'TEST1', '2020-01-01 00:00:01', 'player1', null, 'player2', null, '10-1', 1, 0, 10, 1, 1),
+                ('match2', 'TEST1', '2020-01-01 00:00:02', 'player1', 'player2', 'player3', 'player4', '10-1,2-10', 1, 1, 12, 11, null)
+            """)
+            self.dao.execute("""insert into match_players (player_id, date, match_id, user_id, team) values
+                ('player1', '2020-01-01 00:00:01', 'match1', 'TEST1', 1),
+                ('player2', '2020-01-01 00:00:01', 'match1', 'TEST1', 2),
+                ('player1', '2020-01-01 00:00:02', 'match2', 'TEST1', 1),
+                ('player2', '2020-01-01 00:00:02', 'match2', 'TEST1', 1),
+                ('player3', '2020-01-01 00:00:02', 'match2', 'TEST1', 2),
+                ('player4', '2020-01-01 00:00:02', 'match2', 'TEST1', 2)
             """)
             self.dao.execute("""insert into stats (id, user_id, match_id, player_id, game_index, shot_result, shot_type, shot_side) values 
                 ('stat1', 'TEST1', 'match1', 'player1', 0, 'WINNER', 'DROP', 'FOREHAND'),
                 ('stat2', 'TEST1', 'match1', 'player1', 0, 'ERROR', 'SERVE', null)
             """)
+            self.dao.rebuild_stat_rollups("TEST1")
+            self.dao.rebuild_pair_records("TEST1")
         except:
             self.tearDown()
             exit()
@@ -51,14 +77,18 @@ class Test(unittest.TestCase):
     def tearDown(self) -> None:
         # These will cascade in order to delete the other ones
         self.dao.execute("delete from users where id in ('__TEST', 'TEST1', 'TEST2', 'TEST3', 'TEST4')")
+        self.dao.execute("delete from stat_rollups where user_id in ('__TEST', 'TEST1', 'TEST2', 'TEST3', 'TEST4')")
+        self.dao.execute("delete from player_ratings where user_id in ('__TEST', 'TEST1', 'TEST2', 'TEST3', 'TEST4')")
+        self.dao.execute("delete from pair_records where user_id in ('__TEST', 'TEST1', 'TEST2', 'TEST3', 'TEST4')")
+        self.dao.execute("delete from match_players where user_id in ('__TEST', 'TEST1', 'TEST2', 'TEST3', 'TEST4')")
 
     def test_get_user(self):
         # Test non-existent user
-        user = self.dao.get_user("TEST0")
+        user = self.dao.get_user(self.context, "TEST0")
         self.assertIsNone(user)
 
         # Test regular user
-        user = self.dao.get_user("TEST1")
+        user = self.dao.get_user(self.context, "TEST1")
         self.assertIsNotNone(user)
         self.assertEqual("TEST1", user.user_id)
         self.assertEqual("fb1", user.firebase_id)
@@ -68,16 +98,16 @@ class Test(unittest.TestCase):
 
     def test_get_user_by_firebase_id(self):
         # Test non-existent user
-        user = self.dao.get_user_by_firebase_id("fb0")
+        user = self.dao.get_user_by_firebase_id(self.context, "fb0")
         self.assertIsNone(user)
 
         # Test regular user
-        user = self.dao.get_user_by_firebase_id("fb1")
+        user = self.dao.get_user_by_firebase_id(self.context, "fb1")
         self.assertIsNotNone(user)
         self.assertEqual("TEST1", user.user_id)
 
     def test_create_user(self):
-        self.dao.create_user(User("__TEST", "fbid", "First", "Last", "test.jpg"))
+        self.dao.create_user(self.context, User("__TEST", "fbid", "First", "Last", "test.jpg"))
         user: User = self.dao.get_one(User, "select id, firebase_id, first_name, last_name, image_url from users where ID = '__TEST'")
         self.assertIsNotNone(user)
         self.assertEqual("__TEST", user.user_id)
@@ -86,19 +116,38 @@ class Test(unittest.TestCase):
         self.assertEqual("Last", user.last_name)
         self.assertEqual("test.jpg", user.image_url)
 
+    def test_data_version(self):
+        self.assertEqual(0, self.dao.get_data_version(self.context, "TEST0"))
+        version = self.dao.get_data_version(self.context, "TEST1")
+
+        # Every write to the user's data moves it on
+        player = self.dao.create_player(self.context, Player("0", "TEST1", False, None, "first_name", "", None, None, None, None, None))
+        self.assertEqual(version + 1, self.dao.get_data_version(self.context, "TEST1"))
+        self.dao.update_player(self.context, "0", replace(player, first_name="updated"))
+        self.assertEqual(version + 2, self.dao.get_data_version(self.context, "TEST1"))
+        self.dao.delete_player(self.context, "0")
+        self.assertEqual(version + 3, self.dao.get_data_version(self.context, "TEST1"))
+        self.dao.create_match(self.context, Match("0", "TEST1", datetime(2020, 1, 1), replace(fixtures.player(), player_id="player1"), None, replace(fixtures.player(), player_id="player2"), None, [GameScore(11, 5)], []))
+        self.assertEqual(version + 4, self.dao.get_data_version(self.context, "TEST1"))
+        self.dao.delete_match(self.context, "0")
+        self.assertEqual(version + 5, self.dao.get_data_version(self.context, "TEST1"))
+
+        # Other users aren't affected
+        self.assertEqual(0, self.dao.get_data_version(self.context, "TEST2"))
+
     def test_get_players(self):
-        players = self.dao.get_players("TEST0")
+        players = self.dao.get_players(self.context, "TEST0")
         self.assertEqual(0, len(players))
 
-        players = self.dao.get_players("TEST1")
+        players = self.dao.get_players(self.context, "TEST1")
         self.assertEqual(4, len(players))
 
     def test_get_player(self):
-        player = self.dao.get_player("player1")
+        player = self.dao.get_player(self.context, "player1")
         self.assertIsNotNone(player)
 
     def test_create_player(self):
-        player = self.dao.create_player(Player("0", "TEST1", True, "image_url", "first_name", "last_name", "RIGHT", "notes", "phone_number", "email", 5.0))
+        player = self.dao.create_player(self.context, Player("0", "TEST1", True, "image_url", "first_name", "last_name", "RIGHT", "notes", "phone_number", "email", 5.0))
         self.assertIsNotNone(player)
         self.assertEqual("0", player.player_id)
         self.assertEqual("TEST1", player.owner_user_id)
@@ -114,7 +163,7 @@ class Test(unittest.TestCase):
         self.assertEqual(5.0, player.level)
 
         # Create a player with everything as none
-        player = self.dao.create_player(Player("-1", "TEST1", False, None, "first_name", "", None, None, None, None, None))
+        player = self.dao.create_player(self.context, Player("-1", "TEST1", False, None, "first_name", "", None, None, None, None, None))
         self.assertIsNotNone(player)
         self.assertEqual("-1", player.player_id)
         self.assertEqual("TEST1", player.owner_user_id)
@@ -130,7 +179,7 @@ class Test(unittest.TestCase):
         self.assertIsNone(player.level)
 
     def test_update_player(self):
-        player = self.dao.update_player("player1", Player("new_player_id", "new_owner_user_id", False, "new_image_url", "new_first", "new_last", "RIGHT", "new_notes", "new_phone", "new_email", 1.23))
+        player = self.dao.update_player(self.context, "player1", Player("new_player_id", "new_owner_user_id", False, "new_image_url", "new_first", "new_last", "RIGHT", "new_notes", "new_phone", "new_email", 1.23))
         # You can't change the id or owner info
         self.assertEqual("player1", player.player_id)
         self.assertEqual("TEST1", player.owner_user_id)
@@ -147,11 +196,231 @@ class Test(unittest.TestCase):
         self.assertAlmostEqual(1.2, player.level)
 
     def test_delete_player(self):
-        self.dao.delete_player("player1")
-        self.assertIsNone(self.dao.get_player("player1"))
+        self.dao.delete_player(self.context, "player3")
+        self.assertIsNone(self.dao.get_player(self.context, "player3"))
+        self.assertEqual(3, len(self.dao.get_players(self.context, "TEST1")))
+        # Matches the player was in go with them
+        self.assertIsNone(self.dao.get_match(self.context, "match2"))
+        self.assertIsNotNone(self.dao.get_match(self.context, "match1"))
+
+        # The row is kept as a tombstone for syncing clients
+        self.assertIsNotNone(self.dao.get_one(lambda deleted_at: deleted_at, "select deleted_at from players where id = 'player3'"))
+
+    def test_get_player_changes(self):
+        changes = self.dao.get_player_changes(self.context, "TEST1", None)
+        self.assertEqual(4, len(changes.players))
+        self.assertEqual([], changes.deleted)
+        self.assertIsNotNone(Watermark.decode(changes.watermark).timestamp)
+
+        since = self.dao.get_one(lambda now: now, "select now(6)")
+        changes = self.dao.get_player_changes(self.context, "TEST1", since)
+        self.assertEqual([], changes.players)
+        self.assertEqual([], changes.deleted)
+
+        self.dao.update_player(self.context, "player2", replace(self.dao.get_player(self.context, "player2"), first_name="updated"))
+        self.dao.delete_player(self.context, "player3")
+        changes = self.dao.get_player_changes(self.context, "TEST1", since)
+        self.assertEqual(["player2"], [player.player_id for player in changes.players])
+        self.assertEqual("updated", changes.players[0].first_name)
+        self.assertEqual(["player3"], changes.deleted)
+        self.assertLess(since, Watermark.decode(changes.watermark).timestamp + timedelta(seconds=SYNC_OVERLAP_SECONDS))
+
+    def test_identity_map(self):
+        player = self.dao.get_player(self.context, "player1")
+        match = self.dao.get_match(self.context, "match1")
+
+        # Anything already loaded during the request is served from memory
+        with patch.object(self.dao, "get_one") as get_one_mock, patch.object(self.dao, "get_list") as get_list_mock:
+            self.assertIs(player, self.dao.get_player(self.context, "player1"))
+            self.assertIs(match, self.dao.get_match(self.context, "match1"))
+            self.assertEqual([player], self.dao.get_players_by_ids(self.context, ["player1"]))
+        get_one_mock.assert_not_called()
+        get_list_mock.assert_not_called()
+
+        # Writes are visible for the rest of the request
+        self.dao.update_player(self.context, "player1", replace(player, first_name="updated"))
+        self.assertEqual("updated", self.dao.get_player(self.context, "player1").first_name)
+        self.dao.delete_match(self.context, "match1")
+        self.assertIsNone(self.dao.get_match(self.context, "match1"))
+
+        # A new request starts from a clean slate
+        self.dao.execute("update players set first_name = 'changed elsewhere' where id = 'player1'")
+        self.assertEqual("updated", self.dao.get_player(self.context, "player1").first_name)
+        self.context = RequestContext()
+        self.assertEqual("changed elsewhere", self.dao.get_player(self.context, "player1").first_name)
+
+    def test_get_player_stats(self):
+        self.assertEqual(PlayerStats("player1", 2, [ShotCount("DROP", "FOREHAND", "WINNER", 1), ShotCount("SERVE", None, "ERROR", 1)]), self.dao.get_player_stats(self.context, "TEST1", "player1"))
+        self.assertEqual(PlayerStats("player2", 0, []), self.dao.get_player_stats(self.context, "TEST1", "player2"))
+
+        # Filtered down to the matches asked for
+        self.assertEqual(2, self.dao.get_player_stats(self.context, "TEST1", "player1", StatsQuery(start=datetime(2020, 1, 1), end=datetime(2020, 1, 2))).total)
+        self.assertEqual(0, self.dao.get_player_stats(self.context, "TEST1", "player1", StatsQuery(start=datetime(2020, 1, 2))).total)
+        self.assertEqual(0, self.dao.get_player_stats(self.context, "TEST1", "player1", StatsQuery(end=datetime(2020, 1, 1))).total)
+        self.assertEqual(2, self.dao.get_player_stats(self.context, "TEST1", "player1", StatsQuery(match_ids=frozenset(["match1", "match2"]))).total)
+        self.assertEqual(0, self.dao.get_player_stats(self.context, "TEST1", "player1", StatsQuery(match_ids=frozenset(["match2"]))).total)
+        self.assertEqual(0, self.dao.get_player_stats(self.context, "TEST1", "player1", StatsQuery(match_ids=frozenset())).total)
+
+        # Deleted matches don't count
+        self.dao.delete_match(self.context, "match1")
+        self.assertEqual(0, self.dao.get_player_stats(self.context, "TEST1", "player1").total)
+        self.assertEqual(0, self.dao.get_player_stats(self.context, "TEST1", "player1", StatsQuery(start=datetime(2020, 1, 1, 0, 0, 1))).total)
+
+    def test_get_latest_match(self):
+        self.assertEqual(MatchCursor(datetime(2020, 1, 1, 0, 0, 2), "match2"), self.dao.get_latest_match(self.context, "TEST1"))
+        self.assertEqual(MatchCursor(datetime(2020, 1, 1, 0, 0, 1), "match1"), self.dao.get_latest_match(self.context, "TEST1", excluding_match_id="match2"))
+        self.assertIsNone(self.dao.get_latest_match(self.context, "TEST2"))
+
+    def test_ratings(self):
+        self.assertEqual([], self.dao.get_ratings(self.context, "TEST1"))
+
+        self.dao.save_ratings(self.context, "TEST1", [PlayerRating("player1", 1510.5, 1), PlayerRating("player2", 1489.5, 1)])
+        self.dao.save_ratings(self.context, "TEST1", [PlayerRating("player1", 1520.0, 2)])
+        self.assertEqual([PlayerRating("player1", 1520.0, 2), PlayerRating("player2", 1489.5, 1)], self.dao.get_ratings(self.context, "TEST1"))
+        self.assertEqual([PlayerRating("player2", 1489.5, 1)], self.dao.get_ratings(self.context, "TEST1", ["player2"]))
+        self.assertEqual([], self.dao.get_ratings(self.context, "TEST1", []))
+
+        version = self.dao.get_data_version(self.context, "TEST1")
+        self.dao.save_ratings(self.context, "TEST1", [PlayerRating("player3", 1500.0, 1)], replace_all=True)
+        self.assertEqual([PlayerRating("player3", 1500.0, 1)], self.dao.get_ratings(self.context, "TEST1"))
+        self.assertEqual(version + 1, self.dao.get_data_version(self.context, "TEST1"))
+
+    def test_apply_match_to_ratings(self):
+        self.dao.save_ratings(self.context, "TEST1", [PlayerRating("player1", 1600.0, 10)])
+        match = self.dao.get_match(self.context, "match1")
+        version = self.dao.get_data_version(self.context, "TEST1")
+        self.assertEqual(ratings.apply_match({"player1": PlayerRating("player1", 1600.0, 10)}, match), self.dao.apply_match_to_ratings(self.context, "TEST1", match))
+        self.assertEqual(version + 1, self.dao.get_data_version(self.context, "TEST1"))
+
+        # Requests that rate matches at the same time each start from the other's result, rather than both from the same ratings
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(lambda _: self.dao.apply_match_to_ratings(RequestContext(), "TEST1", match), range(8)))
+        self.assertEqual({"player1": 19, "player2": 9}, {rating.player_id: rating.matches_played for rating in self.dao.get_ratings(self.context, "TEST1")})
+
+    def test_replay_ratings(self):
+        # The matches from setUp predate ratings, so nobody has one until they're replayed
+        self.assertIn("TEST1", self.dao.get_match_user_ids())
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(0, player_ratings.main(["--user", "TEST1"], self.dao))
+        self.assertEqual({"player1": 2, "player2": 2, "player3": 1, "player4": 1}, {rating.player_id: rating.matches_played for rating in self.dao.get_ratings(self.context, "TEST1")})
+        self.assertCountEqual(ratings.replay(self.dao.get_matches(self.context, "TEST1")), self.dao.get_ratings(self.context, "TEST1"))
+
+    def test_stat_rollups(self):
+        match = Match("0", "TEST1", datetime(2020, 2, 3), replace(fixtures.player(), player_id="player1"), None, replace(fixtures.player(), player_id="player2"), None, [GameScore(11, 5)], [
+            Stat(None, "player1", 0, "WINNER", "DROP", "FOREHAND"),
+            Stat(None, "player1", 1, "WINNER", "DROP", "FOREHAND"),
+            Stat(None, "player2", 0, "ERROR", "SERVE", None),
+        ])
+        self.dao.create_match(self.context, match)
+        self.assertEqual([], self.dao.verify_stat_rollups("TEST1"))
+
+        # Whole months are served from the rollup, anything else from the raw stats, and the two agree
+        rolled_up = self.dao.get_player_stats(self.context, "TEST1", "player1")
+        self.assertEqual(PlayerStats("player1", 4, [ShotCount("DROP", "FOREHAND", "WINNER", 3), ShotCount("SERVE", None, "ERROR", 1)]), rolled_up)
+        self.assertEqual(rolled_up, self.dao.get_player_stats(self.context, "TEST1", "player1", StatsQuery(start=datetime(2019, 12, 31, 23))))
+        self.assertEqual(PlayerStats("player1", 2, [ShotCount("DROP", "FOREHAND", "WINNER", 2)]), self.dao.get_player_stats(self.context, "TEST1", "player1", StatsQuery(start=datetime(2020, 2, 1))))
+        self.assertEqual(2, self.dao.get_player_stats(self.context, "TEST1", "player1", StatsQuery(end=datetime(2020, 2, 1))).total)
+
+        self.dao.delete_match(self.context, "0")
+        self.assertEqual([], self.dao.verify_stat_rollups("TEST1"))
+        self.assertEqual(0, self.dao.get_player_stats(self.context, "TEST1", "player1", StatsQuery(start=datetime(2020, 2, 1))).total)
+        self.assertEqual(0, self.dao.get_player_stats(self.context, "TEST1", "player2").total)
+
+        # Deleting a player takes their matches' stats out too
+        self.dao.delete_player(self.context, "player1")
+        self.assertEqual([], self.dao.verify_stat_rollups("TEST1"))
+
+        # Drift is reported, and a rebuild fixes it
+        self.dao.execute("update stat_rollups set count = count + 1 where user_id = 'TEST1'")
+        self.assertNotEqual([], self.dao.verify_stat_rollups("TEST1"))
+        self.dao.rebuild_stat_rollups("TEST1")
+        self.assertEqual([], self.dao.verify_stat_rollups("TEST1"))
+
+    def test_search_matches(self):
+        def search(**kwargs):
+            return [match.match_id for match in self.dao.get_matches(self.context, "TEST1", match_filter=MatchFilter(**kwargs))]
+
+        self.assertEqual(["match2", "match1"], search())
+        self.assertEqual(["match2", "match1"], search(player_id="player2"))
+        self.assertEqual(["match2"], search(player_id="player3"))
+        self.assertEqual(["match2"], search(player_id="player1", partner_id="player2"))
+        self.assertEqual(["match1"], search(player_id="player2", opponent_id="player1", format="singles"))
+        self.assertEqual(["match2"], search(player_id="player1", opponent_id="player4", partner_id="player2"))
+        self.assertEqual([], search(player_id="player3", partner_id="player1"))
+        self.assertEqual(["match1"], search(end=datetime(2020, 1, 1, 0, 0, 2)))
+        self.assertEqual(["match2"], search(player_id="player1", start=datetime(2020, 1, 1, 0, 0, 2), format="doubles"))
+        # Other users' players don't match anything
+        self.assertEqual([], [match.match_id for match in self.dao.get_matches(self.context, "TEST2", match_filter=MatchFilter(player_id="player1"))])
+
+        # Filters combine with the cursor, and only the filtered matches' stats are loaded
+        page = self.dao.get_match_page(self.context, "TEST1", 1, None, match_filter=MatchFilter(player_id="player2"))
+        self.assertEqual(["match2"], [match.match_id for match in page.matches])
+        page = self.dao.get_match_page(self.context, "TEST1", 1, MatchCursor.decode(page.next_cursor), match_filter=MatchFilter(player_id="player2"))
+        self.assertEqual(["match1"], [match.match_id for match in page.matches])
+        self.assertEqual(2, len(page.matches[0].stats))
+        self.assertIsNone(page.next_cursor)
+
+        # New matches are searchable, deleted ones aren't
+        self.dao.create_match(self.context, Match("0", "TEST1", datetime(2020, 2, 3), replace(fixtures.player(), player_id="player3"), None, replace(fixtures.player(), player_id="player4"), None, [GameScore(11, 5)], []))
+        self.assertEqual(["0"], search(player_id="player3", opponent_id="player4"))
+        self.dao.delete_match(self.context, "0")
+        self.assertEqual([], search(player_id="player3", opponent_id="player4"))
+
+    def test_search_query_plans(self):
+        # Every table in every shape of search is read through an index, never scanned whole
+        for match_filter in [MatchFilter(), MatchFilter(start=datetime(2020, 1, 1), format="doubles"), MatchFilter(player_id="player1"),
+                             MatchFilter(player_id="player1", partner_id="player2", opponent_id="player3", end=datetime(2021, 1, 1))]:
+            for cursor in [None, MatchCursor(datetime(2020, 1, 1, 0, 0, 2), "match2")]:
+                sql, args = self.dao.match_search_sql("TEST1", match_filter, cursor, 11)
+                plan = plan_check.explain(self.dao, f"select m.id from matches m {sql}", args)
+                self.assertEqual([], plan_check.full_scans(plan), str(match_filter))
+                for step in plan:
+                    self.assertIsNotNone(step["key"], f"{match_filter} reads {step['table']} without an index")
+
+    def test_create_match_outcome(self):
+        self.dao.create_match(self.context, Match("0", "TEST1", datetime(2020, 2, 3), replace(fixtures.player(), player_id="player1"), None, replace(fixtures.player(), player_id="player2"), None,
+                                    [GameScore(11, 5), GameScore(9, 11), GameScore(11, 0)], []))
+        self.assertEqual((2, 1, 31, 16, 1), self.dao.get_one(lambda *row: row, "select team1_games, team2_games, team1_points, team2_points, winning_team from matches where id = '0'"))
+
+        self.dao.create_match(self.context, Match("1", "TEST1", datetime(2020, 2, 3), replace(fixtures.player(), player_id="player1"), None, replace(fixtures.player(), player_id="player2"), None,
+                                    [GameScore(11, 0), GameScore(9, 11)], []))
+        self.assertEqual((1, 1, 20, 11, None), self.dao.get_one(lambda *row: row, "select team1_games, team2_games, team1_points, team2_points, winning_team from matches where id = '1'"))
+
+    def test_pair_records(self):
+        # match1 was a singles win over player2, and match2 a doubles tie (a game each) with player2, won 12-11 on points
+        self.assertEqual([PairRecord("player1", "player2", 1, 1, 0, 9), PairRecord("player1", "player3", 1, 0, 0, 1), PairRecord("player1", "player4", 1, 0, 0, 1)],
+                         self.dao.get_pair_records(self.context, "player1", OPPONENT))
+        self.assertEqual([PairRecord("player1", "player2", 1, 0, 0, 1)], self.dao.get_pair_records(self.context, "player1", PARTNER))
+        self.assertEqual([PairRecord("player3", "player4", 1, 0, 0, -1)], self.dao.get_pair_records(self.context, "player3", PARTNER))
+
+        self.dao.create_match(self.context, Match("0", "TEST1", datetime(2020, 2, 3), replace(fixtures.player(), player_id="player3"), None, replace(fixtures.player(), player_id="player1"), None, [GameScore(11, 5)], []))
+        self.assertEqual(PairRecord("player1", "player3", 2, 0, 1, -5), self.dao.get_pair_records(self.context, "player1", OPPONENT)[0])
+        self.assertEqual(PairRecord("player3", "player1", 2, 1, 0, 5), self.dao.get_pair_records(self.context, "player3", OPPONENT)[0])
+
+        # Deleting a match (even twice) takes it back out
+        self.dao.delete_match(self.context, "match1")
+        self.dao.delete_match(self.context, "match1")
+        self.assertEqual(["player3", "player4"], [record.other_player_id for record in self.dao.get_pair_records(self.context, "player1", OPPONENT)])
+
+        # Deleting a player takes out their matches
+        self.dao.delete_player(self.context, "player4")
+        self.assertEqual([], self.dao.get_pair_records(self.context, "player1", PARTNER))
+        self.assertEqual([PairRecord("player1", "player3", 1, 0, 1, -6)], self.dao.get_pair_records(self.context, "player1", OPPONENT))
+
+        # Which is what a rebuild comes up with too
+        self.dao.rebuild_pair_records("TEST1")
+        self.assertEqual([PairRecord("player1", "player3", 1, 0, 1, -6)], self.dao.get_pair_records(self.context, "player1", OPPONENT))
+
+    def test_pair_records_backfill(self):
+        # Migration 010's records for the matches from setUp (without writing them, since it replaces everyone's) are the ones create_match kept
+        backfill = next(migration for migration in migrate.load_migrations() if migration.name == "pair_records_backfill").statements()[-1]
+        source = backfill[backfill.index("select"):]
+        columns = "user_id, player_id, other_player_id, relation, matches, wins, losses, point_differential"
+        self.assertEqual(self.dao.get_list(lambda *row: row, f"select {columns} from pair_records where user_id = 'TEST1' and matches > 0 order by player_id, relation, other_player_id"),
+                         self.dao.get_list(lambda *row: row, f"select {columns} from ({source}) backfill where user_id = 'TEST1' order by player_id, relation, other_player_id"))
 
     def test_get_matches(self):
-        matches = self.dao.get_matches("TEST1")
+        matches = self.dao.get_matches(self.context, "TEST1")
         self.assertEqual(2, len(matches))
 
         match = matches[0]
@@ -190,13 +459,109 @@ class Test(unittest.TestCase):
         stat = match.stats[1]
         self.assertIsNone(stat.shot_side)
 
+    def test_get_matches_projection(self):
+        with patch.object(self.dao, "get_stats") as get_stats_mock, patch.object(self.dao, "get_players") as get_players_mock:
+            matches = self.dao.get_matches(self.context, "TEST1", MatchQuery(frozenset(["match_id", "date", "scores"])))
+        # Neither stats nor players are queried when they weren't asked for
+        get_stats_mock.assert_not_called()
+        get_players_mock.assert_not_called()
+        self.assertEqual(["match2", "match1"], [match.match_id for match in matches])
+        self.assertEqual(2, len(matches[0].scores))
+        self.assertIsNone(matches[0].team1_player1)
+        self.assertIsNone(matches[0].stats)
+
+        page = self.dao.get_match_page(self.context, "TEST1", 10, None, MatchQuery(frozenset(["match_id", "date", "team1", "stats"])))
+        match = page.matches[1]
+        self.assertEqual("player1", match.team1_player1.player_id)
+        self.assertIsNone(match.team2_player1)
+        self.assertIsNone(match.scores)
+        self.assertEqual(2, len(match.stats))
+
+        # Partial matches aren't remembered as if they were whole
+        self.assertEqual("player2", self.dao.get_match(self.context, "match1").team2_player1.player_id)
+
+    def test_get_match_page(self):
+        page = self.dao.get_match_page(self.context, "TEST0", 10, None)
+        self.assertEqual(0, len(page.matches))
+        self.assertIsNone(page.next_cursor)
+
+        page = self.dao.get_match_page(self.context, "TEST1", 1, None)
+        self.assertEqual(["match2"], [match.match_id for match in page.matches])
+        self.assertEqual("player4", page.matches[0].team2_player2.player_id)
+        self.assertIsNotNone(page.next_cursor)
+
+        page = self.dao.get_match_page(self.context, "TEST1", 1, MatchCursor.decode(page.next_cursor))
+        self.assertEqual(["match1"], [match.match_id for match in page.matches])
+        # Stats are hydrated for the matches on the page
+        self.assertEqual(2, len(page.matches[0].stats))
+        self.assertIsNone(page.next_cursor)
+
+        # An exact fit doesn't produce an empty trailing page
+        page = self.dao.get_match_page(self.context, "TEST1", 2, None)
+        self.assertEqual(2, len(page.matches))
+        self.assertIsNone(page.next_cursor)
+
+    def test_get_match(self):
+        # Test non-existent match
+        self.assertIsNone(self.dao.get_match(self.context, "match0"))
+
+        match = self.dao.get_match(self.context, "match1")
+        self.assertIsNotNone(match)
+        self.assertEqual("match1", match.match_id)
+        self.assertEqual("TEST1", match.user_id)
+        self.assertEqual("player1", match.team1_player1.player_id)
+        self.assertEqual("p1.jpg", match.team1_player1.image_url)
+        self.assertIsNone(match.team1_player2)
+        self.assertEqual("player2", match.team2_player1.player_id)
+        self.assertIsNone(match.team2_player2)
+        self.assertEqual(1, len(match.scores))
+        # Only this match's stats should be loaded
+        self.assertEqual(2, len(match.stats))
+        self.assertTrue(all(stat.match_id == "match1" for stat in match.stats))
+
+        match = self.dao.get_match(self.context, "match2")
+        self.assertEqual(["player1", "player2", "player3", "player4"], [match.team1_player1.player_id, match.team1_player2.player_id, match.team2_player1.player_id, match.team2_player2.player_id])
+        self.assertEqual(0, len(match.stats))
+
+    def test_create_matches(self):
+        p1, p2 = replace(fixtures.player(), player_id="player1"), replace(fixtures.player(), player_id="player2")
+        version = self.dao.get_data_version(self.context, "TEST1")
+        matches = self.dao.create_matches(self.context, [
+            Match("batch1", "TEST1", datetime(2020, 3, 1), p1, None, p2, None, [GameScore(11, 3)], [Stat(None, "player1", 0, "WINNER", "DROP", None)]),
+            Match("batch2", "TEST1", datetime(2020, 3, 2), p2, None, p1, None, [GameScore(11, 9)], [Stat(None, "player1", 0, "WINNER", "DROP", None), Stat(None, "player2", 0, "ERROR", "DINK", None)]),
+        ])
+        # Built from what was written, with the players filled in
+        self.assertEqual(["batch1", "batch2"], [match.match_id for match in matches])
+        self.assertEqual("p1.jpg", matches[0].team1_player1.image_url)
+        self.assertEqual(["batch2", "batch2"], [stat.match_id for stat in matches[1].stats])
+
+        self.context = RequestContext()
+        read_back = self.dao.get_match(self.context, "batch2")
+        self.assertEqual((matches[1].date, matches[1].scores), (read_back.date, read_back.scores))
+        self.assertEqual(["player1", "player2"], sorted(stat.player_id for stat in read_back.stats))
+        self.assertEqual([], self.dao.verify_stat_rollups("TEST1"))
+        self.assertEqual(PairRecord("player1", "player2", 3, 2, 1, 15), self.dao.get_pair_records(self.context, "player1", OPPONENT)[0])
+        self.assertEqual(["batch2", "batch1"], [match.match_id for match in self.dao.get_matches(self.context, "TEST1", match_filter=MatchFilter(player_id="player1", format="singles", start=datetime(2020, 3, 1)))])
+        # One write, one version
+        self.assertEqual(version + 1, self.dao.get_data_version(self.context, "TEST1"))
+        self.assertEqual(["batch1", "match1"], sorted(self.dao.get_existing_match_ids(self.context, ["batch1", "match1", "nope"])))
+
+        # One bad match (an unknown player) and none of them are written
+        with self.assertRaises(ServiceException):
+            self.dao.create_matches(self.context, [
+                Match("batch3", "TEST1", datetime(2020, 3, 3), p1, None, p2, None, [GameScore(11, 3)], []),
+                Match("batch4", "TEST1", datetime(2020, 3, 3), p1, None, replace(p2, player_id="nobody"), None, [GameScore(11, 3)], []),
+            ])
+        self.assertEqual([], self.dao.get_existing_match_ids(self.context, ["batch3", "batch4"]))
+        self.assertEqual(version + 1, self.dao.get_data_version(self.context, "TEST1"))
+
     def test_create_match(self):
         p1, p2, p3, p4 = fixtures.player(), fixtures.player(), fixtures.player(), fixtures.player()
         p1.player_id = "player1"
         p2.player_id = "player2"
         p3.player_id = "player3"
         p4.player_id = "player4"
-        match = self.dao.create_match(Match(
+        match = self.dao.create_match(self.context, Match(
             match_id="0",
             user_id="TEST1",
             date=datetime(2020, 1, 1, 2, 3, 4),
@@ -258,7 +623,7 @@ class Test(unittest.TestCase):
         self.assertIsNone(stat.shot_side)
 
         # Create a match with as little as possible
-        match = self.dao.create_match(Match(
+        match = self.dao.create_match(self.context, Match(
             match_id="-1",
             user_id="TEST1",
             date=datetime(2020, 1, 1, 2, 3, 4),
@@ -283,7 +648,7 @@ class Test(unittest.TestCase):
 
         # If stats fail, everything rolls back
         with self.assertRaises(ServiceException):
-            self.dao.create_match(Match(
+            self.dao.create_match(self.context, Match(
                 match_id="-2",
                 user_id="TEST1",
                 date=datetime(2020, 1, 1, 2, 3, 4),
@@ -311,8 +676,66 @@ class Test(unittest.TestCase):
                     )
                 ]
             ))
-        self.assertIsNone(self.dao.get_match("-2"))
+        self.assertIsNone(self.dao.get_match(self.context, "-2"))
+
+    def test_create_match_players(self):
+        p1, p2 = replace(fixtures.player(), player_id="player1"), replace(fixtures.player(), player_id="player2")
+        self.dao.execute("insert into players (id, owner_user_id, is_owner, first_name, last_name) values ('player5', 'TEST2', True, 'first', 'last')")
+        self.dao.execute("update players set deleted_at = now(6) where id = 'player4'")
+
+        # Someone else's player, or a deleted one (whose row still satisfies the foreign key), can't be put in a match
+        for player_id in ["player5", "player4", "nobody"]:
+            with self.assertRaises(ServiceException) as e:
+                self.dao.create_match(RequestContext(), Match("bad", "TEST1", datetime(2020, 5, 1), p1, None, replace(p2, player_id=player_id), None, [GameScore(11, 3)], []))
+            self.assertEqual(400, e.exception.status_code)
+        self.assertEqual([], self.dao.get_existing_match_ids(self.context, ["bad"]))
+
+        # Matches saved before that was checked still load
+        self.dao.execute("""insert into matches (id, user_id, date, team1_player1_id, team2_player1_id, scores, team1_games, team2_games, team1_points, team2_points, winning_team)
+            values ('old', 'TEST1', '2020-05-01', 'player1', 'player4', '11-3', 1, 0, 11, 3, 1)""")
+        matches = {match.match_id: match for match in self.dao.get_matches(RequestContext(), "TEST1")}
+        self.assertEqual("player4", matches["old"].team2_player1.player_id)
+
+    def test_match_query_counts(self):
+        p1, p2 = replace(fixtures.player(), player_id="player1"), replace(fixtures.player(), player_id="player2")
+
+        def create_match(match_id):
+            with metrics.counting() as counts:
+                self.dao.create_match(RequestContext(), Match(match_id, "TEST1", datetime(2020, 4, 1), p1, None, p2, None, [GameScore(11, 3)], [Stat(None, "player1", 0, "WINNER", "DROP", None)]))
+            return counts.db_round_trips
+
+        def get_match(match_id):
+            with metrics.counting() as counts:
+                self.assertIsNotNone(self.dao.get_match(RequestContext(), match_id))
+            return counts.db_round_trips
+
+        # The match, its players, stats, rollups and pair records, the version bump, and reading the players back
+        self.assertEqual(7, create_match("count0"))
+        short_history = get_match("match1")
+        self.dao.create_matches(self.context, [Match(f"count{i}", "TEST1", datetime(2020, 4, 1), p1, None, p2, None, [GameScore(11, 3)], [Stat(None, "player1", 0, "WINNER", "DROP", None)]) for i in range(1, 50)])
+        # Neither depends on how many matches the user has
+        self.assertEqual(short_history, get_match("match1"))
+        self.assertEqual(7, create_match("count50"))
 
     def test_delete_match(self):
-        self.dao.delete_match("match1")
-        self.assertIsNone(self.dao.get_match("match1"))
+        self.dao.delete_match(self.context, "match1")
+        self.assertIsNone(self.dao.get_match(self.context, "match1"))
+        self.assertEqual(["match2"], [match.match_id for match in self.dao.get_matches(self.context, "TEST1")])
+        # The deleted match's stats aren't loaded any more either
+        self.assertEqual([], self.dao.get_stats("TEST1"))
+
+    def test_get_match_changes(self):
+        changes = self.dao.get_match_changes(self.context, "TEST1", None)
+        self.assertEqual(["match2", "match1"], [match.match_id for match in changes.matches])
+        self.assertEqual([], changes.deleted)
+
+        since = self.dao.get_one(lambda now: now, "select now(6)")
+        self.dao.create_match(self.context, Match("0", "TEST1", datetime(2020, 1, 1), replace(fixtures.player(), player_id="player1"), None, replace(fixtures.player(), player_id="player2"), None, [GameScore(11, 5)], []))
+        self.dao.delete_match(self.context, "match1")
+        self.context = RequestContext()
+
+        changes = self.dao.get_match_changes(self.context, "TEST1", since, MatchQuery(frozenset(["match_id", "date", "scores"])))
+        self.assertEqual(["0"], [match.match_id for match in changes.matches])
+        self.assertEqual([GameScore(11, 5)], changes.matches[0].scores)
+        self.assertIsNone(changes.matches[0].team1_player1)
+        self.assertEqual(["match1"], changes.deleted)
@@ -2,8 +2,10 @@ import unittest
 from datetime import datetime
 
 from domain.exceptions import DomainException
-from domain.match import Match, GameScore, Stat
+from domain.match import Match, GameScore, Stat, MatchCursor, MatchQuery, MatchOutcome, MatchFilter, MATCH_FIELDS
 from domain.player import Player
+from domain.stats import StatsQuery
+from domain.sync import Watermark
 from test import fixtures
 
 
@@ -74,8 +76,8 @@ class MatchTest(unittest.TestCase):
     def test_from_dict_min_scenario(self):
         min_dict = {
             "date": "2021-10-26T18:35:12Z",
-            "team1": [get_player_dict()],
-            "team2": [get_player_dict()],
+            "team1": [get_player_dict("player1")],
+            "team2": [get_player_dict("player2")],
             "scores": [get_score_dict()],
         }
         match = Match.from_dict(min_dict, fixtures.user())
@@ -84,12 +86,45 @@ class MatchTest(unittest.TestCase):
         self.assertIsNone(match.team2_player2)
         self.assertEqual(0, len(match.stats))
 
+    def test_batch_from_dict(self):
+        second = get_match_dict()
+        second["match_id"] = "second"
+        matches = Match.batch_from_dict({"matches": [get_match_dict(), second]}, fixtures.user())
+        self.assertEqual([Match.from_dict(get_match_dict(), fixtures.user()), Match.from_dict(second, fixtures.user())], matches)
+
+    def test_batch_from_dict_invalid(self):
+        missing_scores = get_match_dict()
+        del missing_scores["scores"]
+        for body, message in [
+            (None, "Missing required key 'matches' in request body"),
+            ({"matches": {}}, "Missing required key 'matches' in request body"),
+            ({"matches": []}, "No matches in the request body"),
+            ({"matches": [get_match_dict(), missing_scores]}, "Match 1: Missing required key 'scores' in request body"),
+            ({"matches": ["match"]}, "Match 0: Must be an object"),
+            ({"matches": [get_match_dict(), get_match_dict()]}, f"Match 1: Duplicate match_id '{get_match_dict()['match_id']}'"),
+        ]:
+            with self.assertRaises(DomainException) as e:
+                Match.batch_from_dict(body, fixtures.user())
+            self.assertEqual(message, e.exception.error_message)
+
     def test_from_dict_empty_id(self):
         no_id_dict = get_match_dict()
         no_id_dict["match_id"] = ""
         match = Match.from_dict(no_id_dict, fixtures.user())
         self.assertNotEqual("", match.match_id)
 
+    def test_from_dict_repeated_player(self):
+        repeated = get_match_dict()
+        repeated["team2"][1] = get_player_dict("player1")
+        with self.assertRaises(DomainException) as e:
+            Match.from_dict(repeated, fixtures.user())
+        self.assertEqual("The same player can't be in a match more than once", e.exception.error_message)
+
+        # New players (without an id) are all different ones
+        unsaved = get_match_dict()
+        unsaved["team1"], unsaved["team2"] = [get_player_dict(""), get_player_dict("")], [get_player_dict(""), get_player_dict("")]
+        self.assertEqual(4, len({player.player_id for player in Match.from_dict(unsaved, fixtures.user()).players()}))
+
     def test_from_dict_not_enough_players(self):
         with self.assertRaises(DomainException) as e:
             Match.from_dict({
@@ -133,6 +168,12 @@ class MatchTest(unittest.TestCase):
         self.assertEqual(1, len(d["scores"]))
         self.assertEqual(1, len(d["stats"]))
 
+    def test_to_dict_partially_loaded(self):
+        match = fixtures.match()
+        match.team1_player1, match.team1_player2, match.scores, match.stats = None, None, None, None
+        d = match.to_dict()
+        self.assertEqual(["match_id", "date", "team2"], list(d.keys()))
+
     def test_to_dict_min_scenario(self):
         match = fixtures.match()
         match.team1_player2 = None
@@ -142,6 +183,50 @@ class MatchTest(unittest.TestCase):
         self.assertEqual(1, len(d["team2"]))
 
 
+class MatchQueryTest(unittest.TestCase):
+    def test_defaults_to_everything(self):
+        self.assertEqual(frozenset(MATCH_FIELDS), MatchQuery.from_query_params({}).fields)
+        self.assertTrue(MatchQuery().includes("stats"))
+
+    def test_include(self):
+        # Asking for a projection at all drops stats unless they're included
+        self.assertEqual(frozenset(MATCH_FIELDS) - {"stats"}, MatchQuery.from_query_params({"include": ""}).fields)
+        self.assertEqual(frozenset(MATCH_FIELDS), MatchQuery.from_query_params({"include": "stats"}).fields)
+
+    def test_fields(self):
+        self.assertEqual({"match_id", "date", "scores"}, MatchQuery.from_query_params({"fields": "scores"}).fields)
+        self.assertEqual({"match_id", "date", "team1", "team2"}, MatchQuery.from_query_params({"fields": " team1 , team2,"}).fields)
+        self.assertEqual({"match_id", "date", "scores", "stats"}, MatchQuery.from_query_params({"fields": "scores", "include": "stats"}).fields)
+        self.assertEqual({"match_id", "date", "stats"}, MatchQuery.from_query_params({"fields": "stats"}).fields)
+
+    def test_unknown_values(self):
+        with self.assertRaises(DomainException) as e:
+            MatchQuery.from_query_params({"fields": "scores,password,email"})
+        self.assertEqual("Unknown field(s): email, password", e.exception.error_message)
+
+        with self.assertRaises(DomainException) as e:
+            MatchQuery.from_query_params({"include": "players"})
+        self.assertEqual("Unknown include(s): players", e.exception.error_message)
+
+
+class MatchFilterTest(unittest.TestCase):
+    def test_from_query_params(self):
+        self.assertTrue(MatchFilter.from_query_params({"fields": "scores"}).is_empty())
+        self.assertEqual(MatchFilter(player_id="p1", opponent_id="p2", start=datetime(2020, 1, 1), end=datetime(2021, 1, 1), format="singles"), MatchFilter.from_query_params({
+            "player_id": "p1", "opponent_id": "p2", "from": "2020-01-01T00:00:00Z", "to": "2021-01-01T00:00:00Z", "format": "singles"
+        }))
+
+    def test_invalid(self):
+        for query_params, message in [
+            ({"format": "mixed"}, "Invalid format: 'mixed'. Must be singles or doubles"),
+            ({"partner_id": "p2"}, "partner_id and opponent_id can only be used along with player_id"),
+            ({"player_id": "p1", "from": "yesterday"}, "Query parameter 'from' must be a date like 2021-10-26T18:35:12Z"),
+        ]:
+            with self.assertRaises(DomainException) as e:
+                MatchFilter.from_query_params(query_params)
+            self.assertEqual(message, e.exception.error_message)
+
+
 class GameScoreTest(unittest.TestCase):
     def test_from_dict(self):
         score = GameScore.from_dict(get_score_dict())
@@ -192,8 +277,67 @@ class StatTest(unittest.TestCase):
         assert_error_without_key("shot_type")
 
 
-def get_player_dict(): return {
-    "player_id": "player_id",
+class MatchOutcomeTest(unittest.TestCase):
+    def test_from_scores(self):
+        outcome = MatchOutcome.from_scores([GameScore(11, 5), GameScore(9, 11), GameScore(11, 0)])
+        self.assertEqual(MatchOutcome(2, 1, 31, 16), outcome)
+        self.assertEqual(1, outcome.winning_team)
+        self.assertEqual(2, MatchOutcome.from_scores([GameScore(3, 11)]).winning_team)
+
+    def test_tie(self):
+        # Decided by games won, not points
+        self.assertIsNone(MatchOutcome.from_scores([GameScore(11, 0), GameScore(9, 11)]).winning_team)
+
+
+class MatchCursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        cursor = MatchCursor(datetime(2021, 10, 26, 18, 35, 12, 123), "match|id")
+        self.assertEqual(cursor, MatchCursor.decode(cursor.encode()))
+
+    def test_decode_invalid(self):
+        for bad_cursor in ["", "not base64!", "bm9waXBl", "ä"]:
+            with self.assertRaises(DomainException) as e:
+                MatchCursor.decode(bad_cursor)
+            self.assertEqual(400, e.exception.status_code)
+            self.assertEqual("Invalid cursor", e.exception.error_message)
+
+
+class StatsQueryTest(unittest.TestCase):
+    def test_from_query_params(self):
+        self.assertEqual(StatsQuery(), StatsQuery.from_query_params({}))
+        self.assertEqual(
+            StatsQuery(datetime(2020, 1, 1), datetime(2020, 2, 1, 12), frozenset(["m1", "m2"])),
+            StatsQuery.from_query_params({"from": "2020-01-01T00:00:00Z", "to": "2020-02-01T12:00:00Z", "match_ids": "m1, m2,"})
+        )
+        # Explicitly asking for no matches is different from not filtering by match
+        self.assertEqual(frozenset(), StatsQuery.from_query_params({"match_ids": ""}).match_ids)
+
+    def test_invalid_date(self):
+        for bad_date in ["", "2020-01-01", "yesterday"]:
+            with self.assertRaises(DomainException) as e:
+                StatsQuery.from_query_params({"from": bad_date})
+            self.assertEqual("Query parameter 'from' must be a date like 2021-10-26T18:35:12Z", e.exception.error_message)
+
+
+class WatermarkTest(unittest.TestCase):
+    def test_round_trip(self):
+        watermark = Watermark(datetime(2021, 10, 26, 18, 35, 12, 123))
+        self.assertEqual(watermark, Watermark.decode(watermark.encode()))
+
+    def test_from_the_start(self):
+        self.assertEqual("0", Watermark(None).encode())
+        self.assertEqual(Watermark(None), Watermark.decode("0"))
+
+    def test_decode_invalid(self):
+        for bad_since in ["", "not base64!", "bm9waXBl", "ä"]:
+            with self.assertRaises(DomainException) as e:
+                Watermark.decode(bad_since)
+            self.assertEqual(400, e.exception.status_code)
+            self.assertEqual("Invalid since watermark", e.exception.error_message)
+
+
+def get_player_dict(player_id="player_id"): return {
+    "player_id": player_id,
     "first_name": "first_name",
     "last_name": "last_name",
     "image_url": "image_url",
@@ -225,12 +369,12 @@ def get_match_dict(): return {
     "match_id": "match_id",
     "date": "2021-10-26T18:35:12Z",
     "team1": [
-        get_player_dict(),
-        get_player_dict(),
+        get_player_dict("player1"),
+        get_player_dict("player2"),
     ],
     "team2": [
-        get_player_dict(),
-        get_player_dict(),
+        get_player_dict("player3"),
+        get_player_dict("player4"),
     ],
     "scores": [
         get_score_dict(),
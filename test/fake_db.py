@@ -0,0 +1,111 @@
+import re
+from datetime import datetime, timedelta
+
+USER_ROW = ("u1", "fb1", "First", "Last", None)
+PLAYER_IDS = ["p0", "p1", "p2", "p3"]
+
+
+def player_row(player_id):
+    return player_id, "u1", player_id == "p0", None, "First", player_id, "RIGHT", None, None, None, 3.5
+
+
+def match_value(column, index):
+    return {
+        "id": f"m{index}",
+        "user_id": "u1",
+        "date": datetime(2020, 1, 1) + timedelta(days=index),
+        "team1_player1_id": "p0",
+        "team1_player2_id": "p1",
+        "team2_player1_id": "p2",
+        "team2_player2_id": "p3",
+        "scores": "11-5,8-11,11-9",
+        "team1_games": 2,
+        "team2_games": 1,
+        "team1_points": 30,
+        "team2_points": 25,
+    }[column]
+
+
+class FakeCursor:
+    """Answers the Dao's queries with a user who has `history` matches between four players, two stats each"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, sql, args=None):
+        self.conn.statements.append(sql)
+        self.rows = self.answer(" ".join(sql.split()), list(args or []))
+
+    def executemany(self, sql, args):
+        self.conn.statements.append(sql)
+        self.rows = []
+
+    def answer(self, sql, args):
+        history = self.conn.history
+        if not sql.startswith("select"):
+            return []
+        if "from users where firebase_id" in sql:
+            return [USER_ROW] if self.conn.known_user else []
+        if "select data_version" in sql:
+            return [(1,)]
+        if "select now(6)" in sql:
+            return [(datetime(2021, 1, 1),)]
+        if sql.startswith("select date, id from matches"):
+            return [(datetime(2019, 1, 1), "m_old")] if history > 0 else []
+        if "from matches m" in sql or sql.startswith("select id, user_id, date, team1_player1_id"):
+            columns = [column.replace("m.", "") for column in re.match(r"select (.*?) from matches", sql).group(1).split(", ")]
+            single = "m.id = %s" in sql or " where id = %s" in sql
+            return [tuple(match_value(column, index) for column in columns) for index in range(1 if single else history)]
+        if "deleted_at is not null" in sql or sql.startswith("select id from matches where id in"):
+            return []
+        if "from players where id = %s" in sql:
+            return [player_row(args[0])] if args[0] in PLAYER_IDS else []
+        if "from players where id in" in sql:
+            return [player_row(player_id) for player_id in args[0] if player_id in PLAYER_IDS]
+        if "from players where owner_user_id" in sql:
+            return [player_row(player_id) for player_id in PLAYER_IDS]
+        if "from stats" in sql:
+            return [(f"m{index}", player_id, 0, "WINNER", "DROP", "FOREHAND") for index in range(history) for player_id in ["p0", "p2"]]
+        if "from player_ratings" in sql:
+            return [(player_id, 1500.0, history) for player_id in PLAYER_IDS]
+        return []
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if len(self.rows) > 0 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+class FakeConnection:
+    open = True
+
+    def __init__(self, history: int = 10, known_user: bool = True):
+        self.history = history
+        self.known_user = known_user
+        self.statements = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def ping(self, reconnect=False):
+        pass
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
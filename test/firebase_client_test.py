@@ -1,10 +1,13 @@
 import os
+import time
 import unittest
+from unittest.mock import patch
 
+from firebase_admin import auth
 from firebase_admin.auth import InvalidIdTokenError
 
 from test import properties
-from firebase_client import FirebaseClientImpl
+from firebase_client import FirebaseClientImpl, InvalidTokenError
 
 class Test(unittest.TestCase):
     @classmethod
@@ -21,12 +24,49 @@ class Test(unittest.TestCase):
         self.assertRaises(ValueError, lambda: self.client.get_firebase_user(""))
 
         # Test partially correct format
-        self.assertRaises(InvalidIdTokenError, lambda: self.client.get_firebase_user("a.bad.token"))
+        self.assertRaises(InvalidTokenError, lambda: self.client.get_firebase_user("a.bad.token"))
 
         # Test valid but old
-        self.assertRaises(InvalidIdTokenError, lambda: self.client.get_firebase_user(properties.old_firebase_token))
+        self.assertRaises(InvalidTokenError, lambda: self.client.get_firebase_user(properties.old_firebase_token))
 
         # In order to run this test, you'll have to generate a new valid token and place it in the properties file
         user = self.client.get_firebase_user(properties.valid_firebase_token)
         self.assertIsNotNone(user)
         print(user)
+
+
+class TokenCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FirebaseClientImpl()
+        self.client._auth = auth
+
+    def test_verified_tokens_are_cached(self):
+        claims = {"user_id": "fb1", "exp": time.time() + 3600}
+        with patch("firebase_admin.auth.verify_id_token", return_value=claims) as verify_mock:
+            self.assertEqual(claims, self.client.get_firebase_user("token"))
+            self.assertEqual(claims, self.client.get_firebase_user("token"))
+            verify_mock.assert_called_once_with("token")
+
+            # Different tokens are verified separately
+            self.client.get_firebase_user("other token")
+            self.assertEqual(2, verify_mock.call_count)
+
+    def test_expired_tokens_are_reverified(self):
+        with patch("firebase_admin.auth.verify_id_token", return_value={"user_id": "fb1", "exp": time.time() - 1}) as verify_mock:
+            self.client.get_firebase_user("token")
+            self.client.get_firebase_user("token")
+        self.assertEqual(2, verify_mock.call_count)
+
+    def test_failures_are_not_cached(self):
+        with patch("firebase_admin.auth.verify_id_token", side_effect=InvalidIdTokenError("bad")) as verify_mock:
+            self.assertRaises(InvalidTokenError, lambda: self.client.get_firebase_user("token"))
+            self.assertRaises(InvalidTokenError, lambda: self.client.get_firebase_user("token"))
+        self.assertEqual(2, verify_mock.call_count)
+
+    def test_firebase_is_initialized_lazily(self):
+        client = FirebaseClientImpl()
+        self.assertIsNone(client._auth)
+        with patch("firebase_admin.initialize_app") as initialize_mock, patch("firebase_admin.auth.verify_id_token", return_value={"user_id": "fb1", "exp": time.time() + 3600}):
+            client.get_firebase_user("token")
+            client.get_firebase_user("other token")
+        initialize_mock.assert_called_once()
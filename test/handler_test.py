@@ -1,23 +1,42 @@
+import io
 import json
+import os
+import subprocess
+import sys
 import unittest
+from contextlib import redirect_stdout
+from datetime import datetime
 from typing import Dict
-from unittest.mock import patch
+from unittest.mock import patch, ANY
 
 import handler
 from bl import Manager
-from domain.match import Match, GameScore, Stat
+from domain.match import Match, GameScore, Stat, MatchPage, MatchQuery, MatchFilter, BatchResult, CREATED
+from domain.pair import PairRecord
 from domain.player import Player
+from domain.rating import PlayerRating
+from domain.stats import StatsQuery, PlayerStats, ShotCount
+from domain.sync import PlayerChanges, MatchChanges
 from domain.user import User
+from request_context import RequestContext
 from test import fixtures
 
 
+USER = User("1", "fb1", "First", "Last", "hello.jpg")
+
+
+class SignedInManager(Manager):
+    """Authenticates every request as USER"""
+
+    def validate_token(self, context: RequestContext, token: str):
+        context.user = USER
+
+
 class Test(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        manager = Manager()
-        manager.user = User("1", "fb1", "First", "Last", "hello.jpg")
-        cls.handler = handler.Handler(manager)
+        cls.handler = handler.Handler(SignedInManager())
 
     def test_login_user(self):
         response = self.handler.handle(create_event("/users", method="POST"))
@@ -29,20 +48,119 @@ class Test(unittest.TestCase):
         self.assertEqual("Last", user["last_name"])
         self.assertEqual("hello.jpg", user["image_url"])
 
+    def test_request_context(self):
+        # Every request gets a context of its own, since the handler and manager are shared
+        with patch.object(self.handler.manager, "get_players", return_value=[]) as get_players_mock:
+            self.handler.handle(create_event("/players"))
+            self.handler.handle(create_event("/players"))
+        first_context, second_context = [call.args[0] for call in get_players_mock.call_args_list]
+        self.assertIsInstance(first_context, RequestContext)
+        self.assertEqual(USER, first_context.user)
+        self.assertIsNot(first_context, second_context)
+
+    def test_metrics(self):
+        # One line per request, and never the response itself
+        with patch.object(self.handler.manager, "get_data_version", return_value=1), patch.object(self.handler.manager, "get_players", return_value=[fixtures.player()]), \
+                redirect_stdout(io.StringIO()) as out:
+            response = self.handler.handle(create_event("/players"))
+        lines = out.getvalue().splitlines()
+        self.assertEqual(1, len(lines))
+        line = json.loads(lines[0])
+        self.assertEqual(("GET /players", 200, len(response["body"])), (line["route"], line["status"], line["bytes_out"]))
+        self.assertEqual({"total", "auth", "encode"}, set(line["ms"]))
+        self.assertNotIn(fixtures.player().first_name, out.getvalue())
+
+        with redirect_stdout(io.StringIO()) as out:
+            self.handler.handle({})
+        self.assertEqual((None, 400), (json.loads(out.getvalue())["route"], json.loads(out.getvalue())["status"]))
+
     def test_get_players(self):
         with patch.object(self.handler.manager, "get_players", return_value=[fixtures.player()]):
             response = self.handler.handle(create_event("/players"))
             self.assertEqual(200, response["statusCode"])
             self.assert_player_json(fixtures.player(), json.loads(response["body"])[0])
 
+    def test_conditional_get(self):
+        with patch.object(self.handler.manager, "get_data_version", return_value=1) as get_data_version_mock, \
+                patch.object(self.handler.manager, "get_players", return_value=[fixtures.player()]) as get_players_mock:
+            response = self.handler.handle(create_event("/players"))
+            self.assertEqual(200, response["statusCode"])
+            etag = response["headers"]["ETag"]
+            self.assertRegex(etag, r'^"[0-9a-f]+"$')
+
+            # A client that's up to date is told so without the players being loaded again
+            get_players_mock.reset_mock()
+            response = self.handler.handle(create_event("/players", headers={"If-None-Match": etag}))
+            self.assertEqual(304, response["statusCode"])
+            self.assertIsNone(response["body"])
+            self.assertEqual(etag, response["headers"]["ETag"])
+            get_players_mock.assert_not_called()
+
+            # Any of a list of tags can match
+            response = self.handler.handle(create_event("/players", headers={"if-none-match": f'"stale", {etag}'}))
+            self.assertEqual(304, response["statusCode"])
+
+            # Any write moves the version on, which changes the tag
+            get_data_version_mock.return_value = 2
+            response = self.handler.handle(create_event("/players", headers={"If-None-Match": etag}))
+            self.assertEqual(200, response["statusCode"])
+            self.assertNotEqual(etag, response["headers"]["ETag"])
+
+        with patch.object(self.handler.manager, "get_data_version", return_value=1), patch.object(self.handler.manager, "get_matches", return_value=[fixtures.match()]):
+            # Different resources and query params are different representations
+            tags = {self.handler.handle(create_event(resource, query_params=query_params))["headers"]["ETag"] for resource, query_params in [
+                ("/players", None), ("/matches", None), ("/matches", {"shape": "normalized"}), ("/matches", {"fields": "date"})
+            ]}
+            self.assertEqual(4, len(tags))
+
+        with patch.object(self.handler.manager, "get_data_version", return_value=1), patch.object(self.handler.manager, "get_players", return_value=[fixtures.player()]):
+            response = self.handler.handle(create_event("/players"))
+            self.assertEqual({"ETag": response["headers"]["ETag"], "Cache-Control": "private", "Vary": "X-Firebase-Token"}, response["headers"])
+
+            # Another user at the same version doesn't get the first one's players
+            with patch.object(self.handler.manager, "validate_token", side_effect=lambda context, token: setattr(context, "user", User("2", "fb2", "Other", "User", None))):
+                other_response = self.handler.handle(create_event("/players", headers={"If-None-Match": response["headers"]["ETag"]}))
+            self.assertEqual(200, other_response["statusCode"])
+            self.assertNotEqual(response["headers"]["ETag"], other_response["headers"]["ETag"])
+
+        # Only the cacheable GETs are tagged
+        with patch.object(self.handler.manager, "create_player", return_value=fixtures.player()), patch.object(Player, "from_dict", return_value=fixtures.player()):
+            self.assertNotIn("headers", self.handler.handle(create_event("/players", method="POST", body="{}")))
+
+    def test_get_player_changes(self):
+        with patch.object(self.handler.manager, "get_player_changes", return_value=PlayerChanges([fixtures.player()], ["deleted"], "watermark")) as get_player_changes_mock:
+            response = self.handler.handle(create_event("/players", query_params={"since": "since"}))
+            self.assertEqual(200, response["statusCode"])
+            body = json.loads(response["body"])
+            self.assert_player_json(fixtures.player(), body["players"][0])
+            self.assertEqual(["deleted"], body["deleted"])
+            self.assertEqual("watermark", body["watermark"])
+        get_player_changes_mock.assert_called_once_with(ANY, "since")
+
+    def test_get_player_stats(self):
+        stats = PlayerStats("ID", 3, [ShotCount("DROP", None, "WINNER", 3)])
+        with patch.object(self.handler.manager, "get_player_stats", return_value=stats) as get_player_stats_mock:
+            response = self.handler.handle(create_event("/players/{id}/stats", path_params={"id": "ID"}, query_params={"from": "2020-01-01T00:00:00Z", "match_ids": "m1,m2"}))
+            self.assertEqual(200, response["statusCode"])
+            self.assertEqual({"player_id": "ID", "total": 3, "shots": [{"shot_type": "DROP", "shot_side": None, "shot_result": "WINNER", "count": 3}]}, json.loads(response["body"]))
+            get_player_stats_mock.assert_called_once_with(ANY, "ID", StatsQuery(start=datetime(2020, 1, 1), match_ids=frozenset(["m1", "m2"])))
+
+            # Each player's stats are their own representation
+            other_response = self.handler.handle(create_event("/players/{id}/stats", path_params={"id": "OTHER"}, query_params={"from": "2020-01-01T00:00:00Z", "match_ids": "m1,m2"}))
+            self.assertNotEqual(response["headers"]["ETag"], other_response["headers"]["ETag"])
+
+        response = self.handler.handle(create_event("/players/{id}/stats", path_params={"id": "ID"}, query_params={"to": "yesterday"}))
+        self.assertEqual(400, response["statusCode"])
+        self.assertEqual("Query parameter 'to' must be a date like 2021-10-26T18:35:12Z", json.loads(response["body"])["error"])
+
     def test_create_player(self):
         with patch.object(self.handler.manager, "create_player", return_value=fixtures.player()) as create_player_mock:
             with patch.object(Player, "from_dict", return_value=fixtures.player()) as from_dict_mock:
                 response = self.handler.handle(create_event("/players", method="POST", body="{}"))
                 self.assertEqual(200, response["statusCode"])
                 self.assert_player_json(fixtures.player(), json.loads(response["body"]))
-            from_dict_mock.assert_called_once_with({}, self.handler.manager.user)
-        create_player_mock.assert_called_once_with(fixtures.player())
+            from_dict_mock.assert_called_once_with({}, USER)
+        create_player_mock.assert_called_once_with(ANY, fixtures.player())
 
     def test_update_player(self):
         with patch.object(self.handler.manager, "update_player", return_value=fixtures.player()) as update_player_mock:
@@ -50,15 +168,15 @@ class Test(unittest.TestCase):
                 response = self.handler.handle(create_event("/players/{id}", method="PUT", path_params={"id": "ID"}, body="{}"))
                 self.assertEqual(200, response["statusCode"])
                 self.assert_player_json(fixtures.player(), json.loads(response["body"]))
-            from_dict_mock.assert_called_once_with({}, self.handler.manager.user)
-        update_player_mock.assert_called_once_with("ID", fixtures.player())
+            from_dict_mock.assert_called_once_with({}, USER)
+        update_player_mock.assert_called_once_with(ANY, "ID", fixtures.player())
 
     def test_delete_player(self):
         with patch.object(self.handler.manager, "delete_player", return_value={}) as delete_player_mock:
             response = self.handler.handle(create_event("/players/{id}", method="DELETE", path_params={"id": "ID"}))
             self.assertEqual(200, response["statusCode"])
             self.assertEqual({}, json.loads(response["body"]))
-        delete_player_mock.assert_called_once_with("ID")
+        delete_player_mock.assert_called_once_with(ANY, "ID")
 
     def test_get_matches(self):
         with patch.object(self.handler.manager, "get_matches", return_value=[fixtures.match()]):
@@ -66,21 +184,137 @@ class Test(unittest.TestCase):
             self.assertEqual(200, response["statusCode"])
             self.assert_match_json(fixtures.match(), json.loads(response["body"])[0])
 
+    def test_get_match_changes(self):
+        with patch.object(self.handler.manager, "get_match_changes", return_value=MatchChanges([fixtures.match()], ["deleted"], "watermark")) as get_match_changes_mock:
+            response = self.handler.handle(create_event("/matches", query_params={"since": "since", "fields": "scores"}))
+            self.assertEqual(200, response["statusCode"])
+            body = json.loads(response["body"])
+            self.assert_match_json(fixtures.match(), body["matches"][0])
+            self.assertEqual(["deleted"], body["deleted"])
+            self.assertEqual("watermark", body["watermark"])
+            get_match_changes_mock.assert_called_once_with(ANY, "since", MatchQuery(frozenset(["match_id", "date", "scores"])))
+
+            for query_params in [{"since": "since", "limit": "10"}, {"since": "since", "cursor": "cursor"}, {"since": "since", "shape": "normalized"}]:
+                response = self.handler.handle(create_event("/matches", query_params=query_params))
+                self.assertEqual(400, response["statusCode"])
+                self.assertEqual("The since parameter can't be combined with limit, cursor or shape", json.loads(response["body"])["error"])
+
+            response = self.handler.handle(create_event("/matches", query_params={"since": "since", "player_id": "p1"}))
+            self.assertEqual(400, response["statusCode"])
+            self.assertEqual("The since parameter can't be combined with filters", json.loads(response["body"])["error"])
+
+    def test_get_ratings(self):
+        with patch.object(self.handler.manager, "get_ratings", return_value=[PlayerRating("a", 1512.5, 3)]):
+            response = self.handler.handle(create_event("/ratings"))
+            self.assertEqual(200, response["statusCode"])
+            self.assertEqual([{"player_id": "a", "rating": 1512.5, "matches_played": 3}], json.loads(response["body"]))
+            self.assertIn("ETag", response["headers"])
+
+    def test_get_pair_records(self):
+        records = [PairRecord("ID", "other", 3, 2, 1, 12)]
+        for resource, method in [("/players/{id}/head-to-head", "get_head_to_head"), ("/players/{id}/partners", "get_partners")]:
+            with patch.object(self.handler.manager, method, return_value=records) as get_records_mock:
+                response = self.handler.handle(create_event(resource, path_params={"id": "ID"}))
+                self.assertEqual(200, response["statusCode"])
+                self.assertEqual([{"player_id": "ID", "other_player_id": "other", "matches": 3, "wins": 2, "losses": 1, "point_differential": 12}], json.loads(response["body"]))
+                self.assertIn("ETag", response["headers"])
+            get_records_mock.assert_called_once_with(ANY, "ID")
+
+    def test_get_match_page(self):
+        with patch.object(self.handler.manager, "get_match_page", return_value=MatchPage([fixtures.match()], "CURSOR")) as get_match_page_mock:
+            response = self.handler.handle(create_event("/matches", query_params={"limit": "10"}))
+            self.assertEqual(200, response["statusCode"])
+            body = json.loads(response["body"])
+            self.assertEqual("CURSOR", body["next_cursor"])
+            self.assert_match_json(fixtures.match(), body["matches"][0])
+            get_match_page_mock.assert_called_once_with(ANY, 10, None, MatchQuery(), MatchFilter())
+
+            # A cursor alone falls back to the default page size
+            self.handler.handle(create_event("/matches", query_params={"cursor": "CURSOR"}))
+            get_match_page_mock.assert_called_with(ANY, handler.DEFAULT_PAGE_SIZE, "CURSOR", MatchQuery(), MatchFilter())
+
+        response = self.handler.handle(create_event("/matches", query_params={"limit": "ten"}))
+        self.assertEqual(400, response["statusCode"])
+        self.assertEqual("Query parameter 'limit' must be an integer", json.loads(response["body"])["error"])
+
+    def test_get_matches_projection(self):
+        match = fixtures.match()
+        match.team1_player1, match.team1_player2, match.team2_player1, match.team2_player2, match.stats = None, None, None, None, None
+        with patch.object(self.handler.manager, "get_matches", return_value=[match]) as get_matches_mock:
+            response = self.handler.handle(create_event("/matches", query_params={"fields": "scores"}))
+            self.assertEqual(200, response["statusCode"])
+            self.assertEqual(["date", "match_id", "scores"], sorted(json.loads(response["body"])[0].keys()))
+        get_matches_mock.assert_called_once_with(ANY, MatchQuery(frozenset(["match_id", "date", "scores"])), MatchFilter())
+
+        response = self.handler.handle(create_event("/matches", query_params={"fields": "scores,password"}))
+        self.assertEqual(400, response["statusCode"])
+        self.assertEqual("Unknown field(s): password", json.loads(response["body"])["error"])
+
+    def test_get_matches_filtered(self):
+        with patch.object(self.handler.manager, "get_match_page", return_value=MatchPage([fixtures.match()], None)) as get_match_page_mock:
+            response = self.handler.handle(create_event("/matches", query_params={"limit": "10", "player_id": "p1", "partner_id": "p2", "from": "2020-01-01T00:00:00Z", "format": "doubles"}))
+            self.assertEqual(200, response["statusCode"])
+        get_match_page_mock.assert_called_once_with(ANY, 10, None, MatchQuery(), MatchFilter(player_id="p1", partner_id="p2", start=datetime(2020, 1, 1), format="doubles"))
+
+        response = self.handler.handle(create_event("/matches", query_params={"format": "triples"}))
+        self.assertEqual(400, response["statusCode"])
+        self.assertEqual("Invalid format: 'triples'. Must be singles or doubles", json.loads(response["body"])["error"])
+
+    def test_get_matches_normalized(self):
+        match = fixtures.match()
+        match.team1_player1.player_id = "p1"
+        with patch.object(self.handler.manager, "get_matches", return_value=[match]):
+            response = self.handler.handle(create_event("/matches", query_params={"shape": "normalized"}))
+            self.assertEqual(200, response["statusCode"])
+            body = json.loads(response["body"])
+            self.assert_player_json(match.team1_player1, body["players"]["p1"])
+            self.assertEqual("p1", body["matches"][0]["team1"][0])
+            self.assertIsNone(body["next_cursor"])
+
+        with patch.object(self.handler.manager, "get_match_page", return_value=MatchPage([match], "CURSOR")):
+            response = self.handler.handle(create_event("/matches", query_params={"shape": "normalized", "limit": "1"}))
+            body = json.loads(response["body"])
+            self.assertEqual(["p1", "player_id"], sorted(body["players"].keys()))
+            self.assertEqual("CURSOR", body["next_cursor"])
+
+        response = self.handler.handle(create_event("/matches", query_params={"shape": "flat"}))
+        self.assertEqual(400, response["statusCode"])
+
     def test_create_match(self):
         with patch.object(self.handler.manager, "create_match", return_value=fixtures.match()) as create_match_mock:
             with patch.object(Match, "from_dict", return_value=fixtures.match()) as from_dict_mock:
                 response = self.handler.handle(create_event("/matches", method="POST", body="{}"))
                 self.assertEqual(200, response["statusCode"])
                 self.assert_match_json(fixtures.match(), json.loads(response["body"]))
-            from_dict_mock.assert_called_once_with({}, self.handler.manager.user)
-        create_match_mock.assert_called_once_with(fixtures.match())
+            from_dict_mock.assert_called_once_with({}, USER)
+        create_match_mock.assert_called_once_with(ANY, fixtures.match())
+
+    def test_create_matches(self):
+        with patch.object(self.handler.manager, "create_matches", return_value=[BatchResult("ID", CREATED)]) as create_matches_mock:
+            with patch.object(Match, "batch_from_dict", return_value=[fixtures.match()]) as batch_from_dict_mock:
+                response = self.handler.handle(create_event("/matches/batch", method="POST", body='{"matches": []}'))
+                self.assertEqual(200, response["statusCode"])
+                self.assertEqual([{"match_id": "ID", "status": "CREATED"}], json.loads(response["body"]))
+            batch_from_dict_mock.assert_called_once_with({"matches": []}, USER)
+        create_matches_mock.assert_called_once_with(ANY, [fixtures.match()])
+
+        response = self.handler.handle(create_event("/matches/batch", method="POST", body='{"matches": [{}]}'))
+        self.assertEqual(400, response["statusCode"])
+        self.assertEqual("Match 0: Missing required key 'team1' in request body", json.loads(response["body"])["error"])
 
     def test_delete_match(self):
         with patch.object(self.handler.manager, "delete_match", return_value={}) as delete_match_mock:
             response = self.handler.handle(create_event("/matches/{id}", method="DELETE", path_params={"id": "ID"}))
             self.assertEqual(200, response["statusCode"])
             self.assertEqual({}, json.loads(response["body"]))
-        delete_match_mock.assert_called_once_with("ID")
+        delete_match_mock.assert_called_once_with(ANY, "ID")
+
+    def test_cold_start_defers_heavy_imports(self):
+        # Importing the handler and serving a request that needs neither the db nor firebase shouldn't load either library (nor numpy, which only analytics uses)
+        script = "import sys, handler; handler.Handler.get_instance(); handler.handle({'resource': '/players', 'httpMethod': 'GET', 'headers': {}}, None); print(sorted(m for m in ['firebase_admin', 'pymysql', 'numpy'] if m in sys.modules))"
+        env = dict(os.environ, PYTHONPATH=os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+        result = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True, check=True)
+        self.assertEqual("[]", result.stdout.strip().splitlines()[-1])
 
     def assert_player_json(self, expected_player: Player, json_player: Dict):
         self.assertEqual(expected_player.player_id, json_player["player_id"])
@@ -119,11 +353,11 @@ class Test(unittest.TestCase):
         self.assertEqual(expected_stat.shot_side, json_stat["shot_side"])
 
 
-def create_event(resource, path_params=None, method="GET", body=None, query_params=None):
+def create_event(resource, path_params=None, method="GET", body=None, query_params=None, headers=None):
     event = {
         "resource": resource,
         "httpMethod": method,
-        "headers": {"X-Firebase-Token": ""}
+        "headers": {"X-Firebase-Token": "", **(headers or {})}
     }
     if path_params is not None:
         event["pathParameters"] = path_params
@@ -0,0 +1,141 @@
+import io
+import json
+import unittest
+from contextlib import redirect_stdout
+from unittest.mock import MagicMock, patch
+
+import metrics
+from connection_pool import ConnectionPool
+from da import DaoImpl
+from domain.player import Player
+from metrics import RequestMetrics
+
+
+class StepClock:
+    """Moves on by a second every time it's read"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+class Test(unittest.TestCase):
+    def test_to_dict(self):
+        request_metrics = RequestMetrics(clock=StepClock())
+        request_metrics.route = "GET /players"
+        with request_metrics.span(metrics.AUTH):
+            pass
+        request_metrics.add_query("select 1", 0.002, 3)
+        request_metrics.add_query("select 2", 0.001, 0)
+        request_metrics.finish({"statusCode": 200, "body": '{"name": "Zoë"}'})
+        self.assertEqual({
+            "metrics": "request",
+            "route": "GET /players",
+            "status": 200,
+            "db_round_trips": 2,
+            "rows": 3,
+            "bytes_out": 16,
+            "ms": {"auth": 1000.0, "db": 3.0},
+        }, request_metrics.to_dict())
+
+    def test_recording(self):
+        request_metrics = RequestMetrics()
+        out = io.StringIO()
+        with redirect_stdout(out):
+            with metrics.recording(request_metrics):
+                self.assertIs(request_metrics, metrics.current_metrics.get())
+                with metrics.span(metrics.ENCODE):
+                    pass
+        self.assertIsNone(metrics.current_metrics.get())
+        lines = out.getvalue().splitlines()
+        self.assertEqual(1, len(lines))
+        self.assertEqual({"total", "encode"}, set(json.loads(lines[0])["ms"]))
+
+        # A request that blows up is still logged
+        request_metrics = RequestMetrics()
+        with redirect_stdout(io.StringIO()) as out, self.assertRaises(RuntimeError):
+            with metrics.recording(request_metrics):
+                raise RuntimeError()
+        self.assertEqual(500, json.loads(out.getvalue())["status"])
+
+    def test_budget_overrun(self):
+        def request(route, auth_queries, queries):
+            request_metrics = RequestMetrics()
+            request_metrics.route = route
+            with request_metrics.span(metrics.AUTH):
+                for sql in auth_queries:
+                    request_metrics.add_query(sql, 0.001, 1)
+            for sql in queries:
+                request_metrics.add_query(sql, 0.001, 1)
+            return request_metrics.budget_overrun()
+
+        with patch.dict(metrics.QUERY_BUDGETS, {"GET /players": 2}):
+            # Authenticating doesn't count against the route
+            self.assertIsNone(request("GET /players", ["select user"] * 2, ["select version", "select players"]))
+            self.assertIsNone(request("GET /unbudgeted", [], ["select a", "select b", "select c"]))
+
+            overrun = request("GET /players", ["select user"], ["select version", "select players", "select stats"])
+            self.assertEqual((1, 3, 2, {}), (overrun["auth_round_trips"], overrun["route_round_trips"], overrun["route_budget"], overrun["repeated"]))
+            self.assertIsNotNone(request("GET /players", ["select user"] * (metrics.AUTH_QUERY_BUDGET + 1), []))
+
+            # The same statement over and over is flagged, even within budget
+            overrun = request("GET /unbudgeted", [], ["select player\n   where id = %s"] * 3)
+            self.assertEqual({"select player where id = %s": 3}, overrun["repeated"])
+
+    def test_parse_budget_overrides(self):
+        self.assertEqual({"GET /ratings": 3}, metrics.parse_budget_overrides('{"GET /ratings": 3}'))
+        for raw in ['{"GET /ratings": ', '["GET /ratings"]', '{"GET /ratings": "3"}', '{"GET /ratings": 2.5}', '{"GET /ratings": true}', '{"GET /ratings": -1}']:
+            with redirect_stdout(io.StringIO()) as out:
+                self.assertEqual({}, metrics.parse_budget_overrides(raw), raw)
+            self.assertTrue(out.getvalue().startswith("Ignoring QUERY_BUDGETS: "), raw)
+
+    def test_strict_budgets(self):
+        request_metrics = RequestMetrics()
+        request_metrics.route = "GET /ratings"
+        with patch.dict(metrics.QUERY_BUDGETS, {"GET /ratings": 0}), redirect_stdout(io.StringIO()) as out:
+            with patch.object(metrics, "strict_budgets", False), metrics.recording(request_metrics):
+                request_metrics.add_query("select 1", 0.001, 1)
+            self.assertEqual(["request", "query_budget_exceeded"], [json.loads(line)["metrics"] for line in out.getvalue().splitlines()])
+
+            with patch.object(metrics, "strict_budgets", True), self.assertRaises(metrics.QueryBudgetExceeded):
+                with metrics.recording(RequestMetrics()) as request_metrics:
+                    request_metrics.route = "GET /ratings"
+                    request_metrics.add_query("select 1", 0.001, 1)
+
+            # The request's own error wins
+            with patch.object(metrics, "strict_budgets", True), self.assertRaises(RuntimeError):
+                with metrics.recording(RequestMetrics()) as request_metrics:
+                    request_metrics.route = "GET /ratings"
+                    request_metrics.add_query("select 1", 0.001, 1)
+                    raise RuntimeError()
+
+    def test_nothing_is_recorded_outside_a_request(self):
+        with metrics.span(metrics.MAPPING), metrics.query("select 1") as query:
+            query.rows = 1
+        self.assertIsNone(metrics.current_metrics.get())
+
+    def test_dao_queries_are_counted(self):
+        conn = MagicMock()
+        cur = conn.cursor.return_value.__enter__.return_value
+        cur.fetchall.return_value = [("p1", "1", True, None, "First", "Last", None, None, None, None, None), ("p2", "1", False, None, "Other", "Last", None, None, None, None, None)]
+        cur.fetchone.return_value = (3,)
+        dao = DaoImpl(ConnectionPool(lambda: conn))
+
+        request_metrics = RequestMetrics()
+        with redirect_stdout(io.StringIO()), metrics.recording(request_metrics):
+            self.assertEqual(2, len(dao.get_list(Player, "select ... from players where owner_user_id = %s", "1")))
+            self.assertEqual(3, dao.get_one(int, "select data_version from users where id = %s", "1"))
+            dao.execute("update users set data_version = data_version + 1 where id = %s", "1")
+            dao.execute_many("insert into a values (%s)", [1], [2])
+        self.assertEqual(4, request_metrics.db_round_trips)
+        self.assertEqual(3, request_metrics.rows)
+        self.assertEqual(["select ... from players where owner_user_id = %s", "select data_version from users where id = %s"], [query.sql for query in request_metrics.queries[:2]])
+        self.assertIn(metrics.DB, request_metrics.phases)
+        self.assertIn(metrics.MAPPING, request_metrics.phases)
+
+
+if __name__ == '__main__':
+    unittest.main()
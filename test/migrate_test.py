@@ -0,0 +1,116 @@
+import io
+import unittest
+from contextlib import redirect_stdout
+from unittest.mock import MagicMock
+
+import pymysql
+
+import migrate
+from connection_pool import ConnectionPool
+from da import DaoImpl
+from migrate import Migration, MigrationException
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        # A db that has the tables in self.tables, the indexes in self.indexes and has had the versions in self.applied, recording every statement it's sent
+        self.tables, self.applied, self.executed = set(), set(), []
+        # Index name -> (non_unique, its comma separated columns)
+        self.indexes = {}
+        self.conn = MagicMock()
+        self.cursor = self.conn.cursor.return_value.__enter__.return_value
+        self.cursor.execute.side_effect = self.execute
+        self.dao = DaoImpl(ConnectionPool(lambda: self.conn))
+        self.migrations = [
+            Migration(0, "baseline", "create table if not exists users (id varchar(64));"),
+            Migration(1, "user_index", "-- Already there on older dbs\ncreate index users_id on users (id);"),
+            Migration(2, "backfill", "alter table users\n    add column x int;\n\nupdate users set x = 1;\n"),
+        ]
+
+    def execute(self, sql, args=None):
+        self.executed.append(sql)
+        if "information_schema.tables" in sql:
+            self.cursor.fetchone.return_value = (1 if args[0] in self.tables else 0,)
+        elif sql.startswith("select version from schema_migrations"):
+            self.cursor.fetchall.return_value = [(version,) for version in sorted(self.applied)]
+        elif sql.startswith("insert") and "into schema_migrations" in sql:
+            self.applied.add(args[0])
+        elif "information_schema.statistics" in sql:
+            self.cursor.fetchall.return_value = [(name, non_unique, columns) for name, (non_unique, columns) in self.indexes.items()]
+        elif sql.startswith("create index users_id") and "users_id" in self.tables:
+            raise pymysql.err.OperationalError(1061, "Duplicate key name 'users_id'")
+
+    def test_load_migrations(self):
+        migrations = migrate.load_migrations()
+        self.assertEqual(list(range(len(migrations))), [migration.version for migration in migrations])
+        for migration in migrations:
+            self.assertGreater(len(migration.statements()), 0, migration.name)
+        # Run without args, so the % stays as it is
+        self.assertIn("date_format(m.date, '%Y-%m-01')", next(migration for migration in migrations if migration.name == "stat_rollups").statements()[1])
+
+    def test_statements(self):
+        self.assertEqual(["alter table users\n    add column x int", "update users set x = 1"], self.migrations[2].statements())
+        self.assertEqual(["create index users_id on users (id)"], self.migrations[1].statements())
+
+    def test_apply(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertEqual(self.migrations, migrate.apply(self.dao, self.migrations))
+        self.assertEqual({0, 1, 2}, self.applied)
+        self.assertIn("update users set x = 1", self.executed)
+
+        # Everything's been applied, so a second run doesn't send any migration statements
+        self.executed.clear()
+        self.tables.add("schema_migrations")
+        self.assertEqual([], migrate.apply(self.dao, self.migrations))
+        self.assertNotIn("update users set x = 1", self.executed)
+
+    def test_apply_skips_ddl_that_was_already_applied(self):
+        self.tables.update({"schema_migrations", "users_id"})
+        self.applied.add(0)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertEqual(self.migrations[1:], migrate.apply(self.dao, self.migrations))
+        self.assertIn("Skipping, already applied: Duplicate key name 'users_id'", output.getvalue())
+        self.assertEqual({0, 1, 2}, self.applied)
+
+        # Anything else still fails, without recording the migration
+        self.cursor.execute.side_effect = lambda sql, args=None: (_ for _ in ()).throw(pymysql.err.ProgrammingError(1064, "You have an error in your SQL syntax"))
+        with self.assertRaises(pymysql.err.ProgrammingError):
+            migrate.run_statement(self.dao, "create tabel")
+
+    def test_apply_skips_indexes_on_the_same_columns(self):
+        self.indexes = {"PRIMARY": (0, "id"), "players_owner": (1, "owner_user_id,last_name")}
+        output = io.StringIO()
+        with redirect_stdout(output):
+            migrate.run_statement(self.dao, "create unique index users_id on users (`id`)")
+            migrate.run_statement(self.dao, "create index players_owner_user_id_last_name on players (owner_user_id, last_name(10) desc)")
+        self.assertEqual(["  Skipping, already applied: PRIMARY has the same columns", "  Skipping, already applied: players_owner has the same columns"], output.getvalue().splitlines())
+        self.assertFalse(any(sql.startswith("create") for sql in self.executed))
+
+        # Only the leading columns, or a unique index where there's only a plain one, are still created
+        for statement in ["create index players_owner_user_id on players (owner_user_id)", "create unique index players_owner_user_id_last_name on players (owner_user_id, last_name)"]:
+            migrate.run_statement(self.dao, statement)
+            self.assertEqual(statement, self.executed[-1])
+
+    def test_apply_requires_a_baseline(self):
+        # Tables were made by hand, and none of the migrations were recorded
+        self.tables.add("users")
+        with self.assertRaises(MigrationException):
+            migrate.apply(self.dao, self.migrations)
+        self.assertEqual(set(), self.applied)
+
+        migrate.baseline(self.dao, self.migrations, 1)
+        self.tables.add("schema_migrations")
+        self.assertEqual({0, 1}, self.applied)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertEqual([self.migrations[2]], migrate.apply(self.dao, self.migrations))
+
+    def test_status(self):
+        self.tables.add("schema_migrations")
+        self.applied.add(0)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertEqual(0, migrate.main(["status"], self.dao, self.migrations))
+        self.assertEqual("applied  000_baseline\npending  001_user_index\npending  002_backfill\n", output.getvalue())
@@ -0,0 +1,42 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import plan_check
+from plan_check import RecordingCursor
+
+
+class Test(unittest.TestCase):
+    def test_recording_cursor(self):
+        statements = []
+        cur = RecordingCursor(MagicMock(), statements)
+        cur.execute("select 1 from users where id = %s", ("1",))
+        cur.executemany("insert into stats (id) values (%s)", [("a",), ("b",)])
+        cur.fetchall()
+        self.assertEqual([("select 1 from users where id = %s", ("1",)), ("insert into stats (id) values (%s)", ("a",))], statements)
+        cur.cur.fetchall.assert_called_once()
+
+    def test_full_scans(self):
+        plan = [
+            {"table": "m", "type": "ref", "key": "matches_user_id_deleted_at_date"},
+            {"table": "s", "type": "ALL", "key": None},
+            {"table": "<derived2>", "type": "ALL", "key": None},
+            {"table": None, "type": None, "key": None},
+        ]
+        self.assertEqual([plan[1]], plan_check.full_scans(plan))
+
+    def test_check(self):
+        statements = [
+            ("select id from matches where user_id = %s", ("user1",)),
+            ("select id from matches where user_id = %s", ("user2",)),
+            ("insert into stats (id) values (%s)", ("a",)),
+            ("  update players set notes = %s where id = %s", ("notes", "p1")),
+        ]
+        plans = {
+            "select id from matches where user_id = %s": [{"table": "matches", "type": "ALL", "key": None}],
+            "  update players set notes = %s where id = %s": [{"table": "players", "type": "range", "key": "PRIMARY"}],
+        }
+        with patch.object(plan_check, "explain", side_effect=lambda dao, sql, args: plans[sql]) as explain_mock:
+            self.assertEqual([("select id from matches where user_id = %s", {"table": "matches", "type": "ALL", "key": None})], plan_check.check(None, statements))
+        # Each distinct statement is explained once, with the first args it was sent with. Inserts of values aren't explained at all
+        self.assertEqual(2, explain_mock.call_count)
+        explain_mock.assert_any_call(None, "select id from matches where user_id = %s", ("user1",))
@@ -0,0 +1,50 @@
+import io
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import player_ratings
+import ratings
+from bl import RATINGS_QUERY
+from da import Dao
+from domain.match import GameScore
+from test import fixtures
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dao = Dao()
+
+    def test_replay(self):
+        # A history that was played before ratings existed, so there aren't any to start from
+        history = []
+        for i in range(3):
+            match = fixtures.match()
+            match.match_id, match.date, match.scores = f"match{i}", datetime(2020, 1, 1) + timedelta(days=i), [GameScore(11, 2 * i)]
+            match.team1_player1.player_id, match.team1_player2.player_id, match.team2_player1.player_id, match.team2_player2.player_id = "p1", "p2", "p3", "p4"
+            history.append(match)
+
+        with patch.object(self.dao, "get_match_user_ids", return_value=["USER1", "USER2"]), patch.object(self.dao, "get_matches", side_effect=lambda context, user_id, query: history if user_id == "USER1" else []) as get_matches_mock, \
+                patch.object(self.dao, "save_ratings") as save_ratings_mock:
+            self.assertEqual((0, "Replayed the ratings of 2 user(s)\n"), self.run_main([]))
+        self.assertEqual([RATINGS_QUERY, RATINGS_QUERY], [call.args[2] for call in get_matches_mock.call_args_list])
+        [(_, user1_id, user1_ratings), (_, user2_id, user2_ratings)] = [call.args for call in save_ratings_mock.call_args_list]
+        self.assertEqual(("USER1", ratings.replay(history)), (user1_id, user1_ratings))
+        self.assertEqual([3, 3, 3, 3], [rating.matches_played for rating in user1_ratings])
+        # Everyone on the winning team has gone up from where they started
+        self.assertTrue(all(rating.rating > ratings.INITIAL_RATING for rating in user1_ratings[:2]))
+        self.assertEqual(("USER2", []), (user2_id, user2_ratings))
+        self.assertTrue(all(call.kwargs == {"replace_all": True} for call in save_ratings_mock.call_args_list))
+
+    def test_one_user(self):
+        with patch.object(self.dao, "get_match_user_ids") as get_match_user_ids_mock, patch.object(self.dao, "get_matches", return_value=[]) as get_matches_mock, patch.object(self.dao, "save_ratings"):
+            self.assertEqual((0, "Replayed the ratings of 1 user(s)\n"), self.run_main(["--user", "USER1"]))
+        get_match_user_ids_mock.assert_not_called()
+        self.assertEqual("USER1", get_matches_mock.call_args.args[1])
+
+    def run_main(self, argv):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            result = player_ratings.main(argv, self.dao)
+        return result, output.getvalue()
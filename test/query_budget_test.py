@@ -0,0 +1,129 @@
+import io
+import json
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime
+from unittest.mock import patch
+
+import metrics
+from async_bl import AsyncManagerImpl
+from async_da import AsyncDaoImpl
+from async_handler import AsyncHandler
+from bl import ManagerImpl
+from connection_pool import ConnectionPool
+from da import DaoImpl
+from domain.sync import Watermark
+from firebase_client import FirebaseClient
+from handler import Handler
+from metrics import QueryBudgetExceeded
+from test.fake_db import FakeConnection
+from test.handler_test import create_event
+
+SINCE = Watermark(datetime(2020, 1, 1)).encode()
+MATCH = {
+    "date": "2022-01-01T00:00:00+0000",
+    "team1": [{"player_id": "p0", "first_name": "First", "last_name": "p0"}, {"player_id": "p1", "first_name": "First", "last_name": "p1"}],
+    "team2": [{"player_id": "p2", "first_name": "First", "last_name": "p2"}, {"player_id": "p3", "first_name": "First", "last_name": "p3"}],
+    "scores": [{"team1_score": 11, "team2_score": 5}],
+    "stats": [{"player_id": "p0", "game_index": 0, "shot_result": "WINNER", "shot_type": "DROP"}],
+}
+BACKDATED_MATCH = dict(MATCH, date="2018-01-01T00:00:00+0000")
+PLAYER = json.dumps({"first_name": "First", "last_name": "Last"})
+
+# Every branch of every route
+EVENTS = [
+    create_event("/users", method="POST"),
+    create_event("/players"),
+    create_event("/players", query_params={"since": SINCE}),
+    create_event("/players", method="POST", body=PLAYER),
+    create_event("/players/{id}", path_params={"id": "p1"}, method="PUT", body=PLAYER),
+    create_event("/players/{id}", path_params={"id": "p1"}, method="DELETE"),
+    create_event("/players/{id}/stats", path_params={"id": "p1"}),
+    create_event("/players/{id}/head-to-head", path_params={"id": "p1"}),
+    create_event("/players/{id}/partners", path_params={"id": "p1"}),
+    create_event("/matches"),
+    create_event("/matches", query_params={"player_id": "p1", "include": "stats"}),
+    create_event("/matches", query_params={"limit": "5"}),
+    create_event("/matches", query_params={"since": SINCE}),
+    create_event("/matches", method="POST", body=json.dumps(MATCH)),
+    create_event("/matches", method="POST", body=json.dumps(BACKDATED_MATCH)),
+    create_event("/matches/batch", method="POST", body=json.dumps({"matches": [MATCH, BACKDATED_MATCH]})),
+    create_event("/matches/{id}", path_params={"id": "m0"}, method="DELETE"),
+    create_event("/ratings"),
+]
+
+
+class SignedInFirebaseClient(FirebaseClient):
+    def get_firebase_user(self, token: str):
+        return {"user_id": "fb1", "name": "First Last"}
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patcher = patch.object(metrics, "strict_budgets", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handle(self, event, history=10, known_user=True):
+        """The response, and how many statements it took"""
+        conn = FakeConnection(history, known_user)
+        with redirect_stdout(io.StringIO()):
+            response = Handler(ManagerImpl(SignedInFirebaseClient(), DaoImpl(ConnectionPool(lambda: conn)))).handle(event)
+        return response, len(conn.statements)
+
+    async def handle_async(self, event, history=10, known_user=True):
+        conn = FakeConnection(history, known_user)
+        dao = AsyncDaoImpl(DaoImpl(ConnectionPool(lambda: conn, max_size=4)))
+        try:
+            with redirect_stdout(io.StringIO()):
+                response = await AsyncHandler(AsyncManagerImpl(SignedInFirebaseClient(), dao)).handle(event)
+        finally:
+            dao.executor.shutdown()
+        return response, len(conn.statements)
+
+    async def test_routes_are_within_budget(self):
+        for event in EVENTS:
+            with self.subTest(method=event["httpMethod"], resource=event["resource"], params=event.get("queryStringParameters")):
+                # The same number of statements however long the history is
+                response, short_history = self.handle(event, history=1)
+                self.assertEqual(200, response["statusCode"], response["body"])
+                self.assertEqual(short_history, self.handle(event, history=200)[1])
+
+                response, async_statements = await self.handle_async(event, history=200)
+                self.assertEqual(200, response["statusCode"], response["body"])
+                self.assertLessEqual(abs(async_statements - short_history), 1)
+
+        # A first login is authentication's worst case
+        self.assertEqual(200, self.handle(create_event("/users", method="POST"), known_user=False)[0]["statusCode"])
+
+    def test_query_per_row_is_caught(self):
+        original = DaoImpl.get_players_by_ids
+
+        def one_by_one(dao, context, player_ids):
+            return [player for player_id in player_ids for player in original(dao, context, [player_id])]
+
+        with patch.object(DaoImpl, "get_players_by_ids", one_by_one):
+            with self.assertRaises(QueryBudgetExceeded) as e:
+                self.handle(create_event("/matches", query_params={"limit": "5"}))
+        overrun = json.loads(str(e.exception))
+        self.assertEqual("GET /matches", overrun["route"])
+        [(sql, count)] = overrun["repeated"].items()
+        self.assertIn("from players where id in", sql)
+        self.assertEqual(4, count)
+
+        # Outside of tests it's only logged
+        with patch.object(DaoImpl, "get_players_by_ids", one_by_one), patch.object(metrics, "strict_budgets", False), redirect_stdout(io.StringIO()) as out:
+            response = Handler(ManagerImpl(SignedInFirebaseClient(), DaoImpl(ConnectionPool(lambda: FakeConnection())))).handle(create_event("/matches", query_params={"limit": "5"}))
+        self.assertEqual(200, response["statusCode"])
+        self.assertEqual(["request", "query_budget_exceeded"], [json.loads(line)["metrics"] for line in out.getvalue().splitlines()])
+
+    def test_budget_is_per_route(self):
+        with patch.dict(metrics.QUERY_BUDGETS, {"GET /ratings": 1}):
+            with self.assertRaises(QueryBudgetExceeded) as e:
+                self.handle(create_event("/ratings"))
+        overrun = json.loads(str(e.exception))
+        self.assertEqual((1, 2, 1, {}), (overrun["auth_round_trips"], overrun["route_round_trips"], overrun["route_budget"], overrun["repeated"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
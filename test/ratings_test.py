@@ -0,0 +1,66 @@
+import unittest
+from dataclasses import replace
+from datetime import datetime
+
+import ratings
+from domain.match import Match, GameScore
+from domain.rating import PlayerRating
+from test import fixtures
+
+
+def match(match_id, day, team1, team2, scores):
+    players = [replace(fixtures.player(), player_id=player_id) if player_id is not None else None for player_id in team1 + team2]
+    return Match(match_id, "user", datetime(2020, 1, day), players[0], players[1], players[2], players[3], [GameScore(*score) for score in scores], [])
+
+
+class Test(unittest.TestCase):
+    def test_winner_gains_what_loser_loses(self):
+        a, b = ratings.apply_match({}, match("1", 1, ["a", None], ["b", None], [(11, 5)]))
+        self.assertEqual(("a", 1), (a.player_id, a.matches_played))
+        self.assertGreater(a.rating, ratings.INITIAL_RATING)
+        self.assertAlmostEqual(ratings.INITIAL_RATING * 2, a.rating + b.rating)
+
+    def test_doubles(self):
+        new_ratings = ratings.apply_match({"a": PlayerRating("a", 1600, 5)}, match("1", 1, ["a", "b"], ["c", "d"], [(5, 11), (11, 9), (8, 11)]))
+        by_id = {rating.player_id: rating for rating in new_ratings}
+        # Team 2 won, and both partners move by the same amount
+        self.assertLess(by_id["a"].rating, 1600)
+        self.assertAlmostEqual(1600 - by_id["a"].rating, ratings.INITIAL_RATING - by_id["b"].rating)
+        self.assertAlmostEqual(by_id["c"].rating, by_id["d"].rating)
+        self.assertEqual(6, by_id["a"].matches_played)
+
+    def test_margin(self):
+        close, _ = ratings.apply_match({}, match("1", 1, ["a", None], ["b", None], [(11, 9)]))
+        sweep, _ = ratings.apply_match({}, match("1", 1, ["a", None], ["b", None], [(11, 0)]))
+        self.assertGreater(sweep.rating, close.rating)
+
+        # An upset moves ratings further than the expected result
+        favourite = {"a": PlayerRating("a", 1700, 10)}
+        expected, _ = ratings.apply_match(favourite, match("1", 1, ["a", None], ["b", None], [(11, 9)]))
+        _, upset = ratings.apply_match(favourite, match("1", 1, ["a", None], ["b", None], [(9, 11)]))
+        self.assertGreater(upset.rating - ratings.INITIAL_RATING, expected.rating - 1700)
+
+    def test_tie(self):
+        a, b = ratings.apply_match({}, match("1", 1, ["a", None], ["b", None], [(11, 9), (9, 11)]))
+        self.assertAlmostEqual(ratings.INITIAL_RATING, a.rating)
+
+    def test_replay_matches_incremental(self):
+        history = [
+            match("1", 1, ["a", None], ["b", None], [(11, 5)]),
+            match("2", 2, ["a", "c"], ["b", "d"], [(7, 11), (11, 2), (11, 13)]),
+            match("3", 3, ["d", None], ["a", None], [(11, 0)]),
+            match("4", 3, ["c", "b"], ["d", "a"], [(11, 9)]),
+        ]
+        current = {}
+        for m in history:
+            current.update({rating.player_id: rating for rating in ratings.apply_match(current, m)})
+
+        # The replay puts the history in (date, id) order itself
+        replayed = {rating.player_id: rating for rating in ratings.replay(reversed(history))}
+        self.assertEqual(current.keys(), replayed.keys())
+        for player_id in current:
+            self.assertAlmostEqual(current[player_id].rating, replayed[player_id].rating)
+            self.assertEqual(current[player_id].matches_played, replayed[player_id].matches_played)
+
+    def test_replay_nothing(self):
+        self.assertEqual([], ratings.replay([]))
@@ -0,0 +1,89 @@
+import datetime
+import json
+import unittest
+from unittest.mock import patch
+
+import serialization
+from domain.base import DomainBase
+from domain.exceptions import ServiceException
+from domain.match import MatchPage, NormalizedMatches
+from test import fixtures
+
+
+def legacy_dumps(body):
+    # The json.dumps(default=...) serialization that the precompiled encoders replace
+    def default_serialize(x):
+        if isinstance(x, datetime.datetime):
+            return x.strftime("%Y-%m-%dT%H:%M:%SZ")
+        elif isinstance(x, DomainBase):
+            return x.to_dict()
+        else:
+            return x.__dict__
+
+    return json.dumps(body, default=default_serialize)
+
+
+class Test(unittest.TestCase):
+    def assert_same_json(self, body):
+        expected = json.loads(legacy_dumps(body))
+        self.assertEqual(expected, json.loads(serialization.dumps(body)))
+        with patch.object(serialization, "orjson", None):
+            self.assertEqual(expected, json.loads(serialization.dumps(body)))
+
+    def test_matches_legacy_output(self):
+        singles = fixtures.match()
+        singles.team1_player2 = None
+        singles.team2_player2 = None
+        singles.stats[0].shot_side = None
+        singles.date = datetime.datetime(2021, 10, 26, 18, 35, 12, 999, tzinfo=datetime.timezone(datetime.timedelta(hours=-6)))
+
+        self.assert_same_json(fixtures.user())
+        self.assert_same_json(fixtures.player())
+        self.assert_same_json([fixtures.match(), singles])
+        self.assert_same_json(MatchPage([fixtures.match()], "cursor"))
+        self.assert_same_json(MatchPage([], None))
+
+        projected = fixtures.match()
+        projected.team2_player1, projected.team2_player2, projected.stats = None, None, None
+        self.assert_same_json([projected])
+        self.assert_same_json({"error": ServiceException("message").error_message})
+        self.assert_same_json({})
+
+    def test_normalized_matches(self):
+        match1, match2 = fixtures.match(), fixtures.match()
+        match1.team1_player1.player_id, match1.team1_player2.player_id, match1.team2_player1.player_id, match1.team2_player2.player_id = "p1", "p2", "p3", "p4"
+        match2.team1_player1.player_id, match2.team2_player1.player_id = "p1", "p5"
+        match2.team1_player2, match2.team2_player2 = None, None
+
+        d = json.loads(serialization.dumps(NormalizedMatches([match1, match2], "cursor")))
+        # Every player is sent exactly once
+        self.assertEqual(["p1", "p2", "p3", "p4", "p5"], sorted(d["players"].keys()))
+        self.assertEqual(fixtures.player().first_name, d["players"]["p5"]["first_name"])
+        self.assertEqual(["p1", "p2"], d["matches"][0]["team1"])
+        self.assertEqual(["p3", "p4"], d["matches"][0]["team2"])
+        self.assertEqual(["p1"], d["matches"][1]["team1"])
+        self.assertEqual(["p5"], d["matches"][1]["team2"])
+        # Everything else is the same as the embedded shape
+        embedded = json.loads(legacy_dumps(match1))
+        self.assertEqual({k: v for k, v in embedded.items() if k not in ("team1", "team2")}, {k: v for k, v in d["matches"][0].items() if k not in ("team1", "team2")})
+        self.assertEqual("cursor", d["next_cursor"])
+
+        self.assertEqual({"players": {}, "matches": [], "next_cursor": None}, json.loads(serialization.dumps(NormalizedMatches([]))))
+
+    def test_format_datetime(self):
+        self.assertEqual("2020-01-02T03:04:05Z", serialization.format_datetime(datetime.datetime(2020, 1, 2, 3, 4, 5, 678)))
+        self.assertEqual("0999-01-02T03:04:05Z", serialization.format_datetime(datetime.datetime(999, 1, 2, 3, 4, 5)))
+
+    def test_encoders_are_precompiled(self):
+        for klass in [type(fixtures.player()), type(fixtures.match()), type(fixtures.stat()), type(fixtures.score()), type(fixtures.user()), MatchPage]:
+            self.assertIn(klass, serialization.encoders)
+
+    def test_unregistered_domain_classes(self):
+        # Anything else still works, and gets an encoder the first time it's seen
+        error = ServiceException("message", 418)
+        self.assertEqual({"error_message": "message", "status_code": 418}, json.loads(serialization.dumps(error)))
+        self.assertIn(ServiceException, serialization.encoders)
+
+
+if __name__ == '__main__':
+    unittest.main()
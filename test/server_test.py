@@ -0,0 +1,179 @@
+import asyncio
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+
+import server
+from async_bl import AsyncManager
+from async_handler import AsyncHandler
+from bl import Manager
+from domain.player import Player
+from domain.stats import PlayerStats
+from domain.user import User
+from handler import Handler
+from request_context import RequestContext
+from test import fixtures
+
+
+class SignedInManager(Manager):
+    def validate_token(self, context: RequestContext, token: str):
+        context.user = User("1", "fb1", "First", "Last", "hello.jpg")
+
+
+class SignedInAsyncManager(AsyncManager):
+    async def validate_token(self, context: RequestContext, token: str):
+        context.user = User("1", "fb1", "First", "Last", "hello.jpg")
+
+
+class EventTest(unittest.TestCase):
+    def test_match_resource(self):
+        self.assertEqual(("/players", {}), server.match_resource("/players"))
+        self.assertEqual(("/players", {}), server.match_resource("/players/"))
+        self.assertEqual(("/players/{id}/head-to-head", {"id": "p 1"}), server.match_resource("/players/p%201/head-to-head"))
+        self.assertEqual(("/matches/batch", {}), server.match_resource("/matches/batch"))
+        self.assertEqual(("/matches/{id}", {"id": "m1"}), server.match_resource("/matches/m1"))
+        self.assertIsNone(server.match_resource("/matches/m1/stats"))
+        self.assertIsNone(server.match_resource("/"))
+
+    def test_to_event(self):
+        self.assertEqual({
+            "resource": "/players/{id}/stats",
+            "path": "/players/p1/stats",
+            "httpMethod": "GET",
+            "headers": {"X-Firebase-Token": "token"},
+            "queryStringParameters": {"from": "2020-01-01T00:00:00Z", "match_ids": "m2"},
+            "pathParameters": {"id": "p1"},
+            "body": None,
+            "isBase64Encoded": False,
+        }, server.to_event("GET", "/players/p1/stats?from=2020-01-01T00:00:00Z&match_ids=m1&match_ids=m2", {"X-Firebase-Token": "token"}, None))
+
+        event = server.to_event("POST", "/players", {}, b'{"first_name": "First"}')
+        self.assertIsNone(event["queryStringParameters"])
+        self.assertIsNone(event["pathParameters"])
+        self.assertEqual('{"first_name": "First"}', event["body"])
+        self.assertIsNone(server.to_event("GET", "/admin", {}, None))
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = server.PooledHTTPServer(("127.0.0.1", 0), Handler(SignedInManager()), workers=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_requests_reach_the_handler(self):
+        stats = PlayerStats("p1", 0, [])
+        with patch.object(self.server.handler.manager, "get_player_stats", return_value=stats) as get_player_stats_mock:
+            status, headers, body = self.request("GET", "/players/p1/stats")
+        self.assertEqual(200, status)
+        self.assertEqual("application/json", headers["Content-Type"])
+        self.assertIn("ETag", headers)
+        self.assertEqual({"player_id": "p1", "total": 0, "shots": []}, json.loads(body))
+        self.assertEqual("p1", get_player_stats_mock.call_args.args[1])
+
+        with patch.object(self.server.handler.manager, "create_player", return_value=fixtures.player()) as create_player_mock, \
+                patch.object(Player, "from_dict", return_value=fixtures.player()) as from_dict_mock:
+            status, _, body = self.request("POST", "/players", b'{"first_name": "First"}')
+        self.assertEqual(200, status)
+        self.assertEqual(fixtures.player().player_id, json.loads(body)["player_id"])
+        self.assertEqual({"first_name": "First"}, from_dict_mock.call_args.args[0])
+        create_player_mock.assert_called_once()
+
+    def test_errors(self):
+        status, _, body = self.request("GET", "/admin")
+        self.assertEqual(404, status)
+        self.assertEqual({"error": "Not found"}, json.loads(body))
+
+        status, _, body = self.request("GET", "/matches", query="limit=ten")
+        self.assertEqual(400, status)
+        self.assertEqual("Query parameter 'limit' must be an integer", json.loads(body)["error"])
+
+    def request(self, method, path, body=None, query=None):
+        url = f"http://127.0.0.1:{self.server.server_port}{path}" + (f"?{query}" if query is not None else "")
+        request = urllib.request.Request(url, data=body, method=method, headers={"X-Firebase-Token": "token"})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+
+class AsyncServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = server.AsyncHTTPServer(AsyncHandler(SignedInAsyncManager()))
+        await self.server.start("127.0.0.1", 0)
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    async def test_requests_reach_the_handler(self):
+        with patch.object(self.server.handler.manager, "get_player_stats", return_value=PlayerStats("p1", 0, [])) as get_player_stats_mock:
+            status, headers, body = await self.request("GET", "/players/p1/stats")
+        self.assertEqual(200, status)
+        self.assertEqual("application/json", headers["Content-Type"])
+        self.assertIn("ETag", headers)
+        self.assertEqual({"player_id": "p1", "total": 0, "shots": []}, json.loads(body))
+        self.assertEqual("p1", get_player_stats_mock.call_args.args[1])
+
+        with patch.object(self.server.handler.manager, "create_player", return_value=fixtures.player()), \
+                patch.object(Player, "from_dict", return_value=fixtures.player()) as from_dict_mock:
+            status, _, body = await self.request("POST", "/players", b'{"first_name": "First"}')
+        self.assertEqual(200, status)
+        self.assertEqual({"first_name": "First"}, from_dict_mock.call_args.args[0])
+
+    async def test_errors(self):
+        status, _, body = await self.request("GET", "/admin")
+        self.assertEqual(404, status)
+        self.assertEqual({"error": "Not found"}, json.loads(body))
+
+        status, _, body = await self.request("GET", "/matches?limit=ten")
+        self.assertEqual(400, status)
+        self.assertEqual("Query parameter 'limit' must be an integer", json.loads(body)["error"])
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.server.server_port)
+        writer.write(b"nonsense\r\n\r\n")
+        self.assertTrue((await reader.read()).startswith(b"HTTP/1.0 400 Bad Request\r\n"))
+        writer.close()
+
+        with patch.object(self.server.handler.manager, "get_ratings", side_effect=RuntimeError("boom")), patch("traceback.print_exc"):
+            status, _, body = await self.request("GET", "/ratings")
+        self.assertEqual(500, status)
+
+    async def test_requests_are_multiplexed(self):
+        # None of the requests can finish until all of them have started
+        count = 200
+        started = []
+        all_started = asyncio.Event()
+
+        async def get_players(context):
+            started.append(context)
+            if len(started) == count:
+                all_started.set()
+            await asyncio.wait_for(all_started.wait(), 5)
+            return []
+
+        with patch.object(self.server.handler.manager, "get_players", side_effect=get_players):
+            responses = await asyncio.gather(*[self.request("GET", "/players") for _ in range(count)])
+        self.assertEqual([200] * count, [status for status, _, _ in responses])
+
+    async def request(self, method, path, body=None):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.server.server_port)
+        headers = {"Host": "127.0.0.1", "X-Firebase-Token": "token", "Content-Length": str(len(body or b""))}
+        writer.write(f"{method} {path} HTTP/1.1\r\n".encode("latin-1") + "".join(f"{name}: {value}\r\n" for name, value in headers.items()).encode("latin-1") + b"\r\n" + (body or b""))
+        # The server closes the connection after every response
+        response = await reader.read()
+        writer.close()
+        head, body = response.split(b"\r\n\r\n", 1)
+        status_line, *header_lines = head.decode("latin-1").split("\r\n")
+        return int(status_line.split(" ")[1]), dict(line.split(": ", 1) for line in header_lines), body
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import io
+import unittest
+from contextlib import redirect_stdout
+from datetime import date
+from unittest.mock import patch
+
+import stat_rollups
+from da import Dao
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dao = Dao()
+
+    def test_verify(self):
+        with patch.object(self.dao, "verify_stat_rollups", return_value=[]) as verify_mock, patch.object(self.dao, "rebuild_stat_rollups") as rebuild_mock:
+            self.assertEqual((0, "0 mismatched rollup(s)\n"), self.run_main(["verify", "--user", "USER1"]))
+        verify_mock.assert_called_once_with("USER1")
+        rebuild_mock.assert_not_called()
+
+    def test_rebuild_is_verified(self):
+        mismatch = ("USER1", "player1", date(2020, 1, 1), "DROP", "", "WINNER", 2, 1)
+        with patch.object(self.dao, "verify_stat_rollups", return_value=[mismatch]), patch.object(self.dao, "rebuild_stat_rollups") as rebuild_mock:
+            result, output = self.run_main(["rebuild"])
+        self.assertEqual(1, result)
+        rebuild_mock.assert_called_once_with(None)
+        self.assertIn("MISMATCH user=USER1 player=player1 month=2020-01-01 DROP/-/WINNER: 2 in stats, 1 rolled up", output)
+
+    def run_main(self, argv):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            result = stat_rollups.main(argv, self.dao)
+        return result, output.getvalue()
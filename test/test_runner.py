@@ -5,6 +5,9 @@ import sys
 sys.path.append(os.path.abspath(__file__ + "/../../"))
 sys.path.append(os.path.abspath(__file__ + "/../../src/"))
 
+# Going over a route's query budget fails the test rather than just being logged
+os.environ["QUERY_BUDGET_STRICT"] = "1"
+
 import unittest
 
 import domain_test
@@ -12,6 +15,21 @@ import da_test
 import bl_test
 import handler_test
 import firebase_client_test
+import connection_pool_test
+import cache_test
+import serialization_test
+import stat_rollups_test
+import player_ratings_test
+import analytics_test
+import ratings_test
+import migrate_test
+import plan_check_test
+import server_test
+import async_da_test
+import async_bl_test
+import async_handler_test
+import metrics_test
+import query_budget_test
 
 loader = unittest.TestLoader()
 suite = unittest.TestSuite()
@@ -20,10 +38,36 @@ suite.addTests(loader.loadTestsFromTestCase(domain_test.GameScoreTest))
 suite.addTests(loader.loadTestsFromTestCase(domain_test.StatTest))
 suite.addTests(loader.loadTestsFromTestCase(domain_test.MatchTest))
 suite.addTests(loader.loadTestsFromTestCase(domain_test.PlayerTest))
+suite.addTests(loader.loadTestsFromTestCase(domain_test.MatchCursorTest))
+suite.addTests(loader.loadTestsFromTestCase(domain_test.MatchOutcomeTest))
+suite.addTests(loader.loadTestsFromTestCase(domain_test.MatchQueryTest))
+suite.addTests(loader.loadTestsFromTestCase(domain_test.MatchFilterTest))
+suite.addTests(loader.loadTestsFromTestCase(domain_test.StatsQueryTest))
+suite.addTests(loader.loadTestsFromTestCase(domain_test.WatermarkTest))
 suite.addTests(loader.loadTestsFromTestCase(da_test.Test))
 suite.addTests(loader.loadTestsFromTestCase(bl_test.Test))
 suite.addTests(loader.loadTestsFromTestCase(handler_test.Test))
 suite.addTests(loader.loadTestsFromTestCase(firebase_client_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(connection_pool_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(connection_pool_test.DaoConnectionTest))
+suite.addTests(loader.loadTestsFromTestCase(firebase_client_test.TokenCacheTest))
+suite.addTests(loader.loadTestsFromTestCase(cache_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(cache_test.UserCacheTest))
+suite.addTests(loader.loadTestsFromTestCase(serialization_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(stat_rollups_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(player_ratings_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(analytics_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(ratings_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(migrate_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(plan_check_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(server_test.EventTest))
+suite.addTests(loader.loadTestsFromTestCase(server_test.ServerTest))
+suite.addTests(loader.loadTestsFromTestCase(server_test.AsyncServerTest))
+suite.addTests(loader.loadTestsFromTestCase(async_da_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(async_bl_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(async_handler_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(metrics_test.Test))
+suite.addTests(loader.loadTestsFromTestCase(query_budget_test.Test))
 
 result = unittest.TextTestRunner(verbosity=3).run(suite)
 exit(0 if result.wasSuccessful() else 1)